@@ -1,48 +1,55 @@
 import os
-import tifffile as tiff
-import numpy as np
 from tqdm import tqdm
 
-# ---------------------------
-# Paths
-# ---------------------------
-base_dir = os.path.join(os.path.dirname(__file__), "./", "data")
-he_dir = os.path.join(base_dir, "he")
-output_dir = os.path.join(base_dir, "he_downsample")
-
-os.makedirs(output_dir, exist_ok=True)
-
-# ---------------------------
-# Downsample factor
-# ---------------------------
 DOWNSAMPLE = 16
 
+
 # ---------------------------
 # Process all H&E files
 # ---------------------------
-he_files = sorted([f for f in os.listdir(he_dir) if f.endswith(".tif")])
+def downsample_he(he_dir, output_dir, downsample=DOWNSAMPLE):
+    import tifffile as tiff
 
-print(f"Found {len(he_files)} H&E slices")
+    os.makedirs(output_dir, exist_ok=True)
 
-for he_file in tqdm(he_files, desc="Downsampling H&E"):
+    he_files = sorted([f for f in os.listdir(he_dir) if f.endswith(".tif")])
 
-    input_path = os.path.join(he_dir, he_file)
-    output_path = os.path.join(output_dir, he_file)
+    print(f"Found {len(he_files)} H&E slices")
 
-    # ---------------------------
-    # Load large TIFF safely
-    # ---------------------------
-    with tiff.TiffFile(input_path) as tif:
-        img = tif.pages[0].asarray()
+    out_paths = []
+    for he_file in tqdm(he_files, desc="Downsampling H&E"):
 
-    # ---------------------------
-    # Downsample by slicing
-    # ---------------------------
-    img_small = img[::DOWNSAMPLE, ::DOWNSAMPLE]
+        input_path = os.path.join(he_dir, he_file)
+        output_path = os.path.join(output_dir, he_file)
+
+        # ---------------------------
+        # Load large TIFF safely
+        # ---------------------------
+        with tiff.TiffFile(input_path) as tif:
+            img = tif.pages[0].asarray()
+
+        # ---------------------------
+        # Downsample by slicing
+        # ---------------------------
+        img_small = img[::downsample, ::downsample]
 
+        # ---------------------------
+        # Save downsampled image
+        # ---------------------------
+        tiff.imwrite(output_path, img_small.astype(img.dtype))
+        out_paths.append(output_path)
+
+    return out_paths
+
+
+if __name__ == "__main__":
     # ---------------------------
-    # Save downsampled image
+    # Paths
     # ---------------------------
-    tiff.imwrite(output_path, img_small.astype(img.dtype))
+    base_dir = os.path.join(os.path.dirname(__file__), "./", "data")
+    he_dir = os.path.join(base_dir, "he")
+    output_dir = os.path.join(base_dir, "he_downsample")
+
+    downsample_he(he_dir, output_dir, DOWNSAMPLE)
 
-print("✅ Done! Downsampled images saved in:", output_dir)
+    print("✅ Done! Downsampled images saved in:", output_dir)
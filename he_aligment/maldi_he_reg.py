@@ -1,76 +1,61 @@
 import os
-import ants
+import re
 import numpy as np
 import cv2
-import matplotlib.pyplot as plt
 from tqdm import tqdm
-from tifffile import imwrite
 
-# ---------------------------
-# Paths
-# ---------------------------
-base_dir = os.path.join(os.path.dirname(__file__), "./")
-he_dir = os.path.join(base_dir, "data/he_downsample")
-maldi_dir = os.path.join(base_dir, "results/best")
+from preprocessing.prefetch import AsyncWriter, prefetch
+from preprocessing.slice_store import open_slices, slice_index
 
-output_dir_images = os.path.join(os.path.dirname(__file__), "", "he_maldi_reg")
-os.makedirs(output_dir_images, exist_ok=True)
+HE_BUNDLE_NAME = "he_transforms.bundle"
 
-# ---------------------------
-# Pair files by prefix 
-# ---------------------------
-import re
 
 # ---------------------------
 # Pair files by numeric index
 # ---------------------------
-he_files = sorted([f for f in os.listdir(he_dir) if f.endswith(".tif")])
-maldi_files = sorted([f for f in os.listdir(maldi_dir) if f.endswith(".png")])
-
-# Create index → filename dictionary for MALDI
-maldi_dict = {}
-
-for f in maldi_files:
-    match = re.search(r'\d+', f)
-    if match:
-        idx = int(match.group())
-        maldi_dict[idx] = f
-
-paired_files = []
-
-for he_file in he_files:
-    match = re.search(r'\d+', he_file)
-    if match:
-        idx = int(match.group())
-        if idx in maldi_dict:
-            paired_files.append((he_file, maldi_dict[idx]))
-        else:
-            print(f"⚠️ No MALDI slice found for H&E index {idx}")
+def pair_slices(he_dir, maldi_slices):
+    he_files = sorted([f for f in os.listdir(he_dir) if f.endswith(".tif")])
 
-print(f"Found {len(paired_files)} matched slice pairs")
+    # Create index → slice name dictionary for MALDI
+    maldi_dict = {slice_index(name): name for name in maldi_slices.names}
+
+    paired_files = []
+
+    for he_file in he_files:
+        match = re.search(r'\d+', he_file)
+        if match:
+            idx = int(match.group())
+            if idx in maldi_dict:
+                paired_files.append((he_file, maldi_dict[idx]))
+            else:
+                print(f"⚠️ No MALDI slice found for H&E index {idx}")
+
+    print(f"Found {len(paired_files)} matched slice pairs")
+    return paired_files
 
 
 # ---------------------------
-# Process each pair
+# Load images
 # ---------------------------
-for idx, (he_file, maldi_file) in enumerate(tqdm(paired_files, desc="Processing pairs")):
+def load_he(path):
+    he_gray = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    he_rgb  = cv2.imread(path, cv2.IMREAD_COLOR)
+    if he_gray is None or he_rgb is None:
+        return None, None
 
-    # ---------------------------
-    # Load images
-    # ---------------------------
-    he_gray = cv2.imread(os.path.join(he_dir, he_file), cv2.IMREAD_GRAYSCALE)
-    he_rgb  = cv2.imread(os.path.join(he_dir, he_file), cv2.IMREAD_COLOR)
     he_rgb  = cv2.cvtColor(he_rgb, cv2.COLOR_BGR2RGB)
     # Flip H&E left-right (horizontal flip)
     he_gray = cv2.flip(he_gray, 1)
     he_rgb  = cv2.flip(he_rgb, 1)
+    return he_gray, he_rgb
 
 
-    maldi_img = cv2.imread(os.path.join(maldi_dir, maldi_file), cv2.IMREAD_GRAYSCALE)
-
-    if he_gray is None or he_rgb is None or maldi_img is None:
-        print(f"⚠️ Skipping due to missing image for {he_file}")
-        continue
+# ---------------------------
+# Register one H&E → MALDI pair
+# ---------------------------
+def register_pair(he_gray, he_rgb, maldi_img, cache=None):
+    # cache: RegistrationCache; the ANTs call is skipped for unchanged pairs
+    import ants
 
     # ---------------------------
     # Resize to MALDI resolution
@@ -97,17 +82,21 @@ for idx, (he_file, maldi_file) in enumerate(tqdm(paired_files, desc="Processing
     fixed = ants.from_numpy(maldi_img_norm)
     moving = ants.from_numpy(he_gray_resized)
 
-    reg = ants.registration(
-        fixed=fixed,
-        moving=moving,
-        type_of_transform="SyN"
-    )
+    def run():
+        return ants.registration(
+            fixed=fixed,
+            moving=moving,
+            type_of_transform="SyN"
+        )
+
+    reg = run() if cache is None else cache.call("he_syn", {"type_of_transform": "SyN"},
+                                                  [fixed, moving], run)
 
     warped = reg["warpedmovout"].numpy()
     warped_norm = (warped - warped.min()) / (warped.max() - warped.min() + 1e-8)
 
     # ---------------------------
-    # Warp RGB H&E using SAME transform (NEW)
+    # Warp RGB H&E using SAME transform
     # ---------------------------
     warped_rgb = np.zeros_like(he_rgb_resized)
 
@@ -134,16 +123,32 @@ for idx, (he_file, maldi_file) in enumerate(tqdm(paired_files, desc="Processing
     overlay[..., 1] = maldi_vis
     overlay[..., 2] = 0
 
-    # ---------------------------
-    # Visualization (UNCHANGED)
-    # ---------------------------
+    return {
+        "maldi": maldi_img_norm,
+        "he_resized": he_gray_resized,
+        "warped": warped_norm,
+        "warped_rgb": warped_rgb,
+        "overlay": overlay,
+        "fwdtransforms": reg["fwdtransforms"],
+        "invtransforms": reg["invtransforms"],
+    }
+
+
+# ---------------------------
+# Visualization (UNCHANGED)
+# ---------------------------
+def save_alignment_figure(result, path):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
     plt.figure(figsize=(20, 5))
 
     panels = [
-        (maldi_img_norm, "MALDI (Fixed)"),
-        (he_gray_resized, "H&E (Resized)"),
-        (warped_norm, "Warped H&E"),
-        (overlay, "Overlay (RGB)")
+        (result["maldi"], "MALDI (Fixed)"),
+        (result["he_resized"], "H&E (Resized)"),
+        (result["warped"], "Warped H&E"),
+        (result["overlay"], "Overlay (RGB)")
     ]
 
     for i, (img, title) in enumerate(panels, 1):
@@ -156,33 +161,139 @@ for idx, (he_file, maldi_file) in enumerate(tqdm(paired_files, desc="Processing
         plt.axis("off")
 
     plt.tight_layout()
+    plt.savefig(path, bbox_inches="tight")
+    plt.close()
 
-    prefix = he_file.replace(".tif", "")
-    if prefix.endswith("_he"):
-        prefix = prefix[:-3]
 
-    plt.savefig(os.path.join(output_dir_images, f"alignment_{prefix}.png"),
-                bbox_inches="tight")
-    plt.close()
+# ---------------------------
+# Save outputs
+# ---------------------------
+def save_outputs(result, output_dir, prefix):
+    from tifffile import imwrite
+
+    save_alignment_figure(result, os.path.join(output_dir, f"alignment_{prefix}.png"))
 
-    # ---------------------------
-    # Save outputs
-    # ---------------------------
     imwrite(
-        os.path.join(output_dir_images, f"warped_he_{prefix}.tif"),
-        (warped_norm * 255).astype(np.uint8)
+        os.path.join(output_dir, f"warped_he_{prefix}.tif"),
+        (result["warped"] * 255).astype(np.uint8)
     )
 
     imwrite(
-        os.path.join(output_dir_images, f"overlay_{prefix}.tif"),
-        (overlay * 255).astype(np.uint8)
+        os.path.join(output_dir, f"overlay_{prefix}.tif"),
+        (result["overlay"] * 255).astype(np.uint8)
     )
 
     imwrite(
-        os.path.join(output_dir_images, f"warped_he_color_{prefix}.tif"),
-        (np.clip(warped_rgb, 0, 1) * 255).astype(np.uint8)
+        os.path.join(output_dir, f"warped_he_color_{prefix}.tif"),
+        (np.clip(result["warped_rgb"], 0, 1) * 255).astype(np.uint8)
     )
 
-    print(f"Saved outputs for: {prefix}")
 
-print("Done! Results saved in", output_dir_images)
\ No newline at end of file
+def he_prefix(he_file):
+    prefix = he_file.replace(".tif", "")
+    if prefix.endswith("_he"):
+        prefix = prefix[:-3]
+    return prefix
+
+
+# ---------------------------
+# Keep transforms for point mapping
+# ---------------------------
+def store_he_transforms(bundle, maldi_name, he_file, he_shape, result, field_mode="full"):
+    # forward chain (MALDI → resized H&E) + inverse warp, and what it takes
+    # to get back to original H&E pixels (see registration.coordinate_map).
+    # field_mode "bspline" / "downsample" trades exactness for size
+    inverse_warps = [tf for tf in result["invtransforms"] if tf.endswith("InverseWarp.nii.gz")]
+    bundle.add(maldi_name, result["fwdtransforms"] + inverse_warps,
+               field_mode=field_mode, factor=4, tolerance=0.5)
+    bundle.meta.setdefault("he", {})[maldi_name] = {
+        "file": he_file,
+        "shape": list(he_shape[:2]),
+        "target": list(result["maldi"].shape[:2]),
+        "flip": True,
+    }
+
+
+# ---------------------------
+# Process each pair
+# ---------------------------
+def maldi_he_reg(he_dir, maldi_dir, output_dir=None, bundle_path=None, cache=None,
+                 field_mode="full"):
+    # maldi_dir: registered MALDI store / PNG folder / MemorySlices.
+    # Returns prefix → registration result; writes figures and TIFFs only
+    # when output_dir is given. Transforms (forward and inverse) go to
+    # bundle_path, by default output_dir/he_transforms.bundle, and their
+    # temporary files are then deleted; without a bundle the results keep the
+    # paths and the caller owns the files (registration_cache.release).
+    # cache: a RegistrationCache or its directory. field_mode: see
+    # store_he_transforms.
+    from registration.registration_cache import TRANSFORM_KEYS, open_cache, release
+    from registration.transform_bundle import TransformBundle
+
+    cache = open_cache(cache)
+
+    maldi_slices = open_slices(maldi_dir)
+    paired_files = pair_slices(he_dir, maldi_slices)
+
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+        if bundle_path is None:
+            bundle_path = os.path.join(output_dir, HE_BUNDLE_NAME)
+
+    bundle = None if bundle_path is None else TransformBundle(bundle_path, mode="w")
+
+    # TIFF decode of the next pairs overlaps the current registration;
+    # figures and TIFFs are encoded and written in the background
+    def load_pair(pair):
+        he_file, maldi_file = pair
+        he_gray, he_rgb = load_he(os.path.join(he_dir, he_file))
+        return he_gray, he_rgb, np.array(maldi_slices.read(maldi_file), dtype=np.float32)
+
+    writer = AsyncWriter()
+    results = {}
+    for (he_file, maldi_file), (he_gray, he_rgb, maldi_img) in tqdm(
+            prefetch(load_pair, paired_files, depth=4), total=len(paired_files),
+            desc="Processing pairs"):
+
+        if he_gray is None:
+            print(f"⚠️ Skipping due to missing image for {he_file}")
+            continue
+
+        prefix = he_prefix(he_file)
+        result = register_pair(he_gray, he_rgb, maldi_img, cache)
+        results[prefix] = result
+
+        if bundle is not None:
+            store_he_transforms(bundle, maldi_file, he_file, he_gray.shape, result, field_mode)
+            release(result)
+            for k in TRANSFORM_KEYS:
+                result.pop(k)
+
+        if output_dir is not None:
+            writer.submit(save_outputs, result, output_dir, prefix)
+
+    writer.close()
+    if output_dir is not None:
+        print(f"Saved outputs for {len(results)} pairs")
+
+    if bundle is not None:
+        bundle.close()
+        print(f"H&E transforms saved to {bundle_path}")
+
+    return results
+
+
+if __name__ == "__main__":
+    # ---------------------------
+    # Paths
+    # ---------------------------
+    base_dir = os.path.join(os.path.dirname(__file__), "./")
+    he_dir = os.path.join(base_dir, "data/he_downsample")
+    maldi_dir = os.path.join(base_dir, "results/best.slices")   # float store or PNG folder
+
+    output_dir_images = os.path.join(os.path.dirname(__file__), "", "he_maldi_reg")
+    registration_cache = os.path.join(output_dir_images, ".registration_cache")   # None → off
+
+    maldi_he_reg(he_dir, maldi_dir, output_dir_images, cache=registration_cache)
+
+    print("Done! Results saved in", output_dir_images)
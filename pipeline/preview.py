@@ -0,0 +1,203 @@
+import json
+import math
+import numpy as np
+from pathlib import Path
+
+from preprocessing.slice_store import MemorySlices, export_png
+from registration.phase_init import ncc
+
+# =========================
+# PREVIEW MODE
+# =========================
+# The whole in-memory pipeline (run_pipeline) on a reduced problem, to check
+# a new dataset or parameter set in minutes:
+#
+#   slice_step    every n-th good slice, counted back from the anchor
+#   downsample    f×f block means of every slice (after normalization)
+#   channel_step  every n-th selected m/z (the reference is always kept)
+#   schedule      registration iterations × schedule, and the pyramid levels
+#                 finer than the downsampling are dropped
+#
+# The result gets a QC summary (qc.json: stage timings, neighbour NCC of the
+# registered slices with outliers flagged, per-channel volume stats) plus
+# mid-plane PNGs of the reference volume. Its transforms.bundle records the
+# factors, so registration.preview_init.PreviewInit can start the
+# full-resolution run from it (register_stack(preview_init=...)).
+PREVIEW = dict(slice_step=4, downsample=4, channel_step=10, schedule=0.5)
+ANTS_AFF_ITERATIONS = (2100, 1200, 1200, 10)
+ANTS_AFF_SHRINK_FACTORS = (6, 4, 2, 1)
+ANTS_AFF_SMOOTHING_SIGMAS = (3, 2, 1, 0)
+LINEAR_TYPES = ("Rigid", "Similarity", "Translation", "Affine")
+QC_NAME = "qc.json"
+OUTLIER_MADS = 3.0
+OUTLIER_MIN_DROP = 0.05
+
+
+# =========================
+# REDUCTIONS
+# =========================
+def preview_columns(mz_cols, channel_step, reference_col):
+    cols = list(mz_cols)[::channel_step]
+    if reference_col not in cols:
+        cols.append(reference_col)
+    return cols
+
+
+def preview_slice_ids(tissue_ids, slice_step, bad_slices=()):
+    # tissue ids kept: the anchor (last) and every slice_step-th good one before it
+    ids = sorted(set(int(t) for t in tissue_ids))
+    good = [t for t in ids if f"slice_{t:03d}" not in bad_slices]
+    return sorted(set(good[::-1][::slice_step]) | {ids[-1]})
+
+
+def downsample_slice(img, factor):
+    # block mean; preview pixel p covers full pixels f·p … f·p + f - 1
+    img = np.asarray(img, dtype=np.float32)
+    if factor == 1:
+        return img
+    h, w = img.shape
+    padded = np.zeros((-(-h // factor) * factor, -(-w // factor) * factor), dtype=np.float32)
+    padded[:h, :w] = img
+    return padded.reshape(padded.shape[0] // factor, factor, -1, factor).mean(axis=(1, 3))
+
+
+def downsample_slices(source, factor):
+    return MemorySlices({name: downsample_slice(source.read(name), factor) for name in source.names})
+
+
+def _levels(iterations, shrink, sigmas, schedule, downsample):
+    # drop the levels finer than the preview resolution (keep at least the
+    # coarsest one), rescale the rest
+    keep = [k for k, s in enumerate(shrink) if s >= downsample] or [0]
+    return (
+        tuple(math.ceil(iterations[k] * schedule) if iterations[k] else 0 for k in keep),
+        tuple(max(1, round(shrink[k] / downsample)) for k in keep),
+        tuple(round(sigmas[k] / downsample) for k in keep),
+    )
+
+
+def preview_params(params, schedule=0.5, downsample=4):
+    # RIGID_PARAMS / SYN_PARAMS-style dict with a proportionally reduced schedule
+    out = dict(params)
+    if params.get("type_of_transform") in LINEAR_TYPES:
+        out["aff_iterations"], out["aff_shrink_factors"], out["aff_smoothing_sigmas"] = _levels(
+            params.get("aff_iterations", ANTS_AFF_ITERATIONS),
+            params.get("aff_shrink_factors", ANTS_AFF_SHRINK_FACTORS),
+            params.get("aff_smoothing_sigmas", ANTS_AFF_SMOOTHING_SIGMAS),
+            schedule, downsample,
+        )
+    else:
+        # SyN levels are shrunk 2^k, finest last (as ants.registration sets them)
+        its = params.get("reg_iterations", (40, 20, 0))
+        shrink = [2 ** (len(its) - 1 - k) for k in range(len(its))]
+        out["reg_iterations"] = _levels(its, shrink, shrink, schedule, downsample)[0]
+    return out
+
+
+def mark_preview(bundle_path, preview):
+    from registration.transform_bundle import TransformBundle
+
+    with TransformBundle(bundle_path, mode="a") as bundle:
+        bundle.meta["preview"] = dict(preview)
+
+
+# =========================
+# QC SUMMARY
+# =========================
+def registration_qc(registered):
+    # NCC of each registered slice against its neighbour in the chain
+    names = registered.names
+    rows = []
+    for name, nxt in zip(names[:-1], names[1:]):
+        a, b = registered.read(name), registered.read(nxt)
+        if a.shape != b.shape:
+            continue
+        rows.append({"slice": name, "neighbour": nxt, "ncc": float(ncc(a, b, (a > 0) | (b > 0)))})
+
+    if rows:
+        values = np.array([r["ncc"] for r in rows])
+        med = np.median(values)
+        # robust cut, but never closer than OUTLIER_MIN_DROP to the median
+        mad = np.median(np.abs(values - med))
+        cut = med - max(OUTLIER_MADS * mad, OUTLIER_MIN_DROP)
+        for r in rows:
+            r["outlier"] = bool(r["ncc"] < cut)
+    return rows
+
+
+def volume_qc(volumes):
+    return {
+        mz: {
+            "shape": list(vol.shape),
+            "nonzero": float(np.count_nonzero(vol) / vol.size),
+            "mean": float(vol.mean()),
+            "max": float(vol.max()),
+        }
+        for mz, vol in volumes.items()
+    }
+
+
+def preview_qc(result, reference_mz, preview, output_root=None):
+    slices = registration_qc(result["registered"])
+    qc = {
+        "preview": dict(preview),
+        "timings": result.get("timings", {}),
+        "slices": slices,
+        "outliers": [r["slice"] for r in slices if r["outlier"]],
+        "median_ncc": float(np.median([r["ncc"] for r in slices])) if slices else None,
+        "volumes": volume_qc(result["volumes"]),
+    }
+
+    if output_root is not None:
+        output_root = Path(output_root)
+        with open(output_root / QC_NAME, "w") as f:
+            json.dump(qc, f, indent=1)
+
+        vol = result["volumes"].get(reference_mz)
+        if vol is not None:
+            z, y, x = (s // 2 for s in vol.shape)
+            export_png(vol[z], output_root / f"qc_{reference_mz}_z{z}.png")
+            export_png(vol[:, y], output_root / f"qc_{reference_mz}_y{y}.png")
+            export_png(vol[:, :, x], output_root / f"qc_{reference_mz}_x{x}.png")
+    return qc
+
+
+def print_qc(qc):
+    print("\n📋 Preview QC")
+    for stage, seconds in qc["timings"].items():
+        print(f"  {stage:<12} {seconds:7.1f} s")
+    if qc["median_ncc"] is not None:
+        print(f"  neighbour NCC median {qc['median_ncc']:.3f}, "
+              f"{len(qc['outliers'])} outliers {qc['outliers'] or ''}")
+    shapes = {tuple(v["shape"]) for v in qc["volumes"].values()}
+    print(f"  {len(qc['volumes'])} volumes, shape {', '.join(map(str, shapes))}")
+
+
+def run_preview(input_csv, reference_mz, output_root=None, preview=PREVIEW, **pipeline_kwargs):
+    from pipeline.runner import run_pipeline
+
+    preview = {**PREVIEW, **preview}
+    result = run_pipeline(input_csv, reference_mz, output_root, preview=preview, **pipeline_kwargs)
+    result["qc"] = preview_qc(result, result["reference_mz"], preview, output_root)
+    print_qc(result["qc"])
+    return result
+
+
+if __name__ == "__main__":
+    # =========================
+    # CONFIG
+    # =========================
+    INPUT = "data/Cochlea_3D_TIC.csv"
+    OUTPUT_ROOT = Path("results_preview")
+
+    START = 0
+    END = 100
+    REFERENCE_MZ = "130.889"
+
+    # every 4th slice, 4× coarser pixels, every 10th m/z, half the iterations
+    PREVIEW = dict(slice_step=4, downsample=4, channel_step=10, schedule=0.5)
+
+    run_preview(INPUT, REFERENCE_MZ, OUTPUT_ROOT, PREVIEW, mz_start=START, mz_end=END)
+
+    print(f"\n✅ Preview written to {OUTPUT_ROOT}")
+    print(f"Warm-start the full run with PREVIEW_BUNDLE = {OUTPUT_ROOT / 'transforms.bundle'}")
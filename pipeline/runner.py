@@ -0,0 +1,248 @@
+import os
+import tempfile
+import time
+import numpy as np
+from pathlib import Path
+
+from preprocessing.channel_stats import csv_channel_stats, rank_channels
+from preprocessing.generate_all_slices import (
+    HIST_BINS,
+    PERCENTILES,
+    channel_slices,
+    save_channel,
+)
+from preprocessing.mz_binning import bin_of, reduce_channels, save_provenance
+from preprocessing.normalization import StreamingHistogram, histogram_window
+from preprocessing.prefetch import AsyncWriter
+from preprocessing.trim_csv import read_channels, select_mz_cols
+from pipeline.preview import (
+    downsample_slices,
+    mark_preview,
+    preview_columns,
+    preview_params,
+    preview_slice_ids,
+)
+from registration.main_registration import BAD_SLICE_NAMES, RIGID_PARAMS, SYN_PARAMS, register_stack
+from registration.transform_all import (
+    BAD_SLICE_INDICES,
+    MidpointFields,
+    open_transforms,
+    reference_image,
+    warp_channel,
+    write_volume,
+)
+
+
+# =========================
+# HELPERS
+# =========================
+def frames_window(frames, percentiles=PERCENTILES, hist_bins=HIST_BINS):
+    # "global" window over in-memory channel frames (same as global_window)
+    hist = StreamingHistogram(hist_bins)
+    for mz_col, df in frames.items():
+        hist.update(np.log1p(df[mz_col].to_numpy(dtype=np.float64)))
+    return histogram_window(hist, percentiles)
+
+
+# =========================
+# CSV → SLICES → REGISTRATION → VOLUMES
+# =========================
+def run_pipeline(input_csv, reference_mz, output_root=None, mz_start=0, mz_end=None,
+                 norm_mode="channel", percentiles=PERCENTILES, hist_bins=HIST_BINS,
+                 bad_slices=BAD_SLICE_NAMES,
+                 bad_indices=BAD_SLICE_INDICES, keep_intermediates=False,
+                 he_dir=None, top_channels=None, impute="copy", binning=None, preview=None,
+                 **registration_kwargs):
+    # Every stage hands its result to the next in memory (SparseChannel /
+    # MemorySlices, ANTs images, numpy volumes). With output_root set, the transform bundle
+    # and one .nii.gz per m/z are written; keep_intermediates also saves the
+    # slice stores and registered reference slices. top_channels=N keeps the N
+    # m/z with the largest TIC share instead of mz_start:mz_end. impute fills
+    # bad slices while warping (see transform_all.IMPUTE_MODES). binning
+    # (reduce_channels kwargs) merges neighbouring m/z and drops weak bins first.
+    # preview (pipeline.preview.PREVIEW-style dict) subsamples slices, pixels
+    # and channels and shortens the registration schedules.
+    # registration_kwargs are passed to register_stack.
+    output_root = Path(output_root) if output_root is not None else None
+    if output_root is not None:
+        output_root.mkdir(parents=True, exist_ok=True)
+    timings = {}
+    t0 = time.perf_counter()
+
+    # =========================
+    # STAGE 1: CSV → CHANNEL FRAMES
+    # =========================
+    bins = None
+    reference_col = f"m.z.{reference_mz}"
+    if binning is not None:
+        bins, provenance = reduce_channels(input_csv, **binning)
+        if output_root is not None:
+            save_provenance(provenance, output_root)
+        if bin_of(reference_col, bins) is None:
+            bins[reference_col] = [reference_col]
+        reference_col = bin_of(reference_col, bins)
+        reference_mz = reference_col.replace("m.z.", "")
+        mz_cols = list(bins)
+    elif top_channels is None:
+        mz_cols = select_mz_cols(input_csv, mz_start, mz_end)
+    else:
+        summary, _ = csv_channel_stats(input_csv)
+        mz_cols = rank_channels(summary, top=top_channels)
+    if reference_col not in mz_cols:
+        mz_cols.append(reference_col)
+    if preview is not None:
+        mz_cols = preview_columns(mz_cols, preview["channel_step"], reference_col)
+
+    print(f"Reading {len(mz_cols)} m/z channels from {input_csv}")
+    frames = read_channels(input_csv, mz_cols, bins)
+
+    if preview is not None:
+        tissue = frames[reference_col]["tissue_id"]
+        keep = tissue.isin(preview_slice_ids(tissue.unique(), preview["slice_step"], bad_slices))
+        frames = {mz: df[keep.to_numpy()] for mz, df in frames.items()}
+        print(f"Preview: {keep.sum():,} of {len(keep):,} pixels, {len(frames)} channels")
+    timings["csv"] = time.perf_counter() - t0
+
+    # =========================
+    # STAGE 2: FRAMES → SLICES
+    # =========================
+    window = None
+    if norm_mode == "global":
+        window = frames_window(frames, percentiles, hist_bins)
+        if window is None:
+            raise RuntimeError("No non-zero intensities found in any channel")
+
+    # channels stay sparse (tissue pixels only) and share one TissueGrid
+    channels = {}
+    grid = None
+    for mz_col, df in frames.items():
+        slices = channel_slices(df, mz_col, norm_mode, window, percentiles, hist_bins, grid)
+        if slices is None:
+            print(f"⚠️ Skipping {mz_col} (no non-zero intensities)")
+            continue
+        grid = slices.grid
+        channels[mz_col.replace("m.z.", "")] = slices
+    del frames
+
+    if reference_mz not in channels:
+        raise RuntimeError(f"Reference channel {reference_mz} has no signal")
+
+    if preview is not None:
+        channels = {mz: downsample_slices(sl, preview["downsample"]) for mz, sl in channels.items()}
+        for key, default in (("rigid_params", RIGID_PARAMS), ("syn_params", SYN_PARAMS)):
+            registration_kwargs[key] = preview_params(registration_kwargs.get(key, default),
+                                                      preview["schedule"], preview["downsample"])
+
+    if keep_intermediates and output_root is not None:
+        for mz_val, slices in channels.items():
+            save_channel(slices, output_root / "slices", mz_val)
+
+    timings["slices"] = time.perf_counter() - t0 - sum(timings.values())
+
+    # =========================
+    # STAGE 3: REGISTER REFERENCE CHANNEL
+    # =========================
+    print(f"\n🚀 Registering reference m/z {reference_mz}")
+    reference = channels[reference_mz]
+    registered, bundle_path = register_stack(
+        reference,
+        bundle_path=None if output_root is None else output_root / "transforms.bundle",
+        out_store=output_root / "best.slices" if keep_intermediates and output_root else None,
+        bad_slices=bad_slices,
+        **registration_kwargs
+    )
+    if preview is not None:
+        mark_preview(bundle_path, preview)
+    timings["registration"] = time.perf_counter() - t0 - sum(timings.values())
+
+    # =========================
+    # STAGE 4: WARP EVERY CHANNEL
+    # =========================
+    anchor_name = reference.names[-1]
+    transforms = open_transforms(bundle_path)
+    fixed = reference_image(registered, anchor_name)
+    fields = MidpointFields(registered) if impute == "midpoint" else None
+
+    volumes = {}
+    with AsyncWriter(depth=2) as writer:
+        for mz_val, slices in channels.items():
+            print(f"\n🚀 Processing m/z {mz_val}")
+            volume = warp_channel(slices, transforms, fixed, anchor_name, bad_indices,
+                                  f" ({mz_val})", impute, fields)
+            if volume is None:
+                print(f"⚠️ No slices warped for {mz_val}")
+                continue
+
+            volumes[mz_val] = volume
+            if output_root is not None:
+                (output_root / "volumes").mkdir(exist_ok=True)
+                writer.submit(write_volume, volume, output_root / "volumes" / f"{mz_val}.nii.gz")
+
+    timings["warp"] = time.perf_counter() - t0 - sum(timings.values())
+
+    if output_root is None:
+        os.unlink(bundle_path)
+        bundle_path = None
+
+    # =========================
+    # OPTIONAL: H&E ↔ MALDI
+    # =========================
+    he = None
+    if he_dir is not None:
+        from he_aligment.maldi_he_reg import HE_BUNDLE_NAME, maldi_he_reg
+
+        he_out = output_root / "he_maldi_reg" if keep_intermediates and output_root else None
+        if output_root is None:
+            # a throwaway bundle, like the main one: maldi_he_reg deletes the
+            # ANTs files of every pair once they are stored
+            fd, he_bundle = tempfile.mkstemp(suffix=".bundle")
+            os.close(fd)
+        else:
+            he_bundle = output_root / HE_BUNDLE_NAME
+        he = maldi_he_reg(he_dir, registered, he_out, he_bundle)
+        if output_root is None:
+            os.unlink(he_bundle)
+
+    return {
+        "reference_mz": reference_mz,
+        "timings": timings,
+        "channels": channels,
+        "registered": registered,
+        "bundle": bundle_path,
+        "volumes": volumes,
+        "he": he,
+    }
+
+
+if __name__ == "__main__":
+    from registration.preview_init import PreviewInit
+
+    # =========================
+    # CONFIG
+    # =========================
+    INPUT = "data/Cochlea_3D_TIC.csv"
+    OUTPUT_ROOT = Path("results_pipeline")   # None → nothing written to disk
+
+    START = 0
+    END = 100
+    REFERENCE_MZ = "130.889"   # channel whose registration is reused for all m/z
+
+    NORM_MODE = "channel"
+    KEEP_INTERMEDIATES = False   # also save slice stores + registered slices
+    HE_DIR = None   # e.g. "he_aligment/data/he_downsample"
+    IMPUTE = "midpoint"   # bad slices: "copy" | "blend" | "midpoint"
+    BINNING = None   # e.g. dict(ppm=10, min_tic_fraction=1e-4, min_nonzero=0.01)
+    PREVIEW_BUNDLE = None   # e.g. "results_preview/transforms.bundle" (warm start)
+
+    run_pipeline(
+        INPUT, REFERENCE_MZ, OUTPUT_ROOT,
+        mz_start=START, mz_end=END,
+        norm_mode=NORM_MODE,
+        keep_intermediates=KEEP_INTERMEDIATES,
+        he_dir=HE_DIR,
+        impute=IMPUTE,
+        binning=BINNING,
+        preview_init=None if PREVIEW_BUNDLE is None else PreviewInit(PREVIEW_BUNDLE),
+    )
+
+    print("\n✅ Pipeline complete")
@@ -0,0 +1,437 @@
+import json
+import os
+import shutil
+import time
+import uuid
+import numpy as np
+from pathlib import Path
+
+from pipeline.workqueue import LEASE_SECONDS, MAX_ATTEMPTS, WorkQueue, run_worker
+from preprocessing.csv_reader import CHUNK_SIZE, read_csv
+from preprocessing.generate_all_slices import (
+    HIST_BINS,
+    PERCENTILES,
+    channel_slices,
+    find_mz_col,
+    global_window,
+    save_channel,
+)
+from preprocessing.slice_store import STORE_SUFFIX, open_slices
+from preprocessing.sparse_slices import GRID_DIR, SPARSE_SUFFIX
+from registration.transform_all import (
+    BAD_SLICE_INDICES,
+    MidpointFields,
+    channel_sources,
+    fill_imputed,
+    open_transforms,
+    reference_image,
+    warp_slices,
+    write_volume,
+)
+
+# =========================
+# SHARDED STAGES
+# =========================
+# generate_all_slices and transform_all split into work units on a
+# WorkQueue. Every unit writes to a private temporary name and publishes with
+# a rename, so a unit that runs twice (expired lease, retry) leaves the same
+# output behind.
+#
+#   slices-<mz>            one trimmed CSV → <out_root>/<mz>.slices (.sparse)
+#   warp-<mz>              one channel → <output_root>/<mz>.nii.gz
+#   warp-<mz>-<start>      slices [start, stop) → <mz>.parts/<start>.npz; the
+#                          worker that finds every part present merges them,
+#                          holding <mz>.nii.gz.merge.lease (O_EXCL, like the
+#                          queue's unit leases) so only one merge runs
+
+
+def publish_dir(tmp, final):
+    # first finished copy wins; later duplicates are dropped
+    tmp, final = Path(tmp), Path(final)
+    if final.exists():
+        shutil.rmtree(tmp, ignore_errors=True)
+        return final
+    try:
+        os.rename(tmp, final)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return final
+
+
+def tmp_name(path):
+    path = Path(path)
+    return path.with_name(f".{path.name}.{uuid.uuid4().hex[:8]}.tmp")
+
+
+# =========================
+# SUBMIT
+# =========================
+def submit_slices(queue, trimmed_dir, out_root, norm_mode="channel", percentiles=PERCENTILES,
+                  hist_bins=HIST_BINS, chunk_size=CHUNK_SIZE, export=False, storage="dense"):
+    csv_files = sorted(Path(trimmed_dir).glob("Cochlea_3D_m.z.*.csv"))
+
+    meta = queue.meta
+    if not meta:
+        window = None
+        if norm_mode == "global":
+            window = global_window(csv_files, percentiles, hist_bins, chunk_size)
+            if window is None:
+                raise RuntimeError("No non-zero intensities found in any CSV")
+        meta = dict(
+            stage="slices", out_root=str(out_root), norm_mode=norm_mode,
+            window=None if window is None else list(window),
+            percentiles=list(percentiles), hist_bins=hist_bins, export=export,
+            storage=storage,
+        )
+
+    units = {}
+    for csv_path in csv_files:
+        mz_val = csv_path.stem.replace("Cochlea_3D_m.z.", "")
+        units[f"slices-{mz_val}"] = {"csv": str(csv_path), "mz": mz_val}
+
+    return queue.submit(units, meta)
+
+
+def submit_warp(queue, slices_root, registered, output_root, reference_name,
+                bundle_path=None, transform_root=None, bad_indices=BAD_SLICE_INDICES,
+                slices_per_unit=None, impute="copy"):
+    # slices_per_unit=None → one unit per channel, otherwise (channel, slice
+    # range) units of that many slices
+    meta = dict(
+        stage="warp", output_root=str(output_root), registered=str(registered),
+        reference_name=reference_name,
+        bundle_path=None if bundle_path is None else str(bundle_path),
+        transform_root=None if transform_root is None else str(transform_root),
+        bad_indices=list(bad_indices),
+        impute=impute,
+    )
+
+    units = {}
+    for mz, mz_path in channel_sources(slices_root):
+        if slices_per_unit is None:
+            units[f"warp-{mz}"] = {"mz": mz, "source": str(mz_path)}
+            continue
+
+        names = open_slices(mz_path).names
+        starts = list(range(0, len(names), slices_per_unit))
+        for start in starts:
+            units[f"warp-{mz}-{start:05d}"] = {
+                "mz": mz, "source": str(mz_path),
+                "start": start, "stop": start + slices_per_unit, "starts": starts,
+            }
+
+    return queue.submit(units, meta)
+
+
+# =========================
+# HANDLERS
+# =========================
+def handle_slices(unit_id, payload, meta):
+    out_root = Path(meta["out_root"])
+    suffix = SPARSE_SUFFIX if meta["storage"] == "sparse" else STORE_SUFFIX
+    final = out_root / f"{payload['mz']}{suffix}"
+    if final.exists():
+        return {"store": str(final), "skipped": True}
+
+    csv_path = payload["csv"]
+    mz_col = find_mz_col(csv_path)
+    if mz_col is None:
+        return {"store": None, "reason": "could not uniquely identify m/z column"}
+
+    window = None if meta["window"] is None else tuple(meta["window"])
+    slices = channel_slices(
+        read_csv(csv_path), mz_col, meta["norm_mode"], window,
+        tuple(meta["percentiles"]), meta["hist_bins"],
+    )
+    if slices is None:
+        return {"store": None, "reason": "no non-zero intensities"}
+
+    # stage under a private name next to the final store, then rename
+    tmp = tmp_name(final)
+    tmp.mkdir(parents=True)
+    store = save_channel(slices, tmp, payload["mz"], meta["export"], meta["storage"])
+    for p in tmp.iterdir():
+        if p.name == GRID_DIR:
+            # grids are shared by channels: publish file by file
+            (out_root / GRID_DIR).mkdir(exist_ok=True)
+            for g in p.iterdir():
+                if not (out_root / GRID_DIR / g.name).exists():
+                    os.replace(g, out_root / GRID_DIR / g.name)
+        elif p != store:
+            publish_dir(p, out_root / p.name)
+    publish_dir(store, final)
+    shutil.rmtree(tmp, ignore_errors=True)
+    return {"store": str(final)}
+
+
+_warp_context = {}
+
+
+def warp_context(meta):
+    # bundle, fixed image and midpoint fields are opened once per worker
+    # process
+    key = (meta["registered"], meta["reference_name"], meta["bundle_path"])
+    if key not in _warp_context:
+        transforms = open_transforms(meta["bundle_path"], meta["transform_root"])
+        fixed = reference_image(meta["registered"], meta["reference_name"])
+        fields = MidpointFields(meta["registered"])
+        _warp_context[key] = (transforms, fixed, fields)
+    return _warp_context[key]
+
+
+def impute_args(meta, source):
+    # (mode, stack names, fields) for fill_imputed
+    _, _, fields = warp_context(meta)
+    ref_sid = Path(meta["reference_name"]).stem
+    names = [n for n in source.names if n != ref_sid]
+    return meta.get("impute", "copy"), names, fields
+
+
+def publish_volume(volume, out_path):
+    tmp = tmp_name(out_path).with_suffix(".nii.gz")
+    write_volume(volume, tmp)
+    os.replace(tmp, out_path)
+    return out_path
+
+
+def merge_lease(out_path, lease_seconds=LEASE_SECONDS):
+    # O_EXCL claim on merging one volume → (lease path, token), or None while
+    # another worker merges. A lease not touched for lease_seconds (merger
+    # died) is renamed away first, as in WorkQueue._break_expired.
+    lease = out_path.with_name(f"{out_path.name}.merge.lease")
+    try:
+        if time.time() - lease.stat().st_mtime > lease_seconds:
+            stale = tmp_name(lease)
+            os.rename(lease, stale)
+            stale.unlink(missing_ok=True)
+    except FileNotFoundError:
+        pass
+
+    token = uuid.uuid4().hex
+    try:
+        fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return None
+    with os.fdopen(fd, "w") as f:
+        json.dump({"token": token, "pid": os.getpid()}, f)
+    return lease, token
+
+
+def _holds(lease, token):
+    # touches the merge lease; False once it was broken and re-claimed
+    try:
+        with open(lease) as f:
+            if json.load(f).get("token") != token:
+                return False
+            os.utime(f.fileno())
+        return True
+    except (FileNotFoundError, json.JSONDecodeError):
+        return False
+
+
+def merge_parts(parts_dir, starts, out_path, ref_img_np, impute=("copy", None, None),
+                lease_seconds=LEASE_SECONDS):
+    # Joins part files in slice order; None until every part exists or while
+    # another worker holds the merge. impute: (mode, names, fields) as
+    # returned by impute_args
+    parts_dir, out_path = Path(parts_dir), Path(out_path)
+    if out_path.exists():
+        return out_path
+
+    part_paths = [parts_dir / f"{start:05d}.npz" for start in starts]
+    if not all(p.exists() for p in part_paths):
+        return None
+
+    claim = merge_lease(out_path, lease_seconds)
+    if claim is None:
+        return None
+    lease, token = claim
+    try:
+        # the previous holder may have published and cleaned up just before
+        if out_path.exists():
+            return out_path
+        if not all(p.exists() for p in part_paths):
+            return None
+
+        warped_stack = []
+        for p in part_paths:
+            if not _holds(lease, token):
+                return None
+            with np.load(p) as part:
+                imputed = set(part["imputed"].tolist())
+                warped = iter(part["warped"])
+                for i in range(int(part["count"])):
+                    warped_stack.append(None if i in imputed else next(warped))
+
+        if not warped_stack or not _holds(lease, token):
+            return None
+
+        publish_volume(np.stack(fill_imputed(warped_stack, ref_img_np, *impute), axis=0), out_path)
+        shutil.rmtree(parts_dir, ignore_errors=True)
+        return out_path
+    finally:
+        if _holds(lease, token):
+            lease.unlink(missing_ok=True)
+
+
+def handle_warp(unit_id, payload, meta):
+    output_root = Path(meta["output_root"])
+    output_root.mkdir(parents=True, exist_ok=True)
+    mz = payload["mz"]
+    out_path = output_root / f"{mz}.nii.gz"
+    if out_path.exists():
+        return {"volume": str(out_path), "skipped": True}
+
+    transforms, fixed, _ = warp_context(meta)
+    source = open_slices(payload["source"])
+    bad_indices = set(meta["bad_indices"])
+    impute = impute_args(meta, source)
+
+    # -----------------------------
+    # whole channel
+    # -----------------------------
+    if "start" not in payload:
+        warped_stack = warp_slices(
+            source, transforms, fixed, meta["reference_name"], bad_indices, desc=f" ({mz})"
+        )
+        if not warped_stack:
+            return {"volume": None, "reason": "no slices warped"}
+        publish_volume(np.stack(fill_imputed(warped_stack, fixed.numpy(), *impute), axis=0),
+                       out_path)
+        return {"volume": str(out_path)}
+
+    # -----------------------------
+    # slice range → part file
+    # -----------------------------
+    names = source.names[payload["start"]:payload["stop"]]
+    warped_stack = warp_slices(
+        source, transforms, fixed, meta["reference_name"], bad_indices,
+        names=names, desc=f" ({mz} {payload['start']}:{payload['stop']})"
+    )
+
+    parts_dir = output_root / f"{mz}.parts"
+    parts_dir.mkdir(exist_ok=True)
+    part_path = parts_dir / f"{payload['start']:05d}.npz"
+
+    imputed = [i for i, img in enumerate(warped_stack) if img is None]
+    warped = [img for img in warped_stack if img is not None]
+    tmp = tmp_name(part_path).with_suffix(".npz")
+    np.savez(
+        tmp,
+        count=len(warped_stack),
+        imputed=np.array(imputed, dtype=np.int64),
+        warped=np.stack(warped) if warped else np.zeros((0,) + fixed.shape, dtype=np.float32),
+    )
+    os.replace(tmp, part_path)
+
+    merged = merge_parts(parts_dir, payload["starts"], out_path, fixed.numpy(), impute)
+    return {"part": str(part_path), "volume": None if merged is None else str(merged)}
+
+
+HANDLERS = {"slices": handle_slices, "warp": handle_warp}
+
+
+def handle_unit(unit_id, payload, meta):
+    return HANDLERS[meta["stage"]](unit_id, payload, meta)
+
+
+# =========================
+# WORKERS
+# =========================
+def merge_pending(queue):
+    # Merges channels whose parts all finished but whose merge did not
+    # (e.g. the merging worker died); safe to call from every worker
+    meta = queue.meta
+    if meta.get("stage") != "warp":
+        return []
+
+    merged = []
+    channels = {}
+    for unit_id in queue.unit_ids():
+        payload = queue.payload(unit_id)
+        if "start" in payload:
+            channels[payload["mz"]] = payload
+
+    output_root = Path(meta["output_root"])
+    for mz, payload in channels.items():
+        out_path = output_root / f"{mz}.nii.gz"
+        if out_path.exists():
+            continue
+        _, fixed, _ = warp_context(meta)
+        impute = impute_args(meta, open_slices(payload["source"]))
+        if merge_parts(output_root / f"{mz}.parts", payload["starts"], out_path, fixed.numpy(),
+                       impute, queue.lease_seconds):
+            merged.append(out_path)
+    return merged
+
+
+def work(queue_root, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS,
+         poll_seconds=2.0, worker=None):
+    queue = WorkQueue(queue_root, lease_seconds, max_attempts)
+    processed = run_worker(queue, handle_unit, worker, poll_seconds)
+    merge_pending(queue)
+    return processed
+
+
+def run_local(queue_root, n_workers, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS,
+              poll_seconds=2.0):
+    # n_workers processes on this host against the same queue directory
+    import multiprocessing as mp
+
+    procs = [
+        mp.Process(target=work, args=(queue_root, lease_seconds, max_attempts, poll_seconds))
+        for _ in range(n_workers)
+    ]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+
+    return WorkQueue(queue_root, lease_seconds, max_attempts).status()
+
+
+if __name__ == "__main__":
+    # =========================
+    # CONFIG
+    # =========================
+    # Start this module on every host (or several times on one host). Each
+    # copy submits the same units (no-op once they exist) and then works the
+    # queue until every unit is done or failed.
+    QUEUE_ROOT = Path("shared/queue_transform_all")   # must be on the shared filesystem
+    STAGE = "warp"   # "slices" (generate_all_slices) | "warp" (transform_all)
+
+    LEASE = 120   # seconds; heartbeat every LEASE / 4
+    ATTEMPTS = 3
+    N_LOCAL_WORKERS = 0   # 0 → this process is one worker; N → spawn N here
+
+    # --- STAGE = "slices" ---
+    TRIMMED_DIR = Path("data/trimmed_csvs_200-400")
+    OUT_ROOT = Path("data/slices_from_trimmed")
+    NORM_MODE = "channel"
+    STORAGE = "dense"   # or "sparse" (see generate_all_slices)
+
+    # --- STAGE = "warp" ---
+    SLICES_ROOT = Path("data/slices_from_trimmed")
+    REGISTERED = Path("results_stable_clean/best.slices")
+    TRANSFORM_BUNDLE = Path("results_stable_clean/transforms.bundle")
+    OUTPUT_ROOT = Path("data/volumes_new")
+    REFERENCE_SLICE_NAME = "slice_078.png"
+    SLICES_PER_UNIT = None   # e.g. 20 → (channel, slice range) units
+    IMPUTE = "midpoint"   # bad slices: "copy" | "blend" | "midpoint"
+
+    queue = WorkQueue(QUEUE_ROOT, LEASE, ATTEMPTS)
+    if STAGE == "slices":
+        OUT_ROOT.mkdir(parents=True, exist_ok=True)
+        added = submit_slices(queue, TRIMMED_DIR, OUT_ROOT, NORM_MODE, storage=STORAGE)
+    else:
+        added = submit_warp(
+            queue, SLICES_ROOT, REGISTERED, OUTPUT_ROOT, REFERENCE_SLICE_NAME,
+            bundle_path=TRANSFORM_BUNDLE, slices_per_unit=SLICES_PER_UNIT, impute=IMPUTE,
+        )
+    print(f"Submitted {added} new units to {QUEUE_ROOT}")
+
+    if N_LOCAL_WORKERS:
+        print(run_local(QUEUE_ROOT, N_LOCAL_WORKERS, LEASE, ATTEMPTS))
+    else:
+        work(QUEUE_ROOT, LEASE, ATTEMPTS)
+        print(queue.status())
@@ -0,0 +1,314 @@
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from pathlib import Path
+
+# =========================
+# SHARED-FILESYSTEM WORK QUEUE
+# =========================
+# Layout under the queue root (any directory every worker can see):
+#
+#   queue.json            queue-wide metadata (e.g. normalization window)
+#   units/<id>.json       work unit definitions, written once by submit()
+#   leases/<id>.lease     claim held by one worker; mtime is its heartbeat
+#   attempts/<id>.json    number of failed / expired attempts so far
+#   done/<id>.json        completion marker (+ small result)
+#   failed/<id>.json      unit gave up after max_attempts
+#
+# Claims use O_CREAT | O_EXCL, so exactly one worker wins a free unit. A lease
+# whose mtime is older than lease_seconds is considered dead; it is first
+# renamed away (only one worker's rename succeeds; a lease found fresh after
+# the rename is restored) and then claimed again.
+# Lease expiry compares file mtimes with the local clock, so lease_seconds
+# must be well above the clock skew between hosts.
+LEASE_SECONDS = 120
+MAX_ATTEMPTS = 3
+POLL_SECONDS = 2.0
+
+
+def atomic_write_json(path, obj):
+    path = Path(path)
+    tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    with open(tmp, "w") as f:
+        json.dump(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def read_json(path, default=None):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return default
+
+
+def worker_name():
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+
+class LeaseLost(RuntimeError):
+    pass
+
+
+class WorkQueue:
+
+    def __init__(self, root, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+        self.root = Path(root)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+        for sub in ("units", "leases", "attempts", "done", "failed"):
+            (self.root / sub).mkdir(parents=True, exist_ok=True)
+
+    def _path(self, kind, unit_id):
+        suffix = ".lease" if kind == "leases" else ".json"
+        return self.root / kind / f"{unit_id}{suffix}"
+
+    # ---------------------------
+    # submit / inspect
+    # ---------------------------
+    @property
+    def meta(self):
+        return read_json(self.root / "queue.json", {})
+
+    def submit(self, units, meta=None):
+        # units: {unit_id: json-able payload}. Existing units are left alone,
+        # so every worker may call submit() with the same list on start-up.
+        if meta is not None and not (self.root / "queue.json").exists():
+            atomic_write_json(self.root / "queue.json", meta)
+
+        added = 0
+        for unit_id, payload in units.items():
+            path = self._path("units", unit_id)
+            if not path.exists():
+                atomic_write_json(path, payload)
+                added += 1
+        return added
+
+    def unit_ids(self):
+        return sorted(p.stem for p in (self.root / "units").glob("*.json"))
+
+    def payload(self, unit_id):
+        return read_json(self._path("units", unit_id))
+
+    def is_done(self, unit_id):
+        return self._path("done", unit_id).exists()
+
+    def is_failed(self, unit_id):
+        return self._path("failed", unit_id).exists()
+
+    def result(self, unit_id):
+        return read_json(self._path("done", unit_id))
+
+    def attempts(self, unit_id):
+        return read_json(self._path("attempts", unit_id), {"count": 0})["count"]
+
+    def status(self):
+        counts = {"pending": 0, "leased": 0, "done": 0, "failed": 0}
+        for unit_id in self.unit_ids():
+            if self.is_done(unit_id):
+                counts["done"] += 1
+            elif self.is_failed(unit_id):
+                counts["failed"] += 1
+            elif self._path("leases", unit_id).exists():
+                counts["leased"] += 1
+            else:
+                counts["pending"] += 1
+        return counts
+
+    def finished(self):
+        return all(self.is_done(u) or self.is_failed(u) for u in self.unit_ids())
+
+    # ---------------------------
+    # leases
+    # ---------------------------
+    def _lease_age(self, unit_id):
+        try:
+            return time.time() - self._path("leases", unit_id).stat().st_mtime
+        except FileNotFoundError:
+            return None
+
+    def _record_attempt(self, unit_id, error):
+        count = self.attempts(unit_id) + 1
+        atomic_write_json(self._path("attempts", unit_id), {"count": count, "error": error})
+        if count >= self.max_attempts:
+            atomic_write_json(self._path("failed", unit_id), {"attempts": count, "error": error})
+        return count
+
+    def _break_expired(self, unit_id):
+        # Only the worker whose rename succeeds counts the expired attempt.
+        # The age check and the rename are not atomic: another worker may have
+        # broken the lease and claimed a fresh one in between, so a renamed
+        # lease that turns out fresh is put back and nothing is recorded.
+        lease = self._path("leases", unit_id)
+        stale = lease.with_name(f".{lease.name}.{uuid.uuid4().hex}.stale")
+        try:
+            os.rename(lease, stale)
+        except FileNotFoundError:
+            return False
+        if time.time() - stale.stat().st_mtime <= self.lease_seconds:
+            try:
+                # link does not clobber a lease claimed meanwhile
+                os.link(stale, lease)
+            except FileExistsError:
+                pass
+            except OSError:
+                if not lease.exists():
+                    os.rename(stale, lease)
+            stale.unlink(missing_ok=True)
+            return False
+
+        holder = read_json(stale, {})
+        stale.unlink(missing_ok=True)
+        print(f"⚠️ Lease on {unit_id} expired (held by {holder.get('worker')})")
+        self._record_attempt(unit_id, "lease expired")
+        return True
+
+    def _try_lease(self, unit_id, worker):
+        if self.is_done(unit_id) or self.is_failed(unit_id):
+            return False
+
+        age = self._lease_age(unit_id)
+        if age is not None:
+            if age <= self.lease_seconds:
+                return False
+            if not self._break_expired(unit_id) or self.is_failed(unit_id):
+                return False
+
+        lease = self._path("leases", unit_id)
+        try:
+            fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            json.dump({"worker": worker, "host": socket.gethostname(),
+                       "pid": os.getpid(), "claimed": time.time()}, f)
+
+        # a finished unit may have been marked done between the check and the claim
+        if self.is_done(unit_id):
+            lease.unlink(missing_ok=True)
+            return False
+        return True
+
+    def claim(self, worker):
+        # Returns a Lease for the first free unit, or None
+        for unit_id in self.unit_ids():
+            if self._try_lease(unit_id, worker):
+                return Lease(self, unit_id, worker)
+        return None
+
+    def holder(self, unit_id):
+        return read_json(self._path("leases", unit_id), {}).get("worker")
+
+    def heartbeat(self, unit_id, worker):
+        # check and touch through one fd, so a lease broken and re-claimed in
+        # between is never refreshed on the new holder's behalf
+        lease = self._path("leases", unit_id)
+        try:
+            f = open(lease)
+        except FileNotFoundError:
+            raise LeaseLost(unit_id)
+        with f:
+            try:
+                holder = json.load(f).get("worker")
+            except json.JSONDecodeError:
+                holder = None
+            if holder != worker:
+                raise LeaseLost(unit_id)
+            os.utime(f.fileno())
+            # renamed away as expired meanwhile → only the stale copy was touched
+            try:
+                current = os.path.samestat(os.fstat(f.fileno()), lease.stat())
+            except FileNotFoundError:
+                current = False
+        if not current:
+            raise LeaseLost(unit_id)
+
+    def complete(self, unit_id, worker, result=None):
+        # done/ is written even if the lease was lost meanwhile: unit outputs
+        # are written idempotently, so a duplicate completion is harmless
+        atomic_write_json(self._path("done", unit_id), {
+            "worker": worker, "finished": time.time(), "result": result,
+        })
+        if self.holder(unit_id) == worker:
+            self._path("leases", unit_id).unlink(missing_ok=True)
+
+    def fail(self, unit_id, worker, error):
+        count = self._record_attempt(unit_id, str(error))
+        if self.holder(unit_id) == worker:
+            self._path("leases", unit_id).unlink(missing_ok=True)
+        return count
+
+
+class Lease:
+    # Context manager that heartbeats the lease from a background thread
+
+    def __init__(self, queue, unit_id, worker):
+        self.queue = queue
+        self.unit_id = unit_id
+        self.worker = worker
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def payload(self):
+        return self.queue.payload(self.unit_id)
+
+    def _beat(self):
+        interval = max(self.queue.lease_seconds / 4, 0.05)
+        while not self._stop.wait(interval):
+            try:
+                self.queue.heartbeat(self.unit_id, self.worker)
+            except (LeaseLost, FileNotFoundError):
+                self.lost = True
+                return
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._beat, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+# =========================
+# WORKER LOOP
+# =========================
+def run_worker(queue, handler, worker=None, poll_seconds=POLL_SECONDS, max_units=None):
+    # handler(unit_id, payload, meta) → json-able result. Runs until every unit
+    # is done or failed; waits while other workers still hold leases so that
+    # units whose holder dies are picked up again after expiry.
+    worker = worker or worker_name()
+    meta = queue.meta
+    processed = 0
+
+    while max_units is None or processed < max_units:
+        lease = queue.claim(worker)
+        if lease is None:
+            if queue.finished():
+                break
+            time.sleep(poll_seconds)
+            continue
+
+        with lease:
+            try:
+                result = handler(lease.unit_id, lease.payload, meta)
+            except Exception as e:
+                count = queue.fail(lease.unit_id, worker, repr(e))
+                print(f"❌ {worker}: {lease.unit_id} failed ({count}/{queue.max_attempts}): {e!r}")
+                continue
+
+        if lease.lost:
+            print(f"⚠️ {worker}: lease on {lease.unit_id} was lost, recording result anyway")
+        queue.complete(lease.unit_id, worker, result)
+        processed += 1
+
+    return processed
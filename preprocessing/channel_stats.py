@@ -0,0 +1,265 @@
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from preprocessing.csv_reader import CHUNK_SIZE, iter_csv, read_header
+
+# =========================
+# PER-CHANNEL SUMMARY STATISTICS
+# =========================
+# One chunked pass over a wide CSV (every m/z column at once) or over a folder
+# of registered volumes. Chunks are reduced in a thread pool (numpy releases
+# the GIL) into mergeable partial sums, giving two small tables:
+#
+#   summary   one row per m/z: n, total, tic_fraction, mean, max, nonzero
+#   profile   slices × m/z mean intensity (tissue_id for CSVs, z for volumes)
+#
+# Results are cached as CSVs keyed by a content hash of the input file(s)
+# plus the channel list, so a second call on unchanged data is free.
+HASH_BLOCK = 8 << 20
+CACHE_DIR_NAME = ".channel_stats"
+VOLUME_EXTS = (".nii", ".nii.gz")
+
+
+def file_hash(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class ChannelStats:
+    # Mergeable partial reductions for a fixed list of channels
+
+    def __init__(self, channels):
+        self.channels = list(channels)
+        c = len(self.channels)
+        self.n = 0
+        self.total = np.zeros(c, dtype=np.float64)
+        self.max = np.full(c, -np.inf, dtype=np.float64)
+        self.nonzero = np.zeros(c, dtype=np.int64)
+        self.slice_sum = {}
+        self.slice_n = {}
+
+    def update(self, slice_ids, values):
+        # slice_ids: (n,) ints, values: (n, channels)
+        values = np.asarray(values, dtype=np.float32)
+        if not len(values):
+            return self
+
+        self.n += len(values)
+        self.total += values.sum(axis=0, dtype=np.float64)
+        np.maximum(self.max, values.max(axis=0), out=self.max)
+        self.nonzero += np.count_nonzero(values, axis=0)
+
+        # per-slice sums via one sort + reduceat (rows are mostly grouped)
+        order = np.argsort(slice_ids, kind="stable")
+        ids = np.asarray(slice_ids)[order]
+        starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+        sums = np.add.reduceat(values[order], starts, axis=0, dtype=np.float64)
+        counts = np.diff(np.r_[starts, len(ids)])
+
+        for sid, s, cnt in zip(ids[starts].tolist(), sums, counts.tolist()):
+            if sid in self.slice_sum:
+                self.slice_sum[sid] += s
+                self.slice_n[sid] += cnt
+            else:
+                self.slice_sum[sid] = s
+                self.slice_n[sid] = cnt
+        return self
+
+    def merge(self, other):
+        self.n += other.n
+        self.total += other.total
+        np.maximum(self.max, other.max, out=self.max)
+        self.nonzero += other.nonzero
+        for sid, s in other.slice_sum.items():
+            if sid in self.slice_sum:
+                self.slice_sum[sid] += s
+                self.slice_n[sid] += other.slice_n[sid]
+            else:
+                self.slice_sum[sid] = s.copy()
+                self.slice_n[sid] = other.slice_n[sid]
+        return self
+
+    def summary(self):
+        n = max(self.n, 1)
+        tic = self.total.sum()
+        return pd.DataFrame({
+            "mz": self.channels,
+            "n": self.n,
+            "total": self.total,
+            "tic_fraction": self.total / tic if tic > 0 else 0.0,
+            "mean": self.total / n,
+            "max": np.where(np.isfinite(self.max), self.max, 0.0),
+            "nonzero": self.nonzero / n,
+        })
+
+    def profile(self):
+        sids = sorted(self.slice_sum)
+        means = [self.slice_sum[sid] / self.slice_n[sid] for sid in sids]
+        profile = pd.DataFrame(np.array(means).reshape(len(sids), -1), columns=self.channels)
+        profile.insert(0, "slice", sids)
+        return profile
+
+
+# =========================
+# PARALLEL CHUNK REDUCTION
+# =========================
+def reduce_chunks(chunks, channels, workers=None):
+    # chunks: iterable of (slice_ids, values). At most 2 × workers chunks are
+    # held in memory while the reader runs ahead.
+    workers = workers or os.cpu_count() or 1
+
+    def reduce_one(chunk):
+        return ChannelStats(channels).update(*chunk)
+
+    stats = ChannelStats(channels)
+    pending = deque()
+    with ThreadPoolExecutor(workers) as pool:
+        for chunk in chunks:
+            pending.append(pool.submit(reduce_one, chunk))
+            if len(pending) >= 2 * workers:
+                stats.merge(pending.popleft().result())
+        while pending:
+            stats.merge(pending.popleft().result())
+    return stats
+
+
+def csv_chunks(csv_path, mz_cols, chunk_size=CHUNK_SIZE):
+    for chunk in iter_csv(csv_path, ["tissue_id"] + list(mz_cols), chunk_size):
+        yield chunk["tissue_id"].to_numpy(), chunk[mz_cols].to_numpy(dtype=np.float32)
+
+
+def volume_files(volume_dir):
+    # m/z → path of every <mz>.nii / <mz>.nii.gz in a folder (transform_all
+    # output), sorted by name; .nii wins if both exist, as append_slices
+    # grows that one
+    files = {}
+    for ext in VOLUME_EXTS:
+        for p in Path(volume_dir).glob(f"*{ext}"):
+            files.setdefault(p.name[:-len(ext)], p)
+    return dict(sorted(files.items()))
+
+
+def volume_chunks(path, slab=8):
+    # rows are voxels of a z-slab, slice id is z
+    import SimpleITK as sitk
+
+    vol = sitk.GetArrayFromImage(sitk.ReadImage(str(path))).astype(np.float32)
+    for z0 in range(0, vol.shape[0], slab):
+        block = vol[z0:z0 + slab]
+        z = np.repeat(np.arange(z0, z0 + len(block)), block[0].size)
+        yield z, block.reshape(-1, 1)
+
+
+def stack_channels(parts):
+    # single-channel stats over the same voxels → one multi-channel table
+    stats = ChannelStats([c for part in parts for c in part.channels])
+    if not parts:
+        return stats
+
+    stats.n = parts[0].n
+    stats.total = np.concatenate([p.total for p in parts])
+    stats.max = np.concatenate([p.max for p in parts])
+    stats.nonzero = np.concatenate([p.nonzero for p in parts])
+    for sid in parts[0].slice_sum:
+        stats.slice_sum[sid] = np.concatenate([p.slice_sum[sid] for p in parts])
+        stats.slice_n[sid] = parts[0].slice_n[sid]
+    return stats
+
+
+# =========================
+# CACHE
+# =========================
+def _cache_key(hashes, channels, kind):
+    h = hashlib.blake2b(digest_size=12)
+    h.update(json.dumps([kind, list(hashes), list(channels)]).encode())
+    return h.hexdigest()
+
+
+def _cached(cache_dir, key, compute):
+    summary_path = Path(cache_dir) / f"{key}.summary.csv"
+    profile_path = Path(cache_dir) / f"{key}.profile.csv"
+    if summary_path.exists() and profile_path.exists():
+        return (pd.read_csv(summary_path, dtype={"mz": str}),
+                pd.read_csv(profile_path))
+
+    stats = compute()
+    summary, profile = stats.summary(), stats.profile()
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    summary.to_csv(summary_path, index=False)
+    profile.to_csv(profile_path, index=False)
+    return summary, profile
+
+
+# =========================
+# ENTRY POINTS
+# =========================
+def csv_channel_stats(csv_path, mz_cols=None, chunk_size=CHUNK_SIZE, workers=None,
+                      cache_dir=None, use_cache=True):
+    # Stats for every m/z column of a (wide or trimmed) CSV in one pass
+    csv_path = Path(csv_path)
+    if mz_cols is None:
+        mz_cols = [c for c in read_header(csv_path) if c.startswith("m.z.")]
+    mz_cols = list(mz_cols)
+
+    def compute():
+        return reduce_chunks(csv_chunks(csv_path, mz_cols, chunk_size), mz_cols, workers)
+
+    if not use_cache:
+        stats = compute()
+        return stats.summary(), stats.profile()
+
+    cache_dir = cache_dir or csv_path.parent / CACHE_DIR_NAME
+    key = _cache_key([file_hash(csv_path)], mz_cols, "csv")
+    return _cached(cache_dir, key, compute)
+
+
+def volume_channel_stats(volume_dir, workers=None, cache_dir=None, use_cache=True):
+    # Stats for every <mz>.nii / .nii.gz in a folder (e.g. transform_all output)
+    files = volume_files(volume_dir)
+    channels, volume_paths = list(files), list(files.values())
+
+    def compute():
+        return stack_channels([
+            reduce_chunks(volume_chunks(path), [mz], workers)
+            for path, mz in zip(volume_paths, channels)
+        ])
+
+    if not use_cache:
+        stats = compute()
+        return stats.summary(), stats.profile()
+
+    cache_dir = cache_dir or Path(volume_dir) / CACHE_DIR_NAME
+    key = _cache_key([file_hash(p) for p in volume_paths], channels, "volume")
+    return _cached(cache_dir, key, compute)
+
+
+def rank_channels(summary, by="tic_fraction", top=None, min_nonzero=0.0, min_max=0.0):
+    # m/z names ranked by `by` after dropping sparse / empty channels
+    keep = summary[(summary["nonzero"] >= min_nonzero) & (summary["max"] > min_max)]
+    ranked = keep.sort_values(by, ascending=False)["mz"].tolist()
+    return ranked if top is None else ranked[:top]
+
+
+if __name__ == "__main__":
+    # =========================
+    # CONFIG
+    # =========================
+    INPUT = "data/Cochlea_3D_TIC.csv"   # wide CSV, trimmed CSV ...
+    VOLUME_DIR = None   # ... or a folder of registered volumes
+
+    if VOLUME_DIR is not None:
+        summary, profile = volume_channel_stats(VOLUME_DIR)
+    else:
+        summary, profile = csv_channel_stats(INPUT)
+
+    print(summary.sort_values("tic_fraction", ascending=False).head(20).to_string(index=False))
+    print(f"\n{len(summary)} channels, {len(profile)} slices")
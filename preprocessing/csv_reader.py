@@ -0,0 +1,98 @@
+import csv
+import numpy as np
+import pandas as pd
+
+# =========================
+# COMPACT CSV READER
+# =========================
+# All CSV stages read through here. Columns get explicit dtypes instead of
+# pandas' inferred int64/float64:
+#
+#   x, y        int32
+#   tissue_id   int16
+#   m.z.*       float32
+#
+# pyarrow's multithreaded parser is used when installed; otherwise the pandas
+# C parser with the same dtypes. Both support column projection and
+# streaming in chunks of roughly chunk_size rows.
+CHUNK_SIZE = 1_000_000
+COORD_DTYPES = {"x": np.int32, "y": np.int32, "tissue_id": np.int16}
+VALUE_DTYPE = np.float32
+SAMPLE_BYTES = 1 << 20
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None
+
+
+def read_header(path):
+    with open(path, newline="") as f:
+        return next(csv.reader(f))
+
+
+def column_dtypes(columns):
+    return {c: COORD_DTYPES.get(c, VALUE_DTYPE) for c in columns}
+
+
+def _bytes_per_row(path):
+    # rough row width from the first MiB, used to size Arrow blocks
+    with open(path, "rb") as f:
+        f.readline()
+        sample = f.read(SAMPLE_BYTES)
+    rows = sample.count(b"\n")
+    return max(len(sample) // max(rows, 1), 1)
+
+
+def _arrow_options(path, columns, block_size=None):
+    header = read_header(path)
+    columns = header if columns is None else list(columns)
+    missing = [c for c in columns if c not in header]
+    if missing:
+        raise ValueError(f"Columns not in {path}: {missing}")
+
+    read_options = pa_csv.ReadOptions(use_threads=True)
+    if block_size is not None:
+        read_options.block_size = block_size
+    convert_options = pa_csv.ConvertOptions(
+        include_columns=columns,
+        column_types={c: pa.from_numpy_dtype(d) for c, d in column_dtypes(columns).items()},
+    )
+    return read_options, convert_options, columns
+
+
+def _to_frame(table_or_batch, columns):
+    df = table_or_batch.to_pandas()
+    return df[columns]
+
+
+# =========================
+# READ
+# =========================
+def read_csv(path, columns=None):
+    # Whole file (or the projected columns) as one compact DataFrame
+    if pa is None:
+        usecols = read_header(path) if columns is None else list(columns)
+        return pd.read_csv(path, usecols=usecols, dtype=column_dtypes(usecols))[usecols]
+
+    read_options, convert_options, columns = _arrow_options(path, columns)
+    table = pa_csv.read_csv(path, read_options=read_options, convert_options=convert_options)
+    return _to_frame(table, columns)
+
+
+def iter_csv(path, columns=None, chunk_size=CHUNK_SIZE):
+    # Streams DataFrames of about chunk_size rows; memory stays at one chunk
+    if pa is None:
+        usecols = read_header(path) if columns is None else list(columns)
+        for chunk in pd.read_csv(path, usecols=usecols, dtype=column_dtypes(usecols),
+                                 chunksize=chunk_size):
+            yield chunk[usecols]
+        return
+
+    block_size = int(min(max(_bytes_per_row(path) * chunk_size, 1 << 16), 1 << 30))
+    read_options, convert_options, columns = _arrow_options(path, columns, block_size)
+    reader = pa_csv.open_csv(path, read_options=read_options, convert_options=convert_options)
+    for batch in reader:
+        if batch.num_rows:
+            yield _to_frame(batch, columns)
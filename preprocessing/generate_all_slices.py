@@ -1,79 +1,184 @@
-import os
 import numpy as np
-import pandas as pd
-import imageio.v2 as imageio
 from pathlib import Path
 
+from preprocessing.csv_reader import CHUNK_SIZE, iter_csv, read_csv, read_header
+from preprocessing.normalization import (
+    NORM_MODES,
+    StreamingHistogram,
+    apply_window,
+    histogram_window,
+    slice_window,
+)
+from preprocessing.slice_store import STORE_SUFFIX, export_png
+from preprocessing.sparse_slices import SPARSE_SUFFIX, SparseChannel, TissueGrid
+
+PERCENTILES = (10, 90)
+HIST_BINS = 4096
+STORAGES = ("dense", "sparse")
+
+
 # =========================
-# CONFIG
+# HELPERS
 # =========================
-TRIMMED_DIR = Path("data/trimmed_csvs_200-400")   # folder with trimmed CSVs
-OUT_ROOT = Path("data/slices_from_trimmed")   # output root
-OUT_ROOT.mkdir(exist_ok=True)
+def find_mz_col(csv_path):
+    cols = read_header(csv_path)
+    mz_cols = [c for c in cols if c.startswith("m.z.")]
+    if len(mz_cols) != 1:
+        return None
+    return mz_cols[0]
+
+def log_histogram(csv_path, mz_col, hist, chunk_size=CHUNK_SIZE):
+    # streams the intensity column only; does not materialise the CSV
+    for chunk in iter_csv(csv_path, [mz_col], chunk_size):
+        hist.update(np.log1p(chunk[mz_col].to_numpy(dtype=np.float64)))
+    return hist
+
+def frame_window(df, mz_col, percentiles=PERCENTILES, hist_bins=HIST_BINS):
+    hist = StreamingHistogram(hist_bins)
+    hist.update(np.log1p(df[mz_col].to_numpy(dtype=np.float64)))
+    return histogram_window(hist, percentiles)
+
+def global_window(csv_paths, percentiles=PERCENTILES, hist_bins=HIST_BINS, chunk_size=CHUNK_SIZE):
+    hist = StreamingHistogram(hist_bins)
+    for csv_path in csv_paths:
+        mz_col = find_mz_col(csv_path)
+        if mz_col is not None:
+            log_histogram(csv_path, mz_col, hist, chunk_size)
+    return histogram_window(hist, percentiles)
+
 
 # =========================
-# PROCESS EACH TRIMMED CSV
+# ONE CHANNEL → SLICES
 # =========================
-csv_files = sorted(TRIMMED_DIR.glob("Cochlea_3D_m.z.*.csv"))
-print(f"Found {len(csv_files)} trimmed CSVs")
+def channel_slices(df, mz_col, norm_mode="channel", window=None,
+                   percentiles=PERCENTILES, hist_bins=HIST_BINS, grid=None):
+    # Returns a SparseChannel of [0, 1] float32 values (one per acquired
+    # pixel; read() densifies a slice), or None if the channel has no signal.
+    # "global" mode needs the shared window. Pass the grid of a previous
+    # channel to reuse it when the coordinates match.
+    if norm_mode not in NORM_MODES:
+        raise ValueError(f"norm_mode must be one of {NORM_MODES}")
+    if norm_mode == "global" and window is None:
+        raise ValueError("norm_mode='global' needs a precomputed window")
+
+    if norm_mode == "channel" and window is None:
+        window = frame_window(df, mz_col, percentiles, hist_bins)
+        if window is None:
+            return None
+
+    if grid is None or not grid.matches(df):
+        grid = TissueGrid.from_frame(df)
+
+    log_values = np.log1p(grid.gather(df[mz_col].to_numpy()))
+    values = np.zeros_like(log_values)
+
+    names = []
+    for name in grid.names:
+        a, b = grid.span(name)
+        log_slice = log_values[a:b]
+        if not np.any(log_slice > 0):
+            continue
 
-for csv_path in csv_files:
-    print(f"\n Processing {csv_path.name}")
+        slice_win = window if norm_mode != "slice" else slice_window(log_slice, percentiles)
+        apply_window(log_slice, slice_win, out=values[a:b])
+        names.append(name)
 
-    # --- infer m/z column ---
-    cols = pd.read_csv(csv_path, nrows=0).columns
-    mz_cols = [c for c in cols if c.startswith("m.z.")]
-    if len(mz_cols) != 1:
-        print("  Skipping (could not uniquely identify m/z column)")
-        continue
+    return SparseChannel(grid, values, names)
 
-    mz_col = mz_cols[0]
-    mz_val = mz_col.replace("m.z.", "")
+def save_channel(slices, out_root, mz_val, export=False, storage="dense"):
+    # storage: "dense" → <mz>.slices float store, "sparse" → <mz>.sparse
+    # (tissue pixels only, grid shared under out_root/grids)
+    if storage not in STORAGES:
+        raise ValueError(f"storage must be one of {STORAGES}")
 
-    gray_dir = OUT_ROOT / f"{mz_val}_gray"
-    gray_dir.mkdir(exist_ok=True)
+    out_root = Path(out_root)
+    if storage == "sparse":
+        store_path = slices.save_sparse(out_root / f"{mz_val}{SPARSE_SUFFIX}")
+    else:
+        store_path = slices.save(out_root / f"{mz_val}{STORE_SUFFIX}")
 
-    # --- load CSV ---
-    df = pd.read_csv(csv_path)
-    slice_ids = sorted(df["tissue_id"].unique())
-    print(f"  → {len(slice_ids)} slices")
+    if export:
+        gray_dir = out_root / f"{mz_val}_gray"
+        gray_dir.mkdir(exist_ok=True)
+        for name in slices.names:
+            export_png(slices.read(name), gray_dir / f"{name}.png")
 
-    # =========================
-    # PROCESS EACH SLICE
-    # =========================
-    for sid in slice_ids:
-        slice_df = df[df["tissue_id"] == sid]
-        if slice_df.empty:
-            continue
+    return store_path
 
-        xs = np.sort(slice_df["x"].unique())
-        ys = np.sort(slice_df["y"].unique())
 
-        x_to_col = {x: i for i, x in enumerate(xs)}
-        y_to_row = {y: i for i, y in enumerate(ys)}
+# =========================
+# PROCESS EACH TRIMMED CSV
+# =========================
+def generate_all_slices(trimmed_dir, out_root, norm_mode="channel", percentiles=PERCENTILES,
+                        hist_bins=HIST_BINS, chunk_size=CHUNK_SIZE, export=False,
+                        storage="dense"):
+    trimmed_dir, out_root = Path(trimmed_dir), Path(out_root)
+    out_root.mkdir(exist_ok=True, parents=True)
+
+    csv_files = sorted(trimmed_dir.glob("Cochlea_3D_m.z.*.csv"))
+    print(f"Found {len(csv_files)} trimmed CSVs")
+    print(f"Normalization mode: {norm_mode}")
+
+    window = None
+    if norm_mode == "global":
+        window = global_window(csv_files, percentiles, hist_bins, chunk_size)
+        if window is None:
+            raise RuntimeError("No non-zero intensities found in any CSV")
+        print(f"Global window (log1p): {window[0]:.4f} – {window[1]:.4f}")
+
+    stores = {}
+    grid = None
+    for csv_path in csv_files:
+        print(f"\n Processing {csv_path.name}")
+
+        # --- infer m/z column ---
+        mz_col = find_mz_col(csv_path)
+        if mz_col is None:
+            print("  Skipping (could not uniquely identify m/z column)")
+            continue
 
-        img = np.zeros((len(ys), len(xs)), dtype=np.float32)
+        mz_val = mz_col.replace("m.z.", "")
 
-        for _, row in slice_df.iterrows():
-            img[y_to_row[row["y"]], x_to_col[row["x"]]] = row[mz_col]
+        # --- load CSV ---
+        df = read_csv(csv_path)
+        print(f"  → {df['tissue_id'].nunique()} slices")
 
-        # =========================
-        # REGISTRATION IMAGE
-        # =========================
-        log_img = np.log1p(img)
-        nz = log_img[log_img > 0]
-        if nz.size == 0:
+        slices = channel_slices(df, mz_col, norm_mode, window, percentiles, hist_bins, grid)
+        if slices is None:
+            print("  Skipping (no non-zero intensities)")
             continue
+        grid = slices.grid
+
+        stores[mz_val] = save_channel(slices, out_root, mz_val, export, storage)
+        print(f" Finished m/z {mz_val}")
+
+    return stores
+
+
+if __name__ == "__main__":
+    # =========================
+    # CONFIG
+    # =========================
+    TRIMMED_DIR = Path("data/trimmed_csvs_200-400")   # folder with trimmed CSVs
+    OUT_ROOT = Path("data/slices_from_trimmed")   # output root
+
+    # "slice"   → contrast window per slice (legacy, not comparable along Z)
+    # "channel" → one window per m/z from all of its slices
+    # "global"  → one window shared by every m/z in TRIMMED_DIR
+    NORM_MODE = "channel"
 
-        vmin, vmax = np.percentile(nz, [10, 90])
-        reg_norm = np.clip((log_img - vmin) / (vmax - vmin), 0, 1)
-        reg_uint8 = (reg_norm * 255).astype(np.uint8)
+    # Slices are stored as float32 in OUT_ROOT/<mz>.slices (memory-mapped by the
+    # registration stages). 8-bit PNGs in OUT_ROOT/<mz>_gray are export-only.
+    EXPORT_PNG = False
 
-        imageio.imwrite(
-            gray_dir / f"slice_{sid:03d}.png",
-            reg_uint8
-        )
+    # "dense"  → OUT_ROOT/<mz>.slices, one full raster per slice
+    # "sparse" → OUT_ROOT/<mz>.sparse, acquired tissue pixels only; the pixel
+    #            coordinates are stored once in OUT_ROOT/grids and shared by
+    #            every m/z. All later stages read either.
+    STORAGE = "dense"
 
-    print(f" Finished m/z {mz_val}")
+    generate_all_slices(
+        TRIMMED_DIR, OUT_ROOT, NORM_MODE, PERCENTILES, HIST_BINS, CHUNK_SIZE, EXPORT_PNG, STORAGE
+    )
 
-print("\n All slices generated from trimmed CSVs")
+    print("\n All slices generated from trimmed CSVs")
@@ -0,0 +1,45 @@
+import os
+
+from preprocessing.csv_reader import read_csv
+from preprocessing.generate_all_slices import channel_slices
+from preprocessing.slice_store import export_png
+
+
+# =========================
+# ONE m/z → GRAYSCALE PNGs
+# =========================
+def generate_one_slice(csv_path, mz_col, gray_dir, norm_mode="slice"):
+    # Debug helper: one channel with per-slice percentile clipping
+    # (stable contrast) written straight to registration-ready PNGs
+    os.makedirs(gray_dir, exist_ok=True)
+
+    print("Loading CSV...")
+    df = read_csv(csv_path)
+    print("Number of slices:", df["tissue_id"].nunique())
+
+    slices = channel_slices(df, mz_col, norm_mode=norm_mode)
+    if slices is None:
+        return []
+
+    paths = []
+    for name in slices.names:
+        print(f"Processing {name}")
+        path = os.path.join(gray_dir, f"{name}.png")
+        export_png(slices.read(name), path)
+        paths.append(path)
+
+    return paths
+
+
+if __name__ == "__main__":
+    # =========================
+    # CONFIG
+    # =========================
+    CSV_PATH = "data/trimmed_csv/Cochlea_3D_mz309.281.csv"
+    MZ_COL = "m.z.309.281"
+
+    GRAY_DIR = "data/slices/309.281_gray"
+
+    generate_one_slice(CSV_PATH, MZ_COL, GRAY_DIR)
+
+    print("All slices saved with registration-ready preprocessing.")
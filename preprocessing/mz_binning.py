@@ -0,0 +1,172 @@
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+from preprocessing.channel_stats import (
+    CACHE_DIR_NAME,
+    _cache_key,
+    _cached,
+    csv_chunks,
+    file_hash,
+    reduce_chunks,
+)
+from preprocessing.csv_reader import CHUNK_SIZE, read_header
+
+# =========================
+# m/z BINNING + PEAK SELECTION
+# =========================
+# Neighbouring m/z columns closer than a ppm / Da tolerance are one peak that
+# got split across bins. They are merged into one channel: the per-pixel sum
+# of the members, named after the most intense member so names keep the
+# usual "m.z.<value>" form. Merged channels whose signal (TIC share, max) or
+# coverage (non-zero pixel fraction) is under the thresholds are dropped.
+#
+# One streaming pass over the CSV collects the statistics for every raw
+# column and every bin at once (bin sums are appended to each chunk). They
+# are cached next to the input like channel_stats. The result is the reduced
+# channel list plus a provenance table with one row per raw column:
+#
+#   mz, bin, bin_mz (intensity-weighted centroid), kept, reason, bin stats
+#
+# trim_csv / read_channels take the bin → members mapping and write the
+# summed columns.
+BIN_PPM = 10.0
+BIN_DA = None
+PROVENANCE_NAME = "mz_bins.csv"
+
+
+def mz_value(col):
+    return float(col[len("m.z."):])
+
+
+def bin_columns(mz_cols, ppm=BIN_PPM, da=BIN_DA):
+    # lists of adjacent columns (sorted by m/z); a bin spans at most the
+    # tolerance from its lowest member, so chains of close peaks are split
+    cols = sorted(mz_cols, key=mz_value)
+    bins = []
+    for col in cols:
+        mz = mz_value(col)
+        if bins:
+            first = mz_value(bins[-1][0])
+            tol = max(da or 0.0, first * (ppm or 0.0) * 1e-6)
+            if mz - first <= tol:
+                bins[-1].append(col)
+                continue
+        bins.append([col])
+    return bins
+
+
+# =========================
+# ONE-PASS STATISTICS
+# =========================
+def _bin_chunks(chunks, starts):
+    # raw columns followed by one summed column per bin
+    for slice_ids, values in chunks:
+        yield slice_ids, np.hstack([values, np.add.reduceat(values, starts, axis=1)])
+
+
+def binned_stats(csv_path, bins, chunk_size=CHUNK_SIZE, workers=None, cache_dir=None,
+                 use_cache=True):
+    # summary rows: every raw column, then "bin:<i>" for each bin
+    csv_path = Path(csv_path)
+    cols = [c for members in bins for c in members]
+    starts = np.cumsum([0] + [len(members) for members in bins[:-1]])
+    channels = cols + [f"bin:{i}" for i in range(len(bins))]
+
+    def compute():
+        chunks = _bin_chunks(csv_chunks(csv_path, cols, chunk_size), starts)
+        return reduce_chunks(chunks, channels, workers)
+
+    if not use_cache:
+        summary = compute().summary()
+    else:
+        cache_dir = cache_dir or csv_path.parent / CACHE_DIR_NAME
+        key = _cache_key([file_hash(csv_path)], [list(b) for b in bins], "bins")
+        summary, _ = _cached(cache_dir, key, compute)
+
+    # ChannelStats' TIC sums every column, i.e. the raw columns twice;
+    # fractions are against the raw columns only
+    tic = summary["total"].iloc[:len(cols)].sum()
+    summary["tic_fraction"] = summary["total"] / tic if tic > 0 else 0.0
+    return summary
+
+
+# =========================
+# REDUCED CHANNEL LIST
+# =========================
+def reduce_channels(csv_path, mz_cols=None, ppm=BIN_PPM, da=BIN_DA, min_tic_fraction=0.0,
+                    min_max=0.0, min_nonzero=0.0, chunk_size=CHUNK_SIZE, workers=None,
+                    cache_dir=None, use_cache=True):
+    # Returns (bins, provenance): bins maps each kept output column to its
+    # member columns, in m/z order
+    if mz_cols is None:
+        mz_cols = [c for c in read_header(csv_path) if c.startswith("m.z.")]
+    groups = bin_columns(mz_cols, ppm, da)
+
+    summary = binned_stats(csv_path, groups, chunk_size, workers, cache_dir, use_cache)
+    summary = summary.set_index("mz")
+    raw_total = summary["total"]
+
+    bins = {}
+    rows = []
+    for i, members in enumerate(groups):
+        stats = summary.loc[f"bin:{i}"]
+        totals = raw_total[members].to_numpy()
+        name = members[int(np.argmax(totals))]
+        mzs = np.array([mz_value(c) for c in members])
+        centroid = float((mzs * totals).sum() / totals.sum()) if totals.sum() > 0 else float(mzs.mean())
+
+        if stats["tic_fraction"] < min_tic_fraction or stats["max"] <= min_max:
+            reason = "signal"
+        elif stats["nonzero"] < min_nonzero:
+            reason = "coverage"
+        else:
+            reason = "kept"
+            bins[name] = members
+
+        for col in members:
+            rows.append({
+                "mz": col, "bin": name, "bin_mz": round(centroid, 6), "members": len(members),
+                "kept": reason == "kept", "reason": reason,
+                "total": raw_total[col], "bin_tic_fraction": stats["tic_fraction"],
+                "bin_max": stats["max"], "bin_nonzero": stats["nonzero"],
+            })
+
+    provenance = pd.DataFrame(rows)
+    print(f"m/z binning: {len(mz_cols)} columns → {len(groups)} bins → {len(bins)} kept "
+          f"({(provenance.drop_duplicates('bin')['reason'] != 'kept').sum()} dropped)")
+    return bins, provenance
+
+
+def save_provenance(provenance, out_dir):
+    path = Path(out_dir) / PROVENANCE_NAME
+    path.parent.mkdir(parents=True, exist_ok=True)
+    provenance.to_csv(path, index=False)
+    return path
+
+
+def load_bins(path):
+    # provenance CSV → {output column: member columns} of the kept bins
+    provenance = pd.read_csv(path, dtype={"mz": str, "bin": str})
+    kept = provenance[provenance["kept"]]
+    return {name: group["mz"].tolist() for name, group in kept.groupby("bin", sort=False)}
+
+
+def bin_of(col, bins):
+    # output column that contains col (None if it was dropped)
+    for name, members in bins.items():
+        if col in members:
+            return name
+    return None
+
+
+if __name__ == "__main__":
+    # =========================
+    # CONFIG
+    # =========================
+    INPUT = "data/Cochlea_3D_TIC.csv"
+    OUT_DIR = Path("data/trimmed_csvs_binned")
+
+    bins, provenance = reduce_channels(INPUT, ppm=BIN_PPM, da=BIN_DA,
+                                       min_tic_fraction=1e-4, min_nonzero=0.01)
+    print(f"Provenance: {save_provenance(provenance, OUT_DIR)}")
@@ -0,0 +1,116 @@
+import numpy as np
+
+# =========================
+# STREAMING HISTOGRAM
+# =========================
+# Approximate quantiles over non-negative values (log1p intensities) in one
+# pass. The range [0, hi) is split into n_bins equal bins; when a value
+# beyond hi arrives, neighbouring bins are merged pairwise and hi doubles,
+# so memory stays fixed and the quantile error is bounded by hi / n_bins.
+# hi is always a power of two, so histograms from different chunks or
+# workers share the same bin edges and merge exactly.
+class StreamingHistogram:
+
+    def __init__(self, n_bins=4096, hi=None):
+        if n_bins % 2:
+            raise ValueError("n_bins must be even")
+        self.n_bins = n_bins
+        self.hi = hi
+        self.counts = np.zeros(n_bins, dtype=np.int64)
+        self.total = 0
+
+    def _grow(self):
+        merged = self.counts.reshape(-1, 2).sum(axis=1)
+        self.counts = np.concatenate([merged, np.zeros_like(merged)])
+        self.hi *= 2.0
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[values > 0]
+        if values.size == 0:
+            return
+
+        vmax = values.max()
+        if self.hi is None:
+            self.hi = float(2.0 ** np.floor(np.log2(vmax) + 1))
+        while vmax >= self.hi:
+            self._grow()
+
+        idx = (values * (self.n_bins / self.hi)).astype(np.int64)
+        np.minimum(idx, self.n_bins - 1, out=idx)
+        self.counts += np.bincount(idx, minlength=self.n_bins)
+        self.total += values.size
+
+    def merge(self, other):
+        if other.total == 0:
+            return
+        if self.total == 0:
+            self.hi = other.hi
+            self.counts = other.counts.copy()
+            self.total = other.total
+            return
+        if other.n_bins != self.n_bins:
+            raise ValueError("Cannot merge histograms with different bin counts")
+
+        other_counts, other_hi = other.counts.copy(), other.hi
+        while self.hi < other_hi:
+            self._grow()
+        while other_hi < self.hi:
+            merged = other_counts.reshape(-1, 2).sum(axis=1)
+            other_counts = np.concatenate([merged, np.zeros_like(merged)])
+            other_hi *= 2.0
+        self.counts += other_counts
+        self.total += other.total
+
+    @property
+    def resolution(self):
+        return 0.0 if self.hi is None else self.hi / self.n_bins
+
+    def quantiles(self, percentiles):
+        # Same convention as np.percentile: percentiles in [0, 100]
+        if self.total == 0:
+            raise ValueError("Histogram is empty")
+
+        q = np.asarray(percentiles, dtype=np.float64) / 100.0
+        cdf = np.cumsum(self.counts)
+        target = q * self.total
+        b = np.searchsorted(cdf, target, side="left")
+        b = np.minimum(b, self.n_bins - 1)
+
+        # linear interpolation inside the selected bin
+        below = np.where(b > 0, cdf[b - 1], 0)
+        in_bin = np.maximum(self.counts[b], 1)
+        frac = np.clip((target - below) / in_bin, 0.0, 1.0)
+        width = self.hi / self.n_bins
+        return (b + frac) * width
+
+
+# =========================
+# CONTRAST WINDOW
+# =========================
+NORM_MODES = ("slice", "channel", "global")
+
+
+def slice_window(log_img, percentiles=(10, 90)):
+    # Legacy behaviour: exact percentiles of one slice's non-zero pixels
+    nz = log_img[log_img > 0]
+    if nz.size == 0:
+        return None
+    vmin, vmax = np.percentile(nz, percentiles)
+    return float(vmin), float(vmax)
+
+
+def histogram_window(hist, percentiles=(10, 90)):
+    if hist.total == 0:
+        return None
+    vmin, vmax = hist.quantiles(percentiles)
+    return float(vmin), float(vmax)
+
+
+def apply_window(log_img, window, out=None):
+    vmin, vmax = window
+    scale = 1.0 / max(vmax - vmin, 1e-12)
+    out = np.subtract(log_img, vmin, out=out, dtype=np.float32)
+    out *= scale
+    np.clip(out, 0, 1, out=out)
+    return out
@@ -0,0 +1,90 @@
+import queue
+import threading
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# =========================
+# PREFETCHING READS / ASYNC WRITES
+# =========================
+# Compute loops walk their slices in a known order, so the next `depth` reads
+# (PNG / TIFF decode, memmap page-in on network storage, sparse densify) run
+# in a small thread pool while the current slice is registered or warped,
+# and come back in order. Outputs (NIfTI, PNG, TIFF encode + write) go to an
+# AsyncWriter: a bounded queue drained by one background thread, so a loop
+# only blocks once `depth` writes are pending. workers=0 reads inline.
+PREFETCH_WORKERS = 4
+PREFETCH_DEPTH = 8
+
+
+def prefetch(fn, items, workers=PREFETCH_WORKERS, depth=PREFETCH_DEPTH):
+    # yields (item, fn(item)) in input order, at most `depth` results ahead
+    if not workers:
+        for item in items:
+            yield item, fn(item)
+        return
+
+    pending = deque()
+    with ThreadPoolExecutor(workers) as pool:
+        for item in items:
+            pending.append((item, pool.submit(fn, item)))
+            if len(pending) >= depth:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+
+
+def prefetch_slices(source, names, transform=None, workers=PREFETCH_WORKERS,
+                    depth=PREFETCH_DEPTH):
+    # (name, float32 array) from any slice source; the copy forces memmap
+    # pages in on the worker thread. transform runs there too.
+    def load(name):
+        img = np.array(source.read(name), dtype=np.float32)
+        return img if transform is None else transform(img)
+
+    return prefetch(load, names, workers, depth)
+
+
+class AsyncWriter:
+    # submit(fn, *args) returns at once; the first error is raised by the
+    # next submit or by close(), after which queued writes are dropped
+
+    def __init__(self, depth=PREFETCH_DEPTH):
+        self._queue = queue.Queue(depth)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            fn, args, kwargs = job
+            if self._error is None:
+                try:
+                    fn(*args, **kwargs)
+                except BaseException as e:
+                    self._error = e
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+
+    def submit(self, fn, *args, **kwargs):
+        self._check()
+        self._queue.put((fn, args, kwargs))
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
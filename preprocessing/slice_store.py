@@ -0,0 +1,235 @@
+import json
+import numpy as np
+from pathlib import Path
+
+# =========================
+# SLICE STACK STORE
+# =========================
+# One directory per channel (e.g. data/slices_from_trimmed/130.889.slices):
+#
+#   data.f32     all slices back to back, float32, C order
+#   index.json   slice name → element offset + shape (+ optional origin)
+#
+# Slices may have different shapes. The origin is the physical position of
+# pixel (0, 0) for slices that live on a cropped/padded registration grid.
+# Reads are zero-copy views into a single np.memmap of data.f32, so stages
+# never decode or rescale anything.
+# Rewriting an existing name appends new data and repoints the index; the old
+# bytes stay in data.f32 until the store is rewritten with mode="w".
+STORE_SUFFIX = ".slices"
+DATA_NAME = "data.f32"
+INDEX_NAME = "index.json"
+DTYPE = np.float32
+
+
+def is_slice_store(path):
+    return (Path(path) / INDEX_NAME).exists()
+
+
+def slice_index(name):
+    # "slice_078" / "slice_078.png" → 78
+    return int(Path(name).stem.split("_")[1])
+
+
+class SliceStore:
+
+    def __init__(self, path, mode="r"):
+        if mode not in ("r", "w", "a"):
+            raise ValueError("mode must be 'r', 'w' or 'a'")
+
+        self.path = Path(path)
+        self.mode = mode
+        self._data_path = self.path / DATA_NAME
+        self._index_path = self.path / INDEX_NAME
+        self._mmap = None
+        self._fh = None
+
+        if mode == "r" and not is_slice_store(self.path):
+            raise FileNotFoundError(f"No slice store at {self.path}")
+
+        if mode == "w" or not is_slice_store(self.path):
+            self.path.mkdir(parents=True, exist_ok=True)
+            self._data_path.write_bytes(b"")
+            self._entries = {}
+            self._write_index()
+        else:
+            with open(self._index_path) as f:
+                self._entries = json.load(f)["slices"]
+
+        if mode != "r":
+            self._fh = open(self._data_path, "ab")
+
+    # ---------------------------
+    # index
+    # ---------------------------
+    @property
+    def names(self):
+        return sorted(self._entries, key=slice_index)
+
+    def __contains__(self, name):
+        return Path(name).stem in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def shape(self, name):
+        return tuple(self._entries[Path(name).stem]["shape"])
+
+    def origin(self, name):
+        return tuple(self._entries[Path(name).stem].get("origin", (0.0, 0.0)))
+
+    def _write_index(self):
+        tmp = self._index_path.with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            json.dump({"dtype": np.dtype(DTYPE).name, "slices": self._entries}, f)
+        tmp.replace(self._index_path)
+
+    # ---------------------------
+    # read / write
+    # ---------------------------
+    def read(self, name):
+        entry = self._entries[Path(name).stem]
+        if self._mmap is None or self._mmap.size < entry["offset"] + entry["size"]:
+            if self._fh is not None:
+                self._fh.flush()
+            self._mmap = np.memmap(self._data_path, dtype=DTYPE, mode="r")
+
+        start = entry["offset"]
+        return self._mmap[start:start + entry["size"]].reshape(entry["shape"])
+
+    def write(self, name, arr, origin=None):
+        if self._fh is None:
+            raise IOError(f"Slice store {self.path} is read-only")
+
+        arr = np.ascontiguousarray(arr, dtype=DTYPE)
+        offset = self._fh.tell() // np.dtype(DTYPE).itemsize
+        self._fh.write(arr.tobytes())
+        self._entries[Path(name).stem] = {
+            "offset": offset,
+            "size": int(arr.size),
+            "shape": list(arr.shape),
+        }
+        if origin is not None:
+            self._entries[Path(name).stem]["origin"] = [float(o) for o in origin]
+
+    def flush(self):
+        if self._fh is not None:
+            self._fh.flush()
+            self._write_index()
+
+    def close(self):
+        self.flush()
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+        self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# =========================
+# PNG FOLDERS (LEGACY / EXPORT)
+# =========================
+class PngSlices:
+
+    def __init__(self, path, pattern="slice_*.png"):
+        self.path = Path(path)
+        self._paths = {p.stem: p for p in self.path.glob(pattern)}
+
+    @property
+    def names(self):
+        return sorted(self._paths, key=slice_index)
+
+    def __contains__(self, name):
+        return Path(name).stem in self._paths
+
+    def __len__(self):
+        return len(self._paths)
+
+    def shape(self, name):
+        # from the PNG header, without decoding the pixels
+        from PIL import Image
+
+        with Image.open(self._paths[Path(name).stem]) as img:
+            bands = len(img.getbands())
+            return (img.height, img.width) + ((bands,) if bands > 1 else ())
+
+    def origin(self, name):
+        return (0.0, 0.0)
+
+    def read(self, name):
+        import imageio.v2 as imageio
+
+        img = imageio.imread(self._paths[Path(name).stem])
+        return img.astype(np.float32) / 255.0
+
+
+# =========================
+# IN-MEMORY STACKS
+# =========================
+# Same interface as SliceStore, used when stages are chained in-process
+class MemorySlices:
+
+    def __init__(self, slices=None):
+        self._arrays = {}
+        self._origins = {}
+        for name, arr in (slices or {}).items():
+            self.write(name, arr)
+
+    @property
+    def names(self):
+        return sorted(self._arrays, key=slice_index)
+
+    def __contains__(self, name):
+        return Path(name).stem in self._arrays
+
+    def __len__(self):
+        return len(self._arrays)
+
+    def shape(self, name):
+        return self._arrays[Path(name).stem].shape
+
+    def origin(self, name):
+        return self._origins.get(Path(name).stem, (0.0, 0.0))
+
+    def read(self, name):
+        return self._arrays[Path(name).stem]
+
+    def write(self, name, arr, origin=None):
+        self._arrays[Path(name).stem] = np.asarray(arr, dtype=DTYPE)
+        if origin is not None:
+            self._origins[Path(name).stem] = tuple(float(o) for o in origin)
+
+    def save(self, path):
+        with SliceStore(path, mode="w") as store:
+            for name in self.names:
+                store.write(name, self._arrays[name], origin=self._origins.get(name))
+        return path
+
+    def close(self):
+        pass
+
+
+def open_slices(path):
+    # Float store (dense or sparse) when available, otherwise a folder of 8-bit
+    # PNGs. Objects that already look like a slice source (stores,
+    # MemorySlices, SparseChannel) pass through.
+    if hasattr(path, "read") and hasattr(path, "names"):
+        return path
+    from preprocessing.sparse_slices import is_sparse_channel, open_sparse
+
+    if is_sparse_channel(path):
+        return open_sparse(path)
+    if is_slice_store(path):
+        return SliceStore(path)
+    return PngSlices(path)
+
+
+def export_png(arr, path):
+    import imageio.v2 as imageio
+
+    imageio.imwrite(path, (np.clip(arr, 0, 1) * 255).astype(np.uint8))
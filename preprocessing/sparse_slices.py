@@ -0,0 +1,264 @@
+import hashlib
+import json
+import numpy as np
+from pathlib import Path
+
+from preprocessing.slice_store import DTYPE, MemorySlices, slice_index
+
+# =========================
+# SPARSE TISSUE PIXELS
+# =========================
+# MALDI only acquires tissue pixels, so a channel is stored as one float32
+# value per acquired pixel instead of a zero-filled raster per slice.
+#
+#   TissueGrid     per slice: raster shape + (row, col) of every acquired
+#                  pixel; built once from x/y/tissue_id and shared by every
+#                  channel of the acquisition
+#   SparseChannel  grid + one value vector (all slices back to back); reads
+#                  like a slice store and densifies on demand
+#
+# On disk (next to dense <mz>.slices stores):
+#
+#   grids/<key>.npz        TissueGrid, key = hash of the coordinate columns
+#   <mz>.sparse/values.f32 channel values in grid order
+#   <mz>.sparse/index.json grid key + names of slices with signal
+SPARSE_SUFFIX = ".sparse"
+GRID_DIR = "grids"
+VALUES_NAME = "values.f32"
+INDEX_NAME = "index.json"
+
+
+def is_sparse_channel(path):
+    return Path(path).name.endswith(SPARSE_SUFFIX) and (Path(path) / INDEX_NAME).exists()
+
+
+def coords_key(df):
+    h = hashlib.blake2b(digest_size=8)
+    for col in ("x", "y", "tissue_id"):
+        h.update(np.ascontiguousarray(df[col].to_numpy()).tobytes())
+    return h.hexdigest()
+
+
+class TissueGrid:
+
+    def __init__(self, names, shapes, offsets, rows, cols, source_index, key=None):
+        self._names = list(names)
+        self._slots = {name: i for i, name in enumerate(self._names)}
+        self.shapes = np.asarray(shapes, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)   # len(names) + 1
+        self.rows = np.asarray(rows, dtype=np.int32)
+        self.cols = np.asarray(cols, dtype=np.int32)
+        self.source_index = np.asarray(source_index, dtype=np.int64)
+        self.key = key
+
+    @classmethod
+    def from_frame(cls, df):
+        # Same raster as the old dense slices: per slice, rows/cols index the
+        # sorted unique y/x. Duplicate pixels keep the last row (as the dense
+        # assignment did).
+        tissue = df["tissue_id"].to_numpy()
+        xs_all = df["x"].to_numpy()
+        ys_all = df["y"].to_numpy()
+
+        order = np.argsort(tissue, kind="stable")
+        sids, starts = np.unique(tissue[order], return_index=True)
+        bounds = np.append(starts, len(order))
+
+        names, shapes, offsets = [], [], [0]
+        rows, cols, index = [], [], []
+        for sid, a, b in zip(sids, bounds[:-1], bounds[1:]):
+            idx = order[a:b]
+            xs = np.unique(xs_all[idx])
+            ys = np.unique(ys_all[idx])
+            r = np.searchsorted(ys, ys_all[idx])
+            c = np.searchsorted(xs, xs_all[idx])
+
+            # last occurrence of each pixel
+            flat = r.astype(np.int64) * len(xs) + c
+            _, last = np.unique(flat[::-1], return_index=True)
+            keep = np.sort(len(flat) - 1 - last)
+
+            names.append(f"slice_{int(sid):03d}")
+            shapes.append((len(ys), len(xs)))
+            rows.append(r[keep])
+            cols.append(c[keep])
+            index.append(idx[keep])
+            offsets.append(offsets[-1] + len(keep))
+
+        return cls(names, shapes, offsets, np.concatenate(rows), np.concatenate(cols),
+                   np.concatenate(index), coords_key(df))
+
+    # ---------------------------
+    # index
+    # ---------------------------
+    @property
+    def names(self):
+        return list(self._names)
+
+    def __contains__(self, name):
+        return Path(name).stem in self._slots
+
+    def __len__(self):
+        return len(self._names)
+
+    @property
+    def n_pixels(self):
+        return int(self.offsets[-1])
+
+    def shape(self, name):
+        return tuple(int(s) for s in self.shapes[self._slots[Path(name).stem]])
+
+    def span(self, name):
+        i = self._slots[Path(name).stem]
+        return int(self.offsets[i]), int(self.offsets[i + 1])
+
+    def coords(self, name):
+        a, b = self.span(name)
+        return self.rows[a:b], self.cols[a:b]
+
+    def dense_pixels(self):
+        return int(np.prod(self.shapes, axis=1).sum())
+
+    # ---------------------------
+    # values
+    # ---------------------------
+    def matches(self, df):
+        return self.key == coords_key(df)
+
+    def gather(self, column):
+        # frame column → value vector in grid order
+        return np.asarray(column, dtype=DTYPE)[self.source_index]
+
+    def densify(self, values, name, fill=0.0, out=None):
+        a, b = self.span(name)
+        if out is None:
+            out = np.full(self.shape(name), fill, dtype=DTYPE)
+        else:
+            out[...] = fill
+        out[self.rows[a:b], self.cols[a:b]] = values[a:b]
+        return out
+
+    # ---------------------------
+    # disk
+    # ---------------------------
+    def save(self, path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        np.savez_compressed(path, names=np.array(self._names), shapes=self.shapes,
+                            offsets=self.offsets, rows=self.rows, cols=self.cols,
+                            source_index=self.source_index)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f["names"].tolist(), f["shapes"], f["offsets"], f["rows"], f["cols"],
+                       f["source_index"], Path(path).stem)
+
+
+# =========================
+# ONE CHANNEL
+# =========================
+class SparseChannel:
+    # Slice-source interface (names / read / shape / origin), so registration
+    # and warping accept it wherever a SliceStore or MemorySlices is expected
+
+    def __init__(self, grid, values, names=None):
+        self.grid = grid
+        self.values = values
+        self._names = grid.names if names is None else sorted(names, key=slice_index)
+
+    @property
+    def names(self):
+        return list(self._names)
+
+    def __contains__(self, name):
+        return Path(name).stem in self._names
+
+    def __len__(self):
+        return len(self._names)
+
+    def shape(self, name):
+        return self.grid.shape(name)
+
+    def origin(self, name):
+        return (0.0, 0.0)
+
+    def slice_values(self, name):
+        a, b = self.grid.span(name)
+        return self.values[a:b]
+
+    def read(self, name):
+        return self.grid.densify(self.values, name)
+
+    def to_memory(self):
+        return MemorySlices({name: self.read(name) for name in self._names})
+
+    def save(self, path):
+        # dense float store, for stages that want plain rasters
+        return self.to_memory().save(path)
+
+    def save_sparse(self, path):
+        # path: <root>/<mz>.sparse; the grid goes to <root>/grids/<key>.npz
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        grid_path = path.parent / GRID_DIR / f"{self.grid.key}.npz"
+        if not grid_path.exists():
+            self.grid.save(grid_path)
+
+        np.asarray(self.values, dtype=DTYPE).tofile(path / VALUES_NAME)
+        with open(path / INDEX_NAME, "w") as f:
+            json.dump({"grid": self.grid.key, "slices": self._names}, f)
+        return path
+
+    def close(self):
+        pass
+
+
+_grids = {}
+
+
+def open_sparse(path):
+    path = Path(path)
+    with open(path / INDEX_NAME) as f:
+        index = json.load(f)
+
+    grid_path = path.parent / GRID_DIR / f"{index['grid']}.npz"
+    if grid_path not in _grids:
+        _grids[grid_path] = TissueGrid.load(grid_path)
+
+    values = np.memmap(path / VALUES_NAME, dtype=DTYPE, mode="r")
+    return SparseChannel(_grids[grid_path], values, index["slices"])
+
+
+# =========================
+# OPERATIONS ON VALUES
+# =========================
+def sparse_stats(channel):
+    # per slice over acquired pixels: mean, max, fraction non-zero
+    stats = {}
+    for name in channel.names:
+        v = channel.slice_values(name)
+        stats[name] = {
+            "mean": float(v.mean()) if v.size else 0.0,
+            "max": float(v.max()) if v.size else 0.0,
+            "nonzero": float(np.count_nonzero(v) / max(v.size, 1)),
+        }
+    return stats
+
+
+def sparse_ncc(a, b, name=None):
+    # NCC between two channels on the same grid, over one slice or all pixels
+    if a.grid.key != b.grid.key:
+        raise ValueError("channels live on different tissue grids")
+
+    if name is None:
+        va, vb = np.asarray(a.values, np.float64), np.asarray(b.values, np.float64)
+    else:
+        va = np.asarray(a.slice_values(name), np.float64)
+        vb = np.asarray(b.slice_values(name), np.float64)
+
+    va = va - va.mean()
+    vb = vb - vb.mean()
+    denom = np.sqrt((va * va).sum() * (vb * vb).sum())
+    return float((va * vb).sum() / denom) if denom > 0 else 0.0
@@ -1,62 +1,127 @@
-import pandas as pd
 from pathlib import Path
 
-# =========================
-# CONFIG
-# =========================
-INPUT = "data/Cochlea_3D_TIC.csv"
-OUT_DIR = Path("data/trimmed_csvs_0_100")
-OUT_DIR.mkdir(parents=True, exist_ok=True)
+from preprocessing.channel_stats import csv_channel_stats, rank_channels
+from preprocessing.csv_reader import CHUNK_SIZE, iter_csv, read_csv, read_header
+from preprocessing.mz_binning import reduce_channels, save_provenance
 
 BASE_COLS = ["x", "y", "tissue_id"]
-CHUNK_SIZE = 1_000_000
 
-START = 0
-END = 100  
 
 # =========================
 # DISCOVER m/z COLUMNS
 # =========================
-print("Reading CSV header...")
-cols = pd.read_csv(INPUT, nrows=0).columns
-mz_cols = [c for c in cols if c.startswith("m.z.")]
+def select_mz_cols(input_csv, start=0, end=None):
+    cols = read_header(input_csv)
+    mz_cols = [c for c in cols if c.startswith("m.z.")]
 
-if END is None:
-    mz_cols = mz_cols[START:]
-else:
-    mz_cols = mz_cols[START:END]
+    if end is None:
+        return mz_cols[start:]
+    return mz_cols[start:end]
+
+
+# =========================
+# IN-MEMORY CHANNEL FRAMES
+# =========================
+def binned_columns(df, bins):
+    # bins: output column → member columns (see mz_binning); members summed
+    out = df[BASE_COLS].copy()
+    for name, members in bins.items():
+        out[name] = df[members].sum(axis=1) if len(members) > 1 else df[members[0]]
+    return out
+
+
+def read_channels(input_csv, mz_cols, bins=None):
+    # One pass over the source; returns m/z column → frame with
+    # BASE_COLS + that column, i.e. what trim_csv would have written to disk.
+    # With bins, mz_cols are the output columns and each is a member sum.
+    if bins is None:
+        df = read_csv(input_csv, BASE_COLS + list(mz_cols))
+    else:
+        members = [c for mz in mz_cols for c in bins[mz]]
+        df = binned_columns(read_csv(input_csv, BASE_COLS + members), {mz: bins[mz] for mz in mz_cols})
+    return {mz: df[BASE_COLS + [mz]] for mz in mz_cols}
 
-print(f"Saving CSVs starting from index {START}")
-print(f"Total m/z values to process: {len(mz_cols)}")
 
 # =========================
 # PROCESS EACH m/z
 # =========================
-for mz in mz_cols:
-    out_csv = OUT_DIR / f"Cochlea_3D_{mz}.csv"
-    usecols = BASE_COLS + [mz]
+def trim_csv(input_csv, out_dir, start=0, end=None, chunk_size=CHUNK_SIZE, mz_cols=None,
+             bins=None):
+    # mz_cols overrides the start:end column range (e.g. rank_channels output).
+    # bins (reduce_channels output) writes one summed CSV per kept bin instead.
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    if bins is not None:
+        mz_cols = list(bins)
+        selection = f"{len(mz_cols)} bins of {sum(len(m) for m in bins.values())} columns"
+    elif mz_cols is None:
+        print("Reading CSV header...")
+        mz_cols = select_mz_cols(input_csv, start, end)
+        selection = f"columns {start}:{'' if end is None else end}"
+    else:
+        selection = "given m/z columns"
+    mz_cols = list(mz_cols)
+    source_cols = mz_cols if bins is None else [c for mz in mz_cols for c in bins[mz]]
 
-    print(f"\nProcessing {mz}")
-    first = True
+    shown = ", ".join(mz_cols[:5]) + (", ..." if len(mz_cols) > 5 else "")
+    print(f"Saving CSVs for {selection}: {shown}")
+    print(f"Total m/z values to process: {len(mz_cols)}")
 
-    reader = pd.read_csv(
-        INPUT,
-        usecols=usecols,
-        chunksize=CHUNK_SIZE
-    )
+    # one streaming pass over the source for all selected m/z columns
+    out_paths = [out_dir / f"Cochlea_3D_{mz}.csv" for mz in mz_cols]
+    reader = iter_csv(input_csv, BASE_COLS + source_cols, chunk_size)
 
+    rows = 0
     for i, chunk in enumerate(reader):
-        chunk.to_csv(
-            out_csv,
-            mode="w" if first else "a",
-            header=first,
-            index=False
-        )
-        first = False
+        if bins is not None:
+            chunk = binned_columns(chunk, bins)
+        for mz, out_csv in zip(mz_cols, out_paths):
+            chunk[BASE_COLS + [mz]].to_csv(
+                out_csv,
+                mode="w" if i == 0 else "a",
+                header=i == 0,
+                index=False
+            )
+        rows += len(chunk)
 
         if i % 10 == 0:
-            print(f"  wrote {i * CHUNK_SIZE:,} rows")
+            print(f"  wrote {rows:,} rows")
+
+    for mz in mz_cols:
+        print(f"Finished {mz}")
+
+    return out_paths
+
+
+if __name__ == "__main__":
+    # =========================
+    # CONFIG
+    # =========================
+    INPUT = "data/Cochlea_3D_TIC.csv"
+    OUT_DIR = Path("data/trimmed_csvs_0_100")
+
+    START = 0
+    END = 100
+
+    # e.g. 100 → keep the 100 m/z with the largest TIC share (one cached
+    # statistics pass, see channel_stats) instead of columns START:END
+    TOP_CHANNELS = None
+
+    # e.g. dict(ppm=10, min_tic_fraction=1e-4, min_nonzero=0.01) → merge
+    # neighbouring m/z within the tolerance and drop weak / sparse bins (one
+    # statistics pass, see mz_binning); provenance goes to OUT_DIR/mz_bins.csv
+    BINNING = None
+
+    mz_cols = None
+    bins = None
+    if BINNING is not None:
+        bins, provenance = reduce_channels(INPUT, **BINNING)
+        save_provenance(provenance, OUT_DIR)
+    elif TOP_CHANNELS is not None:
+        summary, _ = csv_channel_stats(INPUT)
+        mz_cols = rank_channels(summary, top=TOP_CHANNELS, min_nonzero=0.01)
 
-    print(f"Finished {mz}")
+    trim_csv(INPUT, OUT_DIR, START, END, CHUNK_SIZE, mz_cols, bins)
 
-print("\n✅ Done saving remaining m/z CSVs")
+    print("\n✅ Done saving remaining m/z CSVs")
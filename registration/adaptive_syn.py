@@ -0,0 +1,155 @@
+import os
+import tempfile
+import numpy as np
+from pathlib import Path
+from scipy import ndimage as ndi
+
+from registration.phase_init import ncc
+
+# =========================
+# ADAPTIVE SyN
+# =========================
+# Coarse-to-fine SyN driven level by level from Python instead of one fixed
+# reg_iterations schedule. Each level (shrink 2^k, smoothing k, as
+# ants.registration derives them) runs in chunks of `chunk` iterations, each
+# chunk starting from the deformation so far; a level ends when a chunk
+# improves the NCC against the fixed image by less than `tol`, or when the
+# level's budget from reg_iterations is spent. Well-aligned pairs stop after
+# a chunk or two per level.
+#
+# The deformation is kept as one displacement field (chunks composed in
+# numpy) and inverted by fixed-point iteration, so the bundle gets the usual
+# warp + inverse warp. There is no SyN affine stage ("SyNOnly"): the rigid
+# stage already aligned the pair. init_field warm-starts from another
+# deformation on the same grid (the previous slice's), kept only if it beats
+# the identity.
+ADAPTIVE_SYN = dict(chunk=5, tol=1e-3)
+INVERT_ITERATIONS = 20
+
+
+# =========================
+# FIELDS (H, W, 2), physical units, component k along numpy axis k
+# =========================
+def _sample(field, coords):
+    return np.stack([
+        ndi.map_coordinates(field[..., k], coords, order=1, mode="nearest")
+        for k in range(field.shape[-1])
+    ], axis=-1)
+
+
+def compose_fields(first, second, spacing=(1.0, 1.0)):
+    # x → x + first(x) → then second: total(x) = first(x) + second(x + first(x))
+    spacing = np.asarray(spacing, dtype=np.float32)
+    grid = np.indices(first.shape[:2], dtype=np.float32)
+    coords = grid + np.moveaxis(first / spacing, -1, 0)
+    return (first + _sample(second, coords)).astype(np.float32)
+
+
+def invert_field(field, spacing=(1.0, 1.0), iterations=INVERT_ITERATIONS):
+    # v(y) = -u(y + v(y)), solved by fixed-point iteration
+    spacing = np.asarray(spacing, dtype=np.float32)
+    grid = np.indices(field.shape[:2], dtype=np.float32)
+    inv = -field.copy()
+    for _ in range(iterations):
+        inv = -_sample(field, grid + np.moveaxis(inv / spacing, -1, 0))
+    return inv.astype(np.float32)
+
+
+def field_image(field, ref):
+    import ants
+
+    return ants.from_numpy(field, origin=ref.origin, spacing=ref.spacing,
+                           direction=ref.direction, has_components=True)
+
+
+def _write_field(field, ref, prefix, suffix):
+    import ants
+
+    path = f"{prefix}{suffix}"
+    ants.image_write(field_image(field, ref), path)
+    return path
+
+
+def _read_chain(transform_files, ref):
+    # ants fwdtransforms (all displacement fields here) → one field
+    import ants
+
+    total = None
+    for tf in transform_files:
+        field = ants.image_read(tf).numpy()
+        total = field if total is None else compose_fields(total, field, ref.spacing)
+    return total
+
+
+def _similarity(fixed_np, warped_np):
+    return ncc(fixed_np, warped_np, (fixed_np > 0) | (warped_np > 0))
+
+
+# =========================
+# STAGE
+# =========================
+def adaptive_syn_stage(prev, moving, params, chunk=5, tol=1e-3, init_field=None):
+    # params: SYN_PARAMS-style dict; reg_iterations is the per-level budget.
+    # Returns the ants.registration keys used downstream (fwdtransforms,
+    # invtransforms, warpedmovout) plus field, iterations (per level) and cc.
+    import ants
+
+    budgets = list(params.get("reg_iterations", (20, 10, 0)))
+    passed = {k: v for k, v in params.items()
+              if k not in ("type_of_transform", "reg_iterations", "shrink_factors",
+                           "smoothing_sigmas")}
+
+    fd, prefix = tempfile.mkstemp(prefix="adaptive_syn_")
+    os.close(fd)
+    os.unlink(prefix)
+
+    fixed_np = prev.numpy()
+    field = np.zeros(fixed_np.shape + (2,), dtype=np.float32)
+    cc = _similarity(fixed_np, moving.numpy())
+    start = "identity"
+
+    if init_field is not None and init_field.shape == field.shape:
+        init_path = _write_field(init_field, prev, prefix, "init.nii.gz")
+        warped = ants.apply_transforms(prev, moving, [init_path]).numpy()
+        Path(init_path).unlink(missing_ok=True)
+        init_cc = _similarity(fixed_np, warped)
+        if init_cc > cc:
+            field, cc, start = init_field.astype(np.float32), init_cc, "warm"
+
+    iterations = []
+    for level, budget in enumerate(budgets):
+        zeros = (0,) * (len(budgets) - 1 - level)
+        used = 0
+        while used < budget:
+            step = min(chunk, budget - used)
+            init_path = _write_field(field, prev, prefix, "init.nii.gz")
+            reg = ants.registration(
+                fixed=prev, moving=moving, type_of_transform="SyNOnly",
+                reg_iterations=(step,) + zeros, initial_transform=[init_path], **passed
+            )
+            used += step
+
+            new_cc = _similarity(fixed_np, reg["warpedmovout"].numpy())
+            field = _read_chain(reg["fwdtransforms"], prev)
+            for tf in set(reg["fwdtransforms"] + reg["invtransforms"] + [init_path]):
+                Path(tf).unlink(missing_ok=True)
+
+            gain, cc = new_cc - cc, new_cc
+            if gain < tol:
+                break
+        iterations.append(used)
+
+    warp_path = _write_field(field, prev, prefix, "1Warp.nii.gz")
+    inv_path = _write_field(invert_field(field, prev.spacing), prev, prefix, "1InverseWarp.nii.gz")
+    warped = ants.apply_transforms(prev, moving, [warp_path])
+
+    return {
+        "fwdtransforms": [warp_path],
+        "invtransforms": [inv_path],
+        "warpedmovout": warped,
+        "field": field,
+        "iterations": iterations,
+        "budget": budgets,
+        "cc": _similarity(fixed_np, warped.numpy()),
+        "start": start,
+    }
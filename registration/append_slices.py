@@ -0,0 +1,299 @@
+import struct
+import numpy as np
+from pathlib import Path
+
+from preprocessing.slice_store import SliceStore, open_slices, slice_index
+from registration.main_registration import (
+    BAD_SLICE_NAMES,
+    RIGID_PARAMS,
+    SYN_PARAMS,
+    normalize_gray,
+    rigid_stage,
+    store_transforms,
+    syn_stage,
+)
+from registration.registration_cache import open_cache
+from registration.tissue_crop import crop_to_ants
+from registration.transform_all import (
+    BAD_SLICE_INDICES,
+    channel_sources,
+    fill_imputed,
+    reference_image,
+    warp_slices,
+    write_volume,
+)
+from registration.transform_bundle import TransformBundle
+
+# =========================
+# INCREMENTAL APPEND
+# =========================
+# New sections (already present in the channel stores) are registered one by
+# one against their nearest registered neighbour, read back from the
+# registered store, instead of re-running the whole backward chain. Their
+# transforms are appended to the bundle, and each m/z volume grows by the
+# warped new slices only:
+#
+#   <mz>.nii      slices past the current end are appended in place (header
+#                 dim[3] patched, voxels written at the end of the file)
+#   <mz>.nii.gz   / slices inside the stack: the volume is rewritten
+#
+# so ".nii" is the default here and in transform_all; an existing
+# <mz>.nii.gz is still used when there is no <mz>.nii, at the cost of a full
+# read + recompress of every volume on each append.
+#
+# New slices are registered on their neighbour's grid (the tissue ROI of the
+# original run), so tissue outside that ROI is cropped.
+NIFTI1_HEADER = 348
+NIFTI_DTYPES = {2: np.uint8, 4: np.int16, 8: np.int32, 16: np.float32, 64: np.float64}
+
+
+# =========================
+# NIfTI IN-PLACE APPEND
+# =========================
+def _nifti_header(f):
+    f.seek(0)
+    raw = f.read(NIFTI1_HEADER)
+    for endian in "<>":
+        if struct.unpack(endian + "i", raw[:4])[0] == NIFTI1_HEADER:
+            break
+    else:
+        raise ValueError("not a NIfTI-1 file")
+
+    dim = list(struct.unpack(endian + "8h", raw[40:56]))
+    datatype = struct.unpack(endian + "h", raw[70:72])[0]
+    vox_offset = int(struct.unpack(endian + "f", raw[108:112])[0])
+    return endian, dim, datatype, vox_offset
+
+
+def nifti_append(path, slices):
+    # slices: (k, Y, X) appended along z (the slowest axis on disk)
+    with open(path, "r+b") as f:
+        endian, dim, datatype, vox_offset = _nifti_header(f)
+        if dim[0] != 3:
+            raise ValueError(f"{path}: expected a 3D volume, got {dim[0]}D")
+        dtype = np.dtype(NIFTI_DTYPES[datatype]).newbyteorder(endian)
+
+        slices = np.asarray(slices)
+        if slices.shape[1:] != (dim[2], dim[1]):
+            raise ValueError(f"{path}: slice shape {slices.shape[1:]} != {(dim[2], dim[1])}")
+
+        f.seek(0, 2)
+        expected = vox_offset + dim[1] * dim[2] * dim[3] * dtype.itemsize
+        if f.tell() != expected:
+            raise ValueError(f"{path}: data does not end at the end of the file")
+
+        f.write(np.ascontiguousarray(slices, dtype=dtype).tobytes())
+        dim[3] += len(slices)
+        f.seek(40)
+        f.write(struct.pack(endian + "8h", *dim))
+    return dim[3]
+
+
+def read_volume(path):
+    import SimpleITK as sitk
+
+    return sitk.GetArrayFromImage(sitk.ReadImage(str(path)))
+
+
+def volume_depth(path):
+    if str(path).endswith(".nii"):
+        with open(path, "rb") as f:
+            return _nifti_header(f)[1][3]
+    import SimpleITK as sitk
+
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(str(path))
+    reader.ReadImageInformation()
+    return reader.GetSize()[2]
+
+
+def last_slice(path):
+    # reads only the last z-slice of an uncompressed volume
+    if not str(path).endswith(".nii"):
+        return read_volume(path)[-1]
+
+    with open(path, "rb") as f:
+        endian, dim, datatype, vox_offset = _nifti_header(f)
+    dtype = np.dtype(NIFTI_DTYPES[datatype]).newbyteorder(endian)
+    n = dim[1] * dim[2]
+    offset = vox_offset + (dim[3] - 1) * n * dtype.itemsize
+    return np.fromfile(path, dtype=dtype, count=n, offset=offset).reshape(dim[2], dim[1])
+
+
+def insert_slices(path, positions, warped, ref_img_np):
+    # positions: z of each new slice in the final volume; None entries in
+    # warped are imputed from the slice before them
+    volume = list(read_volume(path))
+    for z, img in zip(positions, warped):
+        volume.insert(z, img)
+    return write_volume(np.stack(fill_imputed(volume, ref_img_np), axis=0), path)
+
+
+# =========================
+# REGISTER NEW SLICES
+# =========================
+def new_slice_names(source, registered, bad_slices=BAD_SLICE_NAMES):
+    return [n for n in source.names if n not in registered and n not in bad_slices]
+
+
+def nearest_registered(name, registered_names):
+    # prefer the higher neighbour on ties (the backward chain direction)
+    idx = slice_index(name)
+    return min(registered_names, key=lambda n: (abs(slice_index(n) - idx), -slice_index(n)))
+
+
+def register_new_slices(source, registered_path, bundle_path, new_names=None,
+                        bad_slices=BAD_SLICE_NAMES, rigid_init="phase", init_accept_ncc=0.95,
+                        field_mode="full", field_factor=4, field_tolerance=0.5,
+                        rigid_params=RIGID_PARAMS, syn_params=SYN_PARAMS, syn_adaptive=None,
+                        cache=None):
+    # Cost per new slice is one Rigid + SyN against its neighbour, whatever
+    # the stack size. Returns the names that were registered.
+    import ants
+
+    source = open_slices(source)
+    cache = open_cache(cache)
+    registered = SliceStore(registered_path, mode="a")
+    if new_names is None:
+        new_names = new_slice_names(source, registered, bad_slices)
+    pending = [n for n in new_names if n not in bad_slices]
+
+    done = []
+    with TransformBundle(bundle_path, mode="a") as bundle:
+        while pending:
+            # next: the new slice closest to the current chain
+            names = registered.names
+            gap = {n: abs(slice_index(n) - slice_index(nearest_registered(n, names))) for n in pending}
+            name = min(pending, key=gap.get)
+            pending.remove(name)
+            neighbour = nearest_registered(name, names)
+
+            prev_np = np.array(registered.read(neighbour), dtype=np.float32)
+            origin = registered.origin(neighbour)
+            prev = ants.from_numpy(prev_np, origin=origin)
+
+            # moving on the neighbour's grid (ROI crop or legacy padding)
+            r0, c0 = int(round(origin[0])), int(round(origin[1]))
+            roi = (r0, c0, r0 + prev_np.shape[0], c0 + prev_np.shape[1])
+            moving = crop_to_ants(normalize_gray(source.read(name)), roi)
+
+            print(f"➕ Registering {name} against {neighbour}")
+            rigid = rigid_stage(prev, moving, rigid_init, init_accept_ncc, rigid_params, cache)
+            syn = syn_stage(prev, rigid["warpedmovout"], syn_params, syn_adaptive, cache=cache)
+
+            store_transforms(bundle, name, rigid, syn, field_mode, field_factor, field_tolerance)
+            registered.write(name, syn["warpedmovout"].numpy(), origin=origin)
+            registered.flush()
+            done.append(name)
+
+    registered.close()
+    return done
+
+
+# =========================
+# WARP + APPEND PER CHANNEL
+# =========================
+def volume_path(volume_root, mz, volume_ext=".nii"):
+    # <mz><volume_ext>, or the volume in the other NIfTI flavour if only that exists
+    path = Path(volume_root) / f"{mz}{volume_ext}"
+    if not path.exists():
+        other = Path(volume_root) / f"{mz}{'.nii.gz' if volume_ext == '.nii' else '.nii'}"
+        if other.exists():
+            return other
+    return path
+
+
+def append_to_volumes(slices_root, registered_path, bundle_path, volume_root, reference_name,
+                      new_names, bad_indices=BAD_SLICE_INDICES, volume_ext=".nii"):
+    # new_names: slices to add to every <mz><volume_ext> (bad ones are imputed);
+    # ".nii.gz" volumes are rewritten in full
+    transforms = TransformBundle(bundle_path)
+    fixed = reference_image(registered_path, reference_name)
+    ref_sid = Path(reference_name).stem
+    new_names = sorted(new_names, key=slice_index)
+
+    out_paths = {}
+    for mz, mz_path in channel_sources(slices_root):
+        vol_path = volume_path(volume_root, mz, volume_ext)
+        if not vol_path.exists():
+            print(f"⚠️ No volume for {mz}, skipping")
+            continue
+
+        source = open_slices(mz_path)
+        names = [n for n in new_names if n in source]
+        if not names:
+            continue
+
+        # z positions: the volume holds every source slice except the anchor
+        stack_names = [n for n in source.names if n != ref_sid]
+        depth = volume_depth(vol_path)
+        if depth != len(stack_names) - len(names):
+            raise ValueError(
+                f"{vol_path} has {depth} slices but {mz} has "
+                f"{len(stack_names) - len(names)} besides the new ones; pass every "
+                f"slice missing from the volume in new_names"
+            )
+        positions = [stack_names.index(n) for n in names]
+        at_end = positions == list(range(depth, len(stack_names)))
+
+        warped = warp_slices(source, transforms, fixed, reference_name, bad_indices,
+                             names=names, desc=f" ({mz})")
+
+        if at_end and vol_path.suffix == ".nii":
+            prev = last_slice(vol_path) if depth else fixed.numpy()
+            warped = np.stack(fill_imputed([prev] + warped, fixed.numpy())[1:], axis=0)
+            depth = nifti_append(vol_path, warped)
+            print(f"Appended {len(names)} slices to {vol_path} (z = {depth})")
+        else:
+            print(f"⚠️ Rewriting {vol_path} (compressed or slices inside the stack)")
+            insert_slices(vol_path, positions, warped, fixed.numpy())
+        out_paths[mz] = vol_path
+
+    return out_paths
+
+
+def append_slices(slices_root, reference_mz, registered_path, bundle_path, volume_root,
+                  reference_name, new_names=None, bad_slices=BAD_SLICE_NAMES,
+                  bad_indices=BAD_SLICE_INDICES, volume_ext=".nii", **registration_kwargs):
+    source_path = dict(channel_sources(slices_root))[reference_mz]
+    source = open_slices(source_path)
+
+    if new_names is None:
+        with SliceStore(registered_path) as registered:
+            new_names = new_slice_names(source, registered, bad_slices)
+    if not new_names:
+        print("No new slices")
+        return {}
+
+    print(f"New slices: {', '.join(new_names)}")
+    register_new_slices(source, registered_path, bundle_path, new_names, bad_slices,
+                        **registration_kwargs)
+    return append_to_volumes(slices_root, registered_path, bundle_path, volume_root,
+                             reference_name, new_names, bad_indices, volume_ext)
+
+
+if __name__ == "__main__":
+    # =========================
+    # CONFIG
+    # =========================
+    # Add the new sections to the channel stores first (generate_all_slices
+    # on the new CSV rows). Every good slice not yet in REGISTERED is treated
+    # as new; new bad sections have to be listed in NEW_SLICES.
+    SLICES_ROOT = Path("data/slices_from_trimmed")
+    REFERENCE_MZ = "130.889"
+    REGISTERED = Path("results_stable_clean/best.slices")
+    TRANSFORM_BUNDLE = Path("results_stable_clean/transforms.bundle")
+    VOLUME_ROOT = Path("data/volumes_new")
+    REFERENCE_SLICE_NAME = "slice_078.png"
+
+    # ".nii" volumes grow in place; ".nii.gz" ones (used when no .nii exists)
+    # are read and recompressed in full on every append
+    VOLUME_EXT = ".nii"
+    NEW_SLICES = None   # e.g. ["slice_079", "slice_080"]
+
+    append_slices(
+        SLICES_ROOT, REFERENCE_MZ, REGISTERED, TRANSFORM_BUNDLE, VOLUME_ROOT,
+        REFERENCE_SLICE_NAME, new_names=NEW_SLICES, volume_ext=VOLUME_EXT,
+    )
+
+    print("\n✅ New slices appended")
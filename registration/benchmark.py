@@ -0,0 +1,260 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from preprocessing.slice_store import open_slices
+from registration.main_registration import (
+    ADAPTIVE_SYN,
+    BAD_SLICE_NAMES,
+    RIGID_PARAMS,
+    SYN_PARAMS,
+    normalize_gray,
+    rigid_stage,
+    syn_stage,
+    tissue_roi,
+)
+from registration.phase_init import ncc
+from registration.tissue_crop import crop, crop_to_ants
+
+# =========================
+# PRESETS
+# =========================
+# Overrides of the main_registration defaults. Note what ants.registration
+# actually reads:
+#   Rigid  aff_iterations / aff_shrink_factors / aff_smoothing_sigmas (the
+#          reg_iterations, shrink_factors, smoothing_sigmas and grad_step in
+#          RIGID_PARAMS are ignored; default aff_iterations 2100x1200x1200x10)
+#   SyN    reg_iterations (levels → shrink 2^k, smoothing k), grad_step,
+#          syn_metric / syn_sampling; "SyN" also runs an Affine stage
+#          (2100x1200x1200x0) first, "SyNOnly" does not
+# "syn_adaptive" runs SyN with per-level early stopping (adaptive_syn),
+# reg_iterations then being the per-level budget
+PRESETS = {
+    "current": {},
+    "rigid_fast": {"rigid": {"aff_iterations": (200, 100, 50, 0),
+                             "aff_shrink_factors": (4, 2, 1, 1),
+                             "aff_smoothing_sigmas": (2, 1, 0, 0)}},
+    "phase_accept": {"rigid_init": "phase_accept"},
+    "syn_only": {"syn": {"type_of_transform": "SyNOnly"}},
+    "syn_light": {"syn": {"reg_iterations": (10, 5, 0)}},
+    "syn_full_res": {"syn": {"reg_iterations": (20, 10, 5)}},
+    "syn_mi": {"syn": {"syn_metric": "mattes", "syn_sampling": 32}},
+    "syn_step_08": {"syn": {"grad_step": 0.08}},
+    "syn_adaptive": {"syn_adaptive": ADAPTIVE_SYN},
+    "pad_80": {"crop_to_tissue": False, "pad": 80},
+    "fast": {"rigid_init": "phase_accept",
+             "rigid": {"aff_iterations": (200, 100, 50, 0),
+                       "aff_shrink_factors": (4, 2, 1, 1),
+                       "aff_smoothing_sigmas": (2, 1, 0, 0)},
+             "syn": {"type_of_transform": "SyNOnly"}},
+}
+
+
+# =========================
+# QUALITY METRICS
+# =========================
+def mutual_information(a, b, mask=None, bins=32):
+    if mask is not None:
+        a, b = a[mask], b[mask]
+    hist, _, _ = np.histogram2d(a.ravel(), b.ravel(), bins=bins)
+    pxy = hist / max(hist.sum(), 1)
+    px = pxy.sum(axis=1, keepdims=True)
+    py = pxy.sum(axis=0, keepdims=True)
+    nz = pxy > 0
+    return float((pxy[nz] * np.log(pxy[nz] / (px @ py)[nz])).sum())
+
+
+def jacobian_stats(field):
+    # field: (H, W, 2) displacement in pixels, component k along numpy axis k
+    d00 = np.gradient(field[..., 0], axis=0)
+    d01 = np.gradient(field[..., 0], axis=1)
+    d10 = np.gradient(field[..., 1], axis=0)
+    d11 = np.gradient(field[..., 1], axis=1)
+    det = (1 + d00) * (1 + d11) - d01 * d10
+    return {
+        "fold_frac": float((det <= 0).mean()),
+        "jac_min": float(det.min()),
+        "jac_max": float(det.max()),
+    }
+
+
+def pair_quality(fixed_np, warped_np):
+    mask = (fixed_np > 0) | (warped_np > 0)
+    return {
+        "ncc": ncc(fixed_np, warped_np, mask),
+        "mi": mutual_information(fixed_np, warped_np, mask),
+    }
+
+
+# =========================
+# ONE (PRESET, PAIR) RUN
+# =========================
+def _init_worker(itk_threads):
+    # before ants is imported in the worker
+    os.environ["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(itk_threads)
+
+
+def run_pair(source_path, fixed_name, moving_name, preset_name, preset):
+    import ants
+
+    source = open_slices(source_path)
+    fixed_img = normalize_gray(source.read(fixed_name))
+    moving_img = normalize_gray(source.read(moving_name))
+
+    if preset.get("crop_to_tissue", True):
+        roi = tissue_roi(source, [fixed_name, moving_name])
+        fixed = crop_to_ants(fixed_img, roi)
+        moving = crop_to_ants(moving_img, roi)
+    else:
+        pad = preset.get("pad", 80)
+        fixed = ants.pad_image(ants.from_numpy(fixed_img), pad_width=[pad, pad])
+        moving = ants.pad_image(ants.from_numpy(moving_img), pad_width=[pad, pad])
+
+    rigid_params = {**RIGID_PARAMS, **preset.get("rigid", {})}
+    syn_params = {**SYN_PARAMS, **preset.get("syn", {})}
+
+    t0 = time.perf_counter()
+    rigid = rigid_stage(fixed, moving, preset.get("rigid_init", "phase"), 0.95, rigid_params)
+    t1 = time.perf_counter()
+    syn = syn_stage(fixed, rigid["warpedmovout"], syn_params, preset.get("syn_adaptive"))
+    t2 = time.perf_counter()
+
+    row = {
+        "preset": preset_name, "fixed": fixed_name, "moving": moving_name,
+        "pixels": int(np.prod(fixed.shape)),
+        "t_rigid": t1 - t0, "t_syn": t2 - t1, "t_total": t2 - t0,
+    }
+    row.update(pair_quality(fixed.numpy(), syn["warpedmovout"].numpy()))
+
+    warps = [tf for tf in syn["fwdtransforms"] if tf.endswith("Warp.nii.gz")]
+    if warps:
+        row.update(jacobian_stats(ants.image_read(warps[0]).numpy()))
+
+    for tf in set(rigid["fwdtransforms"] + syn["fwdtransforms"] + syn["invtransforms"]):
+        Path(tf).unlink(missing_ok=True)
+    return row
+
+
+def identity_row(source_path, fixed_name, moving_name):
+    # quality of the unregistered pair, as the floor of the report; scored on
+    # the common tissue ROI like the cropped presets (also makes slices of
+    # different raster sizes comparable)
+    source = open_slices(source_path)
+    roi = tissue_roi(source, [fixed_name, moving_name])
+    fixed_img = crop(normalize_gray(source.read(fixed_name)), roi)
+    moving_img = crop(normalize_gray(source.read(moving_name)), roi)
+    row = {"preset": "identity", "fixed": fixed_name, "moving": moving_name,
+           "pixels": fixed_img.size, "t_rigid": 0.0, "t_syn": 0.0, "t_total": 0.0}
+    row.update(pair_quality(fixed_img, moving_img))
+    return row
+
+
+# =========================
+# SWEEP
+# =========================
+def pick_pairs(names, n_pairs=8, bad_slices=BAD_SLICE_NAMES):
+    # evenly spaced (fixed, moving) neighbour pairs, fixed = next slice as in
+    # the backward chain
+    good = [n for n in names if n not in bad_slices]
+    candidates = list(zip(good[1:], good[:-1]))
+    if len(candidates) <= n_pairs:
+        return candidates
+    idx = np.linspace(0, len(candidates) - 1, n_pairs).round().astype(int)
+    return [candidates[i] for i in idx]
+
+
+def pareto_front(summary, cost="t_total", quality="ncc"):
+    # True where no other preset is at least as fast and at least as good
+    # (strictly better in one)
+    c = summary[cost].to_numpy()
+    q = summary[quality].to_numpy()
+    front = []
+    for i in range(len(summary)):
+        dominated = np.any((c <= c[i]) & (q >= q[i]) & ((c < c[i]) | (q > q[i])))
+        front.append(not dominated)
+    return np.array(front)
+
+
+def summarize(results):
+    summary = results.groupby("preset").agg(
+        t_total=("t_total", "median"),
+        t_rigid=("t_rigid", "median"),
+        t_syn=("t_syn", "median"),
+        ncc=("ncc", "mean"),
+        ncc_min=("ncc", "min"),
+        mi=("mi", "mean"),
+        fold_frac=("fold_frac", "max"),
+        jac_min=("jac_min", "min"),
+    ).reset_index()
+    # identity (no registration) is the quality floor, not a candidate
+    candidates = summary["preset"] != "identity"
+    summary["pareto"] = False
+    summary.loc[candidates, "pareto"] = pareto_front(summary[candidates])
+    return summary.sort_values("t_total").reset_index(drop=True)
+
+
+def run_benchmark(source, presets=PRESETS, n_pairs=8, bad_slices=BAD_SLICE_NAMES,
+                  workers=None, itk_threads=1, out_dir=None):
+    # source: path to a slice store / PNG folder (workers re-open it)
+    source = Path(source)
+    pairs = pick_pairs(open_slices(source).names, n_pairs, bad_slices)
+    print(f"Benchmarking {len(presets)} presets on {len(pairs)} slice pairs")
+
+    tasks = [(str(source), f, m, name, preset)
+             for name, preset in presets.items() for f, m in pairs]
+
+    workers = workers or max((os.cpu_count() or 1) // max(itk_threads, 1), 1)
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(itk_threads,)) as pool:
+        rows = list(pool.map(run_pair, *zip(*tasks)))
+
+    rows += [identity_row(str(source), f, m) for f, m in pairs]
+    results = pd.DataFrame(rows)
+    summary = summarize(results)
+
+    if out_dir is not None:
+        out_dir = Path(out_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        results.to_csv(out_dir / "benchmark_runs.csv", index=False)
+        summary.to_csv(out_dir / "benchmark_summary.csv", index=False)
+        save_pareto_plot(summary, out_dir / "benchmark_pareto.png")
+
+    return results, summary
+
+
+def save_pareto_plot(summary, path):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    plt.figure(figsize=(7, 5))
+    for _, row in summary.iterrows():
+        plt.scatter(row["t_total"], row["ncc"], c="tab:red" if row["pareto"] else "tab:gray")
+        plt.annotate(row["preset"], (row["t_total"], row["ncc"]), fontsize=8)
+    front = summary[summary["pareto"]].sort_values("t_total")
+    plt.plot(front["t_total"], front["ncc"], "r--", lw=1)
+    plt.xlabel("median time per slice pair (s)")
+    plt.ylabel("mean NCC vs neighbour")
+    plt.tight_layout()
+    plt.savefig(path)
+    plt.close()
+
+
+if __name__ == "__main__":
+    # =========================
+    # CONFIG
+    # =========================
+    INPUT_DIR = Path("data/slices_from_trimmed/130.889.slices")
+    OUT_DIR = Path("results_benchmark")
+
+    N_PAIRS = 8   # fixed slice subset, evenly spaced along the stack
+    ITK_THREADS = 1   # per worker; workers = cores / ITK_THREADS
+
+    results, summary = run_benchmark(
+        INPUT_DIR, PRESETS, N_PAIRS, BAD_SLICE_NAMES, itk_threads=ITK_THREADS, out_dir=OUT_DIR
+    )
+
+    print(summary.to_string(index=False, float_format=lambda v: f"{v:.4f}"))
+    print(f"\nPareto presets: {', '.join(summary.loc[summary['pareto'], 'preset'])}")
@@ -0,0 +1,328 @@
+import numpy as np
+from pathlib import Path
+from scipy import ndimage as ndi
+
+from preprocessing.slice_store import open_slices, slice_index
+from registration.transform_all import BAD_SLICE_INDICES
+from registration.transform_bundle import TransformBundle
+
+# =========================
+# POINT MAPPING
+# =========================
+# Batched point transforms between the spaces of one run, straight from the
+# transform bundles (no image re-warping):
+#
+#   raw     (row, col) pixel of a source MALDI slice
+#   volume  (z, row, col) voxel of the transform_all volumes; z follows the
+#           source slice order without the anchor, (row, col) the registered
+#           reference grid
+#   he      (row, col) pixel of the original H&E .tif paired with a slice
+#
+# Bundle chains are fixed → moving (warp, SyN affine, rigid): raw = chain(
+# registered point). The way back inverts the affines exactly and uses the
+# stored SyN inverse warp. Affines become 3×3 matrices and displacement fields
+# are sampled with linear map_coordinates; both are cached per slice, so a
+# call costs a few vectorized passes over the points whatever their number.
+# Points of imputed slices (bad or without transforms) map to NaN.
+
+
+# =========================
+# CHAIN PIECES
+# =========================
+def affine_matrix(entry):
+    # ITK AffineTransform: T(x) = M (x - c) + c + t, as a 3×3 matrix
+    if entry["type"] != "AffineTransform":
+        raise ValueError(f"Unsupported transform type {entry['type']}")
+
+    p = np.asarray(entry["parameters"], dtype=np.float64)
+    c = np.asarray(entry["fixed_parameters"], dtype=np.float64)
+    m = p[:4].reshape(2, 2)
+    h = np.eye(3)
+    h[:2, :2] = m
+    h[:2, 2] = c + p[4:6] - m @ c
+    return h
+
+
+def apply_matrix(h, points):
+    return points @ h[:2, :2].T + h[:2, 2]
+
+
+class FieldSampler:
+    # Linear interpolator of one displacement field in physical coordinates.
+    # Outside the field domain the displacement is zero, as in ITK.
+
+    def __init__(self, field, origin, spacing, direction):
+        self.components = np.ascontiguousarray(np.moveaxis(field, -1, 0), dtype=np.float32)
+        self.origin = np.asarray(origin, dtype=np.float64)
+        self.spacing = np.asarray(spacing, dtype=np.float64)
+        self.inv_direction = np.linalg.inv(np.reshape(direction, (2, 2)))
+        self.shape = np.asarray(field.shape[:2])
+
+    def __call__(self, points):
+        idx = ((points - self.origin) @ self.inv_direction.T / self.spacing).T
+        inside = np.all((idx >= -0.5) & (idx <= self.shape[:, None] - 0.5), axis=0)
+
+        disp = np.zeros_like(points)
+        if inside.any():
+            coords = np.clip(idx[:, inside], 0, self.shape[:, None] - 1)
+            for k, comp in enumerate(self.components):
+                disp[inside, k] = ndi.map_coordinates(comp, coords, order=1, mode="nearest")
+        return points + disp
+
+
+class ChainMapper:
+    # Forward (fixed → moving) and inverse point maps of every chain in a
+    # bundle; pieces are built on first use and kept
+
+    def __init__(self, bundle):
+        self.bundle = bundle if isinstance(bundle, TransformBundle) else TransformBundle(bundle)
+        self._pieces = {}
+
+    def __contains__(self, name):
+        return name in self.bundle
+
+    def pieces(self, name):
+        # (forward steps, inverse steps), each a list of point → point callables
+        name = Path(name).stem
+        if name not in self._pieces:
+            # the inverse is the forward chain reversed, each forward field
+            # replaced by its stored inverse warp (the k-th inverse field of
+            # the entry list belongs to the k-th forward field)
+            forward, backward, inverse_fields = [], [], []
+            for e in self.bundle.slices[name]:
+                if e["kind"] == "affine":
+                    h = affine_matrix(e)
+                    forward.append(lambda p, h=h: apply_matrix(h, p))
+                    backward.append(lambda p, h=np.linalg.inv(h): apply_matrix(h, p))
+                    continue
+
+                sampler = FieldSampler(self.bundle.field(e), e["origin"], e["spacing"],
+                                       e["direction"])
+                if e["inverse"]:
+                    inverse_fields.append(sampler)
+                else:
+                    forward.append(sampler)
+                    backward.append(None)
+
+            inverse = []
+            fields = iter(reversed(inverse_fields))
+            for step in reversed(backward):
+                inverse.append(next(fields, None) if step is None else step)
+            if None in inverse:
+                inverse = []   # no inverse warp stored for some field
+            self._pieces[name] = forward, inverse
+        return self._pieces[name]
+
+    def forward(self, name, points):
+        # registered / fixed physical points → moving (raw) points
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        for step in self.pieces(name)[0]:
+            points = step(points)
+        return points
+
+    def inverse(self, name, points):
+        # moving (raw) points → registered / fixed physical points
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        forward, inverse = self.pieces(name)
+        if len(forward) != len(inverse):
+            raise ValueError(f"{name}: no inverse warp stored in {self.bundle.path}")
+        for step in inverse:
+            points = step(points)
+        return points
+
+    def close(self):
+        self.bundle.close()
+
+
+# =========================
+# H&E PIXELS ↔ H&E MOVING SPACE
+# =========================
+# maldi_he_reg flips the H&E left-right and resizes it to the MALDI slice
+# (cv2, pixel centres aligned) before registering it to the registered slice
+def he_to_moving(points, he_meta):
+    h, w = he_meta["shape"]
+    th, tw = he_meta["target"]
+    r, c = np.asarray(points, dtype=np.float64).reshape(-1, 2).T
+    if he_meta.get("flip", True):
+        c = (w - 1) - c
+    return np.stack([(r + 0.5) * th / h - 0.5, (c + 0.5) * tw / w - 0.5], axis=1)
+
+
+def moving_to_he(points, he_meta):
+    h, w = he_meta["shape"]
+    th, tw = he_meta["target"]
+    r, c = np.asarray(points, dtype=np.float64).reshape(-1, 2).T
+    r = (r + 0.5) * h / th - 0.5
+    c = (c + 0.5) * w / tw - 0.5
+    if he_meta.get("flip", True):
+        c = (w - 1) - c
+    return np.stack([r, c], axis=1)
+
+
+# =========================
+# ALL SPACES OF A RUN
+# =========================
+class CoordinateMap:
+
+    def __init__(self, bundle_path, source, registered, reference_name,
+                 bad_indices=BAD_SLICE_INDICES, he_bundle_path=None):
+        # source: any raw channel (for the slice / z order), registered: the
+        # registered reference store (for the grid origin)
+        self.maldi = ChainMapper(bundle_path)
+        self.he = None if he_bundle_path is None else ChainMapper(he_bundle_path)
+
+        self.reference = Path(reference_name).stem
+        self.bad_indices = set(bad_indices)
+        self.volume_names = [n for n in open_slices(source).names if n != self.reference]
+        self._z = {n: z for z, n in enumerate(self.volume_names)}
+        self.origin = np.asarray(open_slices(registered).origin(self.reference), dtype=np.float64)
+
+    def _mapped(self, name):
+        # slices whose volume plane comes from their own transforms
+        name = Path(name).stem
+        if name == self.reference:
+            return True
+        return slice_index(name) not in self.bad_indices and name in self.maldi
+
+    # ---------------------------
+    # raw ↔ registered physical
+    # ---------------------------
+    def raw_to_physical(self, name, points):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        name = Path(name).stem
+        if name == self.reference:
+            return points.copy()
+        if not self._mapped(name):
+            return np.full_like(points, np.nan)
+        return self.maldi.inverse(name, points)
+
+    def physical_to_raw(self, name, points):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        name = Path(name).stem
+        if name == self.reference:
+            return points.copy()
+        if not self._mapped(name):
+            return np.full_like(points, np.nan)
+        return self.maldi.forward(name, points)
+
+    # ---------------------------
+    # raw ↔ volume
+    # ---------------------------
+    def raw_to_volume(self, name, points):
+        # (N, 2) raw pixels of one slice → (N, 3) voxels; z is NaN for the
+        # anchor, which is not a volume plane
+        rc = self.raw_to_physical(name, points) - self.origin
+        z = self._z.get(Path(name).stem, np.nan)
+        return np.column_stack([np.full(len(rc), z, dtype=np.float64), rc])
+
+    def volume_to_raw(self, voxels):
+        # (N, 3) voxels → (N, 2) raw pixels in slice volume_names[round(z)]
+        voxels = np.asarray(voxels, dtype=np.float64).reshape(-1, 3)
+        z = np.rint(voxels[:, 0]).astype(np.int64)
+        out = np.full((len(voxels), 2), np.nan)
+        for zi in np.unique(z):
+            if not 0 <= zi < len(self.volume_names):
+                continue
+            sel = z == zi
+            out[sel] = self.physical_to_raw(self.volume_names[zi], voxels[sel, 1:] + self.origin)
+        return out
+
+    # ---------------------------
+    # H&E ↔ registered / volume / raw
+    # ---------------------------
+    def _he_meta(self, name):
+        if self.he is None:
+            raise ValueError("No H&E transform bundle given")
+        name = Path(name).stem
+        meta = self.he.bundle.meta.get("he", {}).get(name)
+        if meta is None or name not in self.he:
+            raise KeyError(f"No H&E registration for {name}")
+        return name, meta
+
+    def he_to_physical(self, name, points):
+        # H&E is registered to the registered slice as a plain array, i.e.
+        # relative to its origin (the reference origin)
+        name, meta = self._he_meta(name)
+        return self.he.inverse(name, he_to_moving(points, meta)) + self.origin
+
+    def physical_to_he(self, name, points):
+        name, meta = self._he_meta(name)
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        return moving_to_he(self.he.forward(name, points - self.origin), meta)
+
+    def he_to_volume(self, name, points):
+        rc = self.he_to_physical(name, points) - self.origin
+        z = self._z.get(Path(name).stem, np.nan)
+        return np.column_stack([np.full(len(rc), z, dtype=np.float64), rc])
+
+    def volume_to_he(self, voxels):
+        voxels = np.asarray(voxels, dtype=np.float64).reshape(-1, 3)
+        z = np.rint(voxels[:, 0]).astype(np.int64)
+        out = np.full((len(voxels), 2), np.nan)
+        for zi in np.unique(z):
+            if not 0 <= zi < len(self.volume_names):
+                continue
+            name = self.volume_names[zi]
+            if self.he is None or name not in self.he:
+                continue
+            sel = z == zi
+            out[sel] = self.physical_to_he(name, voxels[sel, 1:] + self.origin)
+        return out
+
+    def he_to_raw(self, name, points):
+        return self.physical_to_raw(name, self.he_to_physical(name, points))
+
+    def raw_to_he(self, name, points):
+        return self.physical_to_he(name, self.raw_to_physical(name, points))
+
+    def close(self):
+        self.maldi.close()
+        if self.he is not None:
+            self.he.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def map_points_csv(mapper, in_csv, out_csv, direction, slice_name=None):
+    # direction: "raw_to_volume" / "volume_to_raw" / "he_to_volume" /
+    # "volume_to_he" / "he_to_raw" / "raw_to_he". Input columns: z,row,col
+    # for volume points, row,col otherwise (one slice_name for those)
+    import pandas as pd
+
+    df = pd.read_csv(in_csv)
+    src, dst = direction.split("_to_")
+    points = df[["z", "row", "col"] if src == "volume" else ["row", "col"]].to_numpy()
+
+    fn = getattr(mapper, direction)
+    mapped = fn(points) if src == "volume" else fn(slice_name, points)
+    cols = ["z", "row", "col"] if dst == "volume" else ["row", "col"]
+    out = pd.concat([df, pd.DataFrame(mapped, columns=[f"{dst}_{c}" for c in cols])], axis=1)
+    out.to_csv(out_csv, index=False)
+    return out
+
+
+if __name__ == "__main__":
+    # =========================
+    # CONFIG
+    # =========================
+    TRANSFORM_BUNDLE = Path("results_stable_clean/transforms.bundle")
+    HE_BUNDLE = Path("he_aligment/he_maldi_reg/he_transforms.bundle")   # None → MALDI only
+    SOURCE = Path("data/slices_from_trimmed/130.889.slices")
+    REGISTERED = Path("results_stable_clean/best.slices")
+    REFERENCE_SLICE_NAME = "slice_078.png"
+
+    # points: CSV with z,row,col (volume) or row,col (raw / H&E of SLICE)
+    POINTS_CSV = Path("annotations/points.csv")
+    OUT_CSV = Path("annotations/points_mapped.csv")
+    DIRECTION = "he_to_volume"
+    SLICE = "slice_040"
+
+    with CoordinateMap(TRANSFORM_BUNDLE, SOURCE, REGISTERED, REFERENCE_SLICE_NAME,
+                       he_bundle_path=HE_BUNDLE if HE_BUNDLE and HE_BUNDLE.exists() else None) as cmap:
+        out = map_points_csv(cmap, POINTS_CSV, OUT_CSV, DIRECTION, SLICE)
+
+    print(f"✅ Mapped {len(out)} points ({DIRECTION}) → {OUT_CSV}")
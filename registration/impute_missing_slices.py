@@ -1,40 +1,48 @@
-import cv2
-from pathlib import Path
 import shutil
-
-# =====================================================
-# CONFIG
-# =====================================================
-INPUT_DIR = Path("results_stable_clean/best")
-OUTPUT_DIR = Path("data/results_stable_clean_imputed")
-OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
+from pathlib import Path
 
 BAD_SLICE_INDICES = [8, 26, 44, 62]
 
+
 # =====================================================
-# STEP 1: COPY ALL EXISTING SLICES
+# COPY PREVIOUS SLICE FOR MISSING ONES
 # =====================================================
+def impute_missing_slices(input_dir, output_dir, bad_indices=BAD_SLICE_INDICES):
+    input_dir, output_dir = Path(input_dir), Path(output_dir)
+    output_dir.mkdir(exist_ok=True, parents=True)
 
-for file in sorted(INPUT_DIR.glob("slice_*.png")):
-    shutil.copy(file, OUTPUT_DIR / file.name)
+    # STEP 1: copy all existing slices
+    for file in sorted(input_dir.glob("slice_*.png")):
+        shutil.copy(file, output_dir / file.name)
 
-print("Existing slices copied.")
+    print("Existing slices copied.")
 
-# =====================================================
-# STEP 2: COPY PREVIOUS SLICE FOR MISSING ONES
-# =====================================================
+    # STEP 2: copy previous slice for missing ones
+    created = []
+    for idx in bad_indices:
+
+        prev_path = input_dir / f"slice_{idx-1:03d}.png"
+        new_path  = output_dir / f"slice_{idx:03d}.png"
+
+        if not prev_path.exists():
+            print(f"⚠ Cannot create slice_{idx:03d}, previous slice missing")
+            continue
+
+        print(f"Creating slice_{idx:03d} by copying slice_{idx-1:03d}")
 
-for idx in BAD_SLICE_INDICES:
+        shutil.copy(prev_path, new_path)
+        created.append(new_path)
 
-    prev_path = INPUT_DIR / f"slice_{idx-1:03d}.png"
-    new_path  = OUTPUT_DIR / f"slice_{idx:03d}.png"
+    return created
 
-    if not prev_path.exists():
-        print(f"⚠ Cannot create slice_{idx:03d}, previous slice missing")
-        continue
 
-    print(f"Creating slice_{idx:03d} by copying slice_{idx-1:03d}")
+if __name__ == "__main__":
+    # =====================================================
+    # CONFIG
+    # =====================================================
+    INPUT_DIR = Path("results_stable_clean/best")
+    OUTPUT_DIR = Path("data/results_stable_clean_imputed")
 
-    shutil.copy(prev_path, new_path)
+    impute_missing_slices(INPUT_DIR, OUTPUT_DIR, BAD_SLICE_INDICES)
 
-print("Missing slices filled by copying previous slice.")
+    print("Missing slices filled by copying previous slice.")
@@ -1,55 +1,64 @@
 import numpy as np
-import SimpleITK as sitk
 from scipy.ndimage import zoom, gaussian_filter
 
+
 # =========================
-# CONFIG
+# Z-UPSAMPLING
 # =========================
-IN_NII = "results/volume_registered.nii.gz"
-OUT_NII = "results/volume_registered_imputed.nii.gz"
+def upsample_z(vol, upsample_factor=2, z_smooth_sigma=0.5):
+    # upsample_factor=2 inserts 1 slice between each pair; light smoothing
+    # along Z only
+    vol = gaussian_filter(vol, sigma=(z_smooth_sigma, 0, 0))
 
-UPSAMPLE_FACTOR = 2   # inserts 1 slice between each pair
-Z_SMOOTH_SIGMA = 0.5  # light smoothing along Z only
+    # correct Z-interpolation: keep first and last slice in place
+    Z = vol.shape[0]
+    new_Z = upsample_factor * (Z - 1) + 1
 
-# =========================
-# LOAD VOLUME
-# =========================
-img = sitk.ReadImage(IN_NII)
-vol = sitk.GetArrayFromImage(img)   # (Z, Y, X)
+    zoom_factor = new_Z / Z
 
-print("Original shape:", vol.shape)
+    return zoom(
+        vol,
+        zoom=(zoom_factor, 1, 1),
+        order=1          # linear in Z
+    )
 
-# =========================
-# OPTIONAL: LIGHT Z-SMOOTHING
-# =========================
-vol = gaussian_filter(vol, sigma=(Z_SMOOTH_SIGMA, 0, 0))
 
-# =========================
-# CORRECT Z-INTERPOLATION
-# =========================
-Z = vol.shape[0]
-new_Z = UPSAMPLE_FACTOR * (Z - 1) + 1
+def impute_zvolume(in_nii, out_nii, upsample_factor=2, z_smooth_sigma=0.5):
+    import SimpleITK as sitk
 
-zoom_factor = new_Z / Z
+    img = sitk.ReadImage(in_nii)
+    vol = sitk.GetArrayFromImage(img)   # (Z, Y, X)
 
-vol_interp = zoom(
-    vol,
-    zoom=(zoom_factor, 1, 1),
-    order=1          # linear in Z
-)
+    print("Original shape:", vol.shape)
 
-print("Imputed shape:", vol_interp.shape)
+    vol_interp = upsample_z(vol, upsample_factor, z_smooth_sigma)
+
+    print("Imputed shape:", vol_interp.shape)
+
+    # =========================
+    # SAVE WITH CORRECT SPACING
+    # =========================
+    out_img = sitk.GetImageFromArray(vol_interp)
+
+    sx, sy, sz = img.GetSpacing()
+    out_img.SetSpacing((sx, sy, sz / upsample_factor))
+    out_img.SetOrigin(img.GetOrigin())
+    out_img.SetDirection(img.GetDirection())
+
+    sitk.WriteImage(out_img, out_nii)
+
+    print("Saved:", out_nii)
+    return vol_interp
 
-# =========================
-# SAVE WITH CORRECT SPACING
-# =========================
-out_img = sitk.GetImageFromArray(vol_interp)
 
-sx, sy, sz = img.GetSpacing()
-out_img.SetSpacing((sx, sy, sz / UPSAMPLE_FACTOR))
-out_img.SetOrigin(img.GetOrigin())
-out_img.SetDirection(img.GetDirection())
+if __name__ == "__main__":
+    # =========================
+    # CONFIG
+    # =========================
+    IN_NII = "results/volume_registered.nii.gz"
+    OUT_NII = "results/volume_registered_imputed.nii.gz"
 
-sitk.WriteImage(out_img, OUT_NII)
+    UPSAMPLE_FACTOR = 2   # inserts 1 slice between each pair
+    Z_SMOOTH_SIGMA = 0.5  # light smoothing along Z only
 
-print("Saved:", OUT_NII)
+    impute_zvolume(IN_NII, OUT_NII, UPSAMPLE_FACTOR, Z_SMOOTH_SIGMA)
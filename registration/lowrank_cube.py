@@ -0,0 +1,303 @@
+import json
+import shutil
+import numpy as np
+from pathlib import Path
+
+from preprocessing.channel_stats import volume_files
+from preprocessing.prefetch import prefetch
+
+# =========================
+# LOW-RANK m/z DATACUBE
+# =========================
+# The registered volumes of all channels form one voxels × channels matrix X
+# (N = Z·H·W rows, C columns) that is close to low rank. A randomized PCA,
+# X ≈ mean + scores · loadingsᵀ, is fitted out of core: volumes are streamed
+# `batch` channels at a time and the N × (rank + oversample) range basis
+# lives in a memmap, so memory stays at one batch of volumes plus one voxel
+# block. Each power iteration costs two more passes over the volumes, plus
+# one final pass for the per-channel reconstruction error.
+#
+# One directory per cube (e.g. data/volumes_new.lowrank):
+#
+#   scores.npy     (N, rank) float32: spatial components, singular values folded in
+#   loadings.npy   (C, rank) float32: orthonormal spectral components
+#   mean.npy       (C,) channel means
+#   meta.json      channels, volume shape, spacing, singular values,
+#                  per-channel relative error
+#
+# Any channel is reconstructed on demand (N × rank work instead of a volume
+# read), and spectra / similarity queries run on the rank-dimensional scores.
+# Storage is (N + C) · rank floats instead of N · C.
+CUBE_SUFFIX = ".lowrank"
+META_NAME = "meta.json"
+RANK = 32
+OVERSAMPLE = 8
+POWER_ITERATIONS = 1
+BATCH = 16
+BLOCK = 1 << 18
+
+
+def _blocks(n, block=BLOCK):
+    for a in range(0, n, block):
+        yield slice(a, min(a + block, n))
+
+
+def read_volume(path):
+    import SimpleITK as sitk
+
+    img = sitk.ReadImage(str(path))
+    return sitk.GetArrayFromImage(img).astype(np.float32), img.GetSpacing()
+
+
+def volume_channels(volume_dir):
+    # name → path of every <mz>.nii / <mz>.nii.gz in a folder (transform_all output)
+    return volume_files(volume_dir)
+
+
+def _load(value):
+    if isinstance(value, (str, Path)):
+        return read_volume(value)
+    return np.asarray(value, dtype=np.float32), None
+
+
+def _batches(channels, batch):
+    # (channel indices, (N, b) matrix) per batch; volumes decoded in threads
+    names = list(channels)
+    for a in range(0, len(names), batch):
+        idx = list(range(a, min(a + batch, len(names))))
+        loaded = [vol for _, (vol, _) in prefetch(lambda i: _load(channels[names[i]]), idx)]
+        yield idx, np.stack([vol.ravel() for vol in loaded], axis=1)
+
+
+# =========================
+# OUT-OF-CORE LINEAR ALGEBRA
+# =========================
+def _orthonormalize(Y, block=BLOCK):
+    # in-place Q = Y W Λ^-1/2 from the Gram matrix, twice for accuracy
+    for _ in range(2):
+        G = np.zeros((Y.shape[1],) * 2)
+        for s in _blocks(len(Y), block):
+            y = np.asarray(Y[s], dtype=np.float64)
+            G += y.T @ y
+        lam, W = np.linalg.eigh(G)
+        T = W / np.sqrt(np.maximum(lam, lam.max() * 1e-12))
+        for s in _blocks(len(Y), block):
+            Y[s] = Y[s] @ T
+    return Y
+
+
+def _project(channels, Q, mean, batch, block=BLOCK):
+    # B = Qᵀ (X − mean), one column per channel
+    q_sum = np.zeros(Q.shape[1])
+    for s in _blocks(len(Q), block):
+        q_sum += np.asarray(Q[s], dtype=np.float64).sum(axis=0)
+
+    B = np.zeros((Q.shape[1], len(channels)))
+    for idx, X in _batches(channels, batch):
+        for s in _blocks(len(Q), block):
+            B[:, idx] += np.asarray(Q[s], dtype=np.float64).T @ X[s]
+        B[:, idx] -= np.outer(q_sum, mean[idx])
+    return B
+
+
+def _range(channels, Y, mean, omega, batch, block=BLOCK):
+    # Y = (X − mean) Ω
+    Y[:] = 0
+    for idx, X in _batches(channels, batch):
+        for s in _blocks(len(Y), block):
+            Y[s] += X[s] @ omega[idx]
+    shift = (mean @ omega).astype(np.float32)
+    for s in _blocks(len(Y), block):
+        Y[s] -= shift
+    return Y
+
+
+# =========================
+# FIT
+# =========================
+def compress_cube(channels, out_path, rank=RANK, target_error=None, oversample=OVERSAMPLE,
+                  power_iterations=POWER_ITERATIONS, batch=BATCH, seed=0):
+    # channels: name → volume path or (Z, H, W) array (e.g. run_pipeline
+    # volumes), all the same shape. target_error picks the smallest rank ≤
+    # `rank` whose overall relative error is below it. Returns a LowRankCube.
+    names = list(channels)
+    first, spacing = _load(channels[names[0]])
+    shape = first.shape
+    n, c = first.size, len(names)
+    width = min(rank + oversample, c)
+    del first
+
+    out_path = Path(out_path)
+    if out_path.exists():
+        shutil.rmtree(out_path)
+    out_path.mkdir(parents=True)
+
+    # pass 1: channel means / norms, then the range of (X − mean) Ω
+    mean = np.zeros(c)
+    sq_norm = np.zeros(c)
+    print(f"🔹 Statistics over {c} channels ({n:,} voxels)")
+    for idx, X in _batches(channels, batch):
+        if X.shape[0] != n:
+            raise ValueError(f"{names[idx[0]]}...: volume shape differs from {shape}")
+        mean[idx] = X.mean(axis=0, dtype=np.float64)
+        sq_norm[idx] = np.einsum("ij,ij->j", X, X, dtype=np.float64)
+
+    omega = np.random.default_rng(seed).standard_normal((c, width)).astype(np.float32)
+    Y = np.lib.format.open_memmap(out_path / "basis.tmp.npy", mode="w+", dtype=np.float32,
+                                  shape=(n, width))
+    print("🔹 Range finder")
+    _orthonormalize(_range(channels, Y, mean, omega, batch))
+    for i in range(power_iterations):
+        print(f"🔹 Power iteration {i + 1}/{power_iterations}")
+        B = _project(channels, Y, mean, batch)
+        _orthonormalize(_range(channels, Y, mean, B.T.astype(np.float32), batch))
+
+    B = _project(channels, Y, mean, batch)
+    U, sigma, Vt = np.linalg.svd(B, full_matrices=False)
+
+    # overall relative error of a rank-k fit from the singular values
+    centered = sq_norm - n * mean ** 2
+    residual = np.maximum(centered.sum() - np.cumsum(sigma ** 2), 0)
+    errors = np.sqrt(residual / max(sq_norm.sum(), 1e-30))
+    k = min(rank, len(sigma))
+    if target_error is not None:
+        k = min(int(np.searchsorted(-errors, -target_error)) + 1, k)
+
+    scores = np.lib.format.open_memmap(out_path / "scores.npy", mode="w+", dtype=np.float32,
+                                       shape=(n, k))
+    T = (U[:, :k] * sigma[:k]).astype(np.float32)
+    for s in _blocks(n):
+        scores[s] = Y[s] @ T
+    scores.flush()
+    del Y
+    (out_path / "basis.tmp.npy").unlink()
+
+    loadings = Vt[:k].T.astype(np.float32)
+    np.save(out_path / "loadings.npy", loadings)
+    np.save(out_path / "mean.npy", mean.astype(np.float32))
+
+    # last pass: exact per-channel error of the stored fit
+    res = np.zeros(c)
+    for idx, X in _batches(channels, batch):
+        for s in _blocks(n):
+            approx = scores[s] @ loadings[idx].T + mean[idx].astype(np.float32)
+            res[idx] += ((X[s] - approx) ** 2).sum(axis=0, dtype=np.float64)
+    channel_error = np.sqrt(res / np.maximum(sq_norm, 1e-30))
+
+    meta = {
+        "channels": names,
+        "shape": list(shape),
+        "spacing": None if spacing is None else list(spacing),
+        "rank": k,
+        "singular_values": sigma[:k].tolist(),
+        "error": float(np.sqrt(res.sum() / max(sq_norm.sum(), 1e-30))),
+        "channel_error": dict(zip(names, channel_error.tolist())),
+    }
+    with open(out_path / META_NAME, "w") as f:
+        json.dump(meta, f, indent=1)
+
+    ratio = n * c / ((n + c) * k)
+    print(f"✔ rank {k}: relative error {meta['error']:.4f} overall, "
+          f"{channel_error.max():.4f} worst channel, {ratio:.1f}× smaller")
+    return LowRankCube(out_path)
+
+
+# =========================
+# READ / QUERY
+# =========================
+class LowRankCube:
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path / META_NAME) as f:
+            self.meta = json.load(f)
+        self.channels = self.meta["channels"]
+        self.shape = tuple(self.meta["shape"])
+        self.scores = np.load(self.path / "scores.npy", mmap_mode="r")
+        self.loadings = np.load(self.path / "loadings.npy")
+        self.mean = np.load(self.path / "mean.npy")
+        self._index = {name: i for i, name in enumerate(self.channels)}
+
+    @property
+    def rank(self):
+        return self.meta["rank"]
+
+    def error(self, name=None):
+        # relative reconstruction error (‖x − x̂‖ / ‖x‖) of one channel or overall
+        return self.meta["error"] if name is None else self.meta["channel_error"][name]
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __len__(self):
+        return len(self.channels)
+
+    # ---------------------------
+    # reconstruction
+    # ---------------------------
+    def channel(self, name):
+        i = self._index[name]
+        vol = np.empty(len(self.scores), dtype=np.float32)
+        for s in _blocks(len(vol)):
+            vol[s] = self.scores[s] @ self.loadings[i] + self.mean[i]
+        return vol.reshape(self.shape)
+
+    def write_channel(self, name, out_path):
+        from registration.transform_all import write_volume
+
+        spacing = self.meta["spacing"] or (1.0, 1.0, 1.0)
+        return write_volume(self.channel(name), out_path, tuple(spacing))
+
+    def spectrum(self, z, y, x):
+        v = np.ravel_multi_index((z, y, x), self.shape)
+        return self.loadings @ self.scores[v] + self.mean
+
+    # ---------------------------
+    # reduced-space queries
+    # ---------------------------
+    def project(self, spectrum):
+        # spectrum (C,) → rank coordinates
+        return self.loadings.T @ (np.asarray(spectrum, dtype=np.float32) - self.mean)
+
+    def similar_channels(self, name, top=10):
+        # [(channel, Pearson r)] from the loadings scaled by the singular values
+        emb = self.loadings * np.asarray(self.meta["singular_values"], dtype=np.float32)
+        emb = emb / np.maximum(np.linalg.norm(emb, axis=1, keepdims=True), 1e-12)
+        r = emb @ emb[self._index[name]]
+        order = [i for i in np.argsort(-r) if i != self._index[name]][:top]
+        return [(self.channels[i], float(r[i])) for i in order]
+
+    def similarity_map(self, spectrum):
+        # cosine similarity of every voxel's spectrum to `spectrum`, as a
+        # volume; spectra are mean + loadings · score, so
+        # ⟨a, b⟩ = |mean|² + meanᵀV(sa + sb) + sa·sb
+        q = self.project(spectrum)
+        m = float(self.mean @ self.mean)
+        a = self.loadings.T @ self.mean
+        q_norm = np.sqrt(m + 2 * a @ q + q @ q)
+
+        out = np.empty(len(self.scores), dtype=np.float32)
+        for s in _blocks(len(out)):
+            sv = np.asarray(self.scores[s])
+            dot = m + sv @ a + a @ q + sv @ q
+            norm = np.sqrt(np.maximum(m + 2 * sv @ a + np.einsum("ij,ij->i", sv, sv), 1e-30))
+            out[s] = dot / (norm * max(q_norm, 1e-15))
+        return out.reshape(self.shape)
+
+
+if __name__ == "__main__":
+    # =========================
+    # CONFIG
+    # =========================
+    VOLUME_DIR = Path("data/volumes_new")
+    OUT = VOLUME_DIR.with_suffix(CUBE_SUFFIX)
+
+    # rank cap; TARGET_ERROR (e.g. 0.05) picks the smallest rank meeting it
+    RANK = 32
+    TARGET_ERROR = None
+
+    cube = compress_cube(volume_channels(VOLUME_DIR), OUT, RANK, TARGET_ERROR)
+
+    worst = sorted(cube.meta["channel_error"].items(), key=lambda kv: -kv[1])[:5]
+    for name, err in worst:
+        print(f"  {name}: {err:.4f}")
@@ -1,125 +1,375 @@
-import ants
+import os
+import tempfile
 import numpy as np
-import cv2
 from pathlib import Path
 from tqdm import tqdm
 
+from preprocessing.prefetch import AsyncWriter, prefetch, prefetch_slices
+from preprocessing.slice_store import MemorySlices, export_png, open_slices
+from registration.adaptive_syn import ADAPTIVE_SYN, adaptive_syn_stage
+from registration.phase_init import phase_correlation_init
+from registration.registration_cache import open_cache, release
+from registration.tissue_crop import common_roi, crop, crop_to_ants, tissue_bbox
+from registration.transform_bundle import TransformBundle
+
+BAD_SLICE_NAMES = {"slice_008", "slice_026", "slice_044", "slice_062"}
+
+RIGID_PARAMS = dict(
+    type_of_transform="Rigid",
+    aff_metric="MI",
+    reg_iterations=(40, 20, 0),
+    shrink_factors=(2, 1),
+    smoothing_sigmas=(1, 0),
+    grad_step=0.05,
+    verbose=False
+)
+
+SYN_PARAMS = dict(
+    type_of_transform="SyN",
+    syn_metric="CC",
+    reg_iterations=(20, 10, 0),
+    shrink_factors=(2, 1),
+    smoothing_sigmas=(1, 0),
+    grad_step=0.04,
+    verbose=False
+)
+
+
 # =========================
-# CONFIG
+# HELPERS
 # =========================
-INPUT_DIR = Path("data/grayscale_slices")
-OUTPUT_DIR = Path("results_stablee/best")
-TRANSFORM_DIR = Path("results_stablee/transforms")
+def normalize_gray(img):
+    img = np.asarray(img, dtype=np.float32)
+    return (img - img.min()) / (img.max() - img.min() + 1e-8)
 
-OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
-TRANSFORM_DIR.mkdir(exist_ok=True, parents=True)
 
-BAD_SLICE_NAMES = {"slice_008", "slice_026", "slice_044", "slice_062"}
+def tissue_roi(source, names, margin_frac=0.1, min_margin=8):
+    boxes = [box for _, box in prefetch(lambda n: tissue_bbox(normalize_gray(source.read(n))), names)]
+    return common_roi(boxes, margin_frac, min_margin)
+
 
 # =========================
-# HELPERS
+# STAGE 1: RIGID
 # =========================
-def load_gray(path):
-    img = cv2.imread(str(path), cv2.IMREAD_GRAYSCALE).astype(np.float32)
-    img = (img - img.min()) / (img.max() - img.min() + 1e-8)
-    return img
+def rigid_stage(prev, moving, rigid_init="phase", init_accept_ncc=0.95, params=RIGID_PARAMS,
+                cache=None, init_transform=None):
+    # rigid_init: None → identity (legacy), "phase" → FFT phase-correlation
+    # initial transform, "phase_accept" → additionally skip the ANTs Rigid
+    # stage when the initializer's NCC against prev is ≥ init_accept_ncc.
+    # init_transform: a transform file (e.g. PreviewInit.rigid) used as the
+    # start instead of rigid_init; it is deleted afterwards.
+    # cache: RegistrationCache, checked before registering
+    import ants
+
+    if cache is not None:
+        key_params = dict(rigid_init=rigid_init, init_accept_ncc=init_accept_ncc, params=params)
+        images = [prev, moving]
+        if init_transform is not None:
+            images.append(np.fromfile(init_transform, dtype=np.uint8))
+        result = cache.call("rigid", key_params, images,
+                            lambda: rigid_stage(prev, moving, rigid_init, init_accept_ncc, params,
+                                                init_transform=init_transform))
+        if init_transform is not None:
+            Path(init_transform).unlink(missing_ok=True)
+        return result
+
+    init = None
+    if init_transform is not None:
+        init = {"transform": init_transform, "confidence": -1.0}
+    elif rigid_init is not None:
+        init = phase_correlation_init(prev, moving)
+
+    if rigid_init == "phase_accept" and init["confidence"] >= init_accept_ncc:
+        return {
+            "warpedmovout": ants.apply_transforms(
+                fixed=prev,
+                moving=moving,
+                transformlist=[init["transform"]],
+                interpolator="linear"
+            ),
+            "fwdtransforms": [init["transform"]],
+        }
+
+    rigid = ants.registration(
+        fixed=prev,
+        moving=moving,
+        initial_transform=None if init is None else [init["transform"]],
+        **params
+    )
+    if init is not None:
+        Path(init["transform"]).unlink(missing_ok=True)
+    return rigid
 
-def save_uint8(img, path):
-    cv2.imwrite(str(path), (np.clip(img, 0, 1) * 255).astype(np.uint8))
 
 # =========================
-# LOAD SLICES
+# STAGE 2: SyN
 # =========================
-slice_paths = sorted(INPUT_DIR.glob("slice_*.png"))
-n = len(slice_paths)
+def syn_stage(prev, moving, params=SYN_PARAMS, adaptive=None, init_field=None, cache=None):
+    # adaptive: None → the fixed reg_iterations schedule; a dict such as
+    # ADAPTIVE_SYN → per-level early stopping (see adaptive_syn), optionally
+    # warm-started from init_field
+    import ants
 
-if n < 2:
-    raise RuntimeError("Not enough slices found")
+    if cache is not None:
+        return cache.call("syn", dict(params=params, adaptive=adaptive), [prev, moving, init_field],
+                          lambda: syn_stage(prev, moving, params, adaptive, init_field))
+    if adaptive is not None:
+        return adaptive_syn_stage(prev, moving, params, init_field=init_field, **adaptive)
+    return ants.registration(fixed=prev, moving=moving, **params)
 
-print(f"Found {n} slices")
 
 # =========================
-# GLOBAL ANCHOR = LAST SLICE
+# SAVE TRANSFORMS
 # =========================
-anchor_idx = n - 1
-anchor_path = slice_paths[anchor_idx]
+def store_transforms(bundle, name, rigid, syn, field_mode="full", field_factor=4,
+                     field_tolerance=0.5, loose_dir=None):
+    # bundle order = ants.apply_transforms order: warp, SyN affine, rigid;
+    # the inverse warp is kept for point mapping
+    inverse_warps = [tf for tf in syn["invtransforms"] if tf.endswith("InverseWarp.nii.gz")]
+    bundle.add(
+        name,
+        syn["fwdtransforms"] + inverse_warps + rigid["fwdtransforms"],
+        field_mode=field_mode,
+        factor=field_factor,
+        tolerance=field_tolerance,
+    )
 
-print(f"Global anchor slice: {anchor_path.name} (index {anchor_idx})")
+    slice_tf_dir = None
+    if loose_dir is not None:
+        slice_tf_dir = Path(loose_dir) / name
+        slice_tf_dir.mkdir(exist_ok=True, parents=True)
 
-anchor_img = load_gray(anchor_path)
-anchor_ants = ants.from_numpy(anchor_img)
-anchor_ants = ants.pad_image(anchor_ants, pad_width=[80, 80])
+    for tf in set(rigid["fwdtransforms"] + syn["fwdtransforms"] + inverse_warps):
+        tf_path = Path(tf)
+        if slice_tf_dir is not None and "InverseWarp" not in tf_path.name:
+            tf_path.rename(slice_tf_dir / tf_path.name)
+        else:
+            tf_path.unlink(missing_ok=True)
+    release(rigid, syn)
 
-save_uint8(anchor_img, OUTPUT_DIR / anchor_path.name)
 
 # =========================
 # BACKWARD SEQUENTIAL REGISTRATION
 # Rigid → SyN
 # =========================
-prev = anchor_ants
+def register_stack(source, bundle_path=None, out_store=None, png_dir=None,
+                   bad_slices=BAD_SLICE_NAMES, rigid_init="phase", init_accept_ncc=0.95,
+                   crop_to_tissue=True, crop_margin_frac=0.1, crop_min_margin=8, pad=80,
+                   field_mode="full", field_factor=4, field_tolerance=0.5,
+                   loose_dir=None, rigid_params=RIGID_PARAMS, syn_params=SYN_PARAMS,
+                   syn_adaptive=None, warm_start=False, cache=None, preview_init=None):
+    # source: SliceStore / PngSlices / MemorySlices or a path to one.
+    # Returns (registered MemorySlices, bundle path). out_store / png_dir are
+    # optional on-disk copies of the registered slices. syn_adaptive (e.g.
+    # ADAPTIVE_SYN) switches SyN to early stopping; warm_start then starts
+    # each slice from the previous slice's deformation. Iterations used per
+    # slice are kept in the bundle meta ("syn_iterations"). cache: a
+    # RegistrationCache or its directory; unchanged slice pairs are not
+    # registered again. preview_init (registration.preview_init.PreviewInit)
+    # starts every slice from a preview run's transforms instead.
+    import ants
 
-for i in tqdm(range(anchor_idx - 1, -1, -1), desc="Registering backward"):
+    source = open_slices(source)
+    slice_names = source.names
+    n = len(slice_names)
 
-    slice_name = slice_paths[i].stem
+    if n < 2:
+        raise RuntimeError("Not enough slices found")
 
-    # 🚫 Skip bad slices
-    if slice_name in BAD_SLICE_NAMES:
-        print(f"⚠️ Skipping bad slice: {slice_paths[i].name}")
-        continue
+    print(f"Found {n} slices")
+    cache = open_cache(cache)
+    if warm_start and syn_adaptive is None:
+        print("⚠️ warm_start needs syn_adaptive (the fixed SyN schedule cannot start "
+              "from a field); ignoring it")
+        warm_start = False
 
-    img = load_gray(slice_paths[i])
-    moving = ants.from_numpy(img)
+    if bundle_path is None:
+        fd, bundle_path = tempfile.mkstemp(suffix=".bundle")
+        os.close(fd)
+    bundle = TransformBundle(bundle_path, mode="w")
+    bundle.meta.update(field_mode=field_mode, field_factor=field_factor)
 
-    # =========================
-    # STAGE 1: RIGID
-    # =========================
-    rigid = ants.registration(
-        fixed=prev,
-        moving=moving,
-        type_of_transform="Rigid",
-        aff_metric="MI",
-        reg_iterations=(40, 20, 0),
-        shrink_factors=(2, 1),
-        smoothing_sigmas=(1, 0),
-        grad_step=0.05,
-        verbose=False
-    )
+    registered = MemorySlices()
 
     # =========================
-    # STAGE 2: SyN (NO affine)
+    # TISSUE ROI
     # =========================
-    syn = ants.registration(
-        fixed=prev,
-        moving=rigid["warpedmovout"],
-        type_of_transform="SyN",
-        syn_metric="CC",
-        reg_iterations=(20, 10, 0),
-        shrink_factors=(2, 1),
-        smoothing_sigmas=(1, 0),
-        grad_step=0.04,
-        verbose=False
-    )
+    # Register on a common tissue ROI (union of per-slice tissue boxes +
+    # adaptive margin) instead of the full raster padded by `pad` pixels.
+    roi = None
+    if crop_to_tissue:
+        roi = tissue_roi(
+            source,
+            [name for name in slice_names if name not in bad_slices],
+            crop_margin_frac,
+            crop_min_margin,
+        )
+        print(f"Tissue ROI (rows {roi[0]}:{roi[2]}, cols {roi[1]}:{roi[3]})")
 
-    warped = syn["warpedmovout"].numpy()
+    def to_ants(img):
+        if roi is None:
+            return ants.from_numpy(img)
+        return crop_to_ants(img, roi)
 
     # =========================
-    # SAVE TRANSFORMS
+    # GLOBAL ANCHOR = LAST SLICE
     # =========================
-    slice_tf_dir = TRANSFORM_DIR / slice_name
-    slice_tf_dir.mkdir(exist_ok=True)
+    anchor_idx = n - 1
+    anchor_name = slice_names[anchor_idx]
 
-    for tf in rigid["fwdtransforms"] + syn["fwdtransforms"]:
-        tf_path = Path(tf)
-        tf_path.rename(slice_tf_dir / tf_path.name)
+    print(f"Global anchor slice: {anchor_name} (index {anchor_idx})")
+
+    anchor_img = normalize_gray(source.read(anchor_name))
+    if roi is None:
+        anchor_ants = ants.pad_image(ants.from_numpy(anchor_img), pad_width=[pad, pad])
+        registered.write(anchor_name, anchor_img)
+    else:
+        anchor_ants = to_ants(anchor_img)
+        registered.write(anchor_name, crop(anchor_img, roi), origin=anchor_ants.origin)
+
+    prev = anchor_ants
+    prev_field = None
+    if syn_adaptive is not None:
+        bundle.meta["syn_iterations"] = {}
+
+    # next slices are read + normalized in the background while one registers
+    backward = [slice_names[i] for i in range(anchor_idx - 1, -1, -1)]
+    loaded = prefetch_slices(source, [n for n in backward if n not in bad_slices], normalize_gray)
+
+    for slice_name in tqdm(backward, desc="Registering backward"):
+
+        # 🚫 Skip bad slices
+        if slice_name in bad_slices:
+            print(f"⚠️ Skipping bad slice: {slice_name}")
+            continue
+
+        _, moving_img = next(loaded)
+        moving = to_ants(moving_img)
+
+        init_transform = init_field = None
+        if warm_start:
+            init_field = prev_field
+        if preview_init is not None:
+            init_transform = preview_init.rigid(slice_name)
+            if syn_adaptive is not None:
+                init_field = preview_init.field(slice_name, prev)
+
+        rigid = rigid_stage(prev, moving, rigid_init, init_accept_ncc, rigid_params, cache,
+                            init_transform)
+        syn = syn_stage(prev, rigid["warpedmovout"], syn_params, syn_adaptive, init_field, cache)
+
+        if syn_adaptive is not None:
+            print(f"  SyN {slice_name}: {'x'.join(map(str, syn['iterations']))} of "
+                  f"{'x'.join(map(str, syn['budget']))} iterations ({syn['start']} start, "
+                  f"NCC {syn['cc']:.4f})")
+            bundle.meta["syn_iterations"][slice_name] = syn["iterations"]
+            prev_field = syn["field"]
+
+        warped = syn["warpedmovout"].numpy()
+
+        store_transforms(
+            bundle, slice_name, rigid, syn,
+            field_mode, field_factor, field_tolerance, loose_dir
+        )
+
+        registered.write(slice_name, warped, origin=prev.origin)
+
+        # Update prev with stable warped result (same grid and origin as prev)
+        prev = ants.from_numpy(warped, origin=prev.origin)
+
+    if syn_adaptive is not None and bundle.meta["syn_iterations"]:
+        used = np.array(list(bundle.meta["syn_iterations"].values())).sum(axis=1)
+        print(f"Adaptive SyN: {used.mean():.1f} iterations per slice on average "
+              f"(fixed schedule: {sum(syn_params['reg_iterations'])})")
+
+    if cache is not None:
+        print(f"Registration cache: {cache.hits} hits, {cache.misses} misses "
+              f"({cache.size() / 2**20:.0f} MiB in {cache.root})")
+
+    bundle.close()
+
+    if out_store is not None:
+        registered.save(out_store)
+    if png_dir is not None:
+        Path(png_dir).mkdir(exist_ok=True, parents=True)
+        with AsyncWriter() as writer:
+            for name in registered.names:
+                writer.submit(export_png, registered.read(name), Path(png_dir) / f"{name}.png")
+
+    return registered, Path(bundle_path)
+
+
+if __name__ == "__main__":
+    from registration.preview_init import PreviewInit
 
     # =========================
-    # SAVE WARPED IMAGE
+    # CONFIG
     # =========================
-    save_uint8(warped, OUTPUT_DIR / slice_paths[i].name)
+    INPUT_DIR = Path("data/slices_from_trimmed/130.889.slices")   # float store or PNG folder
+    OUTPUT_STORE = Path("results_stablee/best.slices")
+    OUTPUT_DIR = Path("results_stablee/best")   # PNG export only
+    TRANSFORM_DIR = Path("results_stablee/transforms")   # loose files, optional
+    TRANSFORM_BUNDLE = Path("results_stablee/transforms.bundle")
 
-    # Update prev with stable warped result
-    prev = ants.from_numpy(warped)
+    EXPORT_PNG = False
+    KEEP_LOOSE_TRANSFORMS = False
 
-print("\n✅ Rigid → SyN sequential anchoring complete")
-print(f"Results saved to: {OUTPUT_DIR}")
+    # Rigid start: None | "phase" | "phase_accept" (see rigid_stage)
+    RIGID_INIT = "phase"
+    INIT_ACCEPT_NCC = 0.95
+
+    # Crop to the tissue ROI; PAD is the legacy padding when disabled.
+    # Cropped images keep their ROI offset as origin, so transforms stay in
+    # full-frame coordinates.
+    CROP_TO_TISSUE = True
+    CROP_MARGIN_FRAC = 0.1
+    CROP_MIN_MARGIN = 8
+    PAD = 80
+
+    # Displacement fields in the bundle: "full" stores the ANTs warps exactly;
+    # "downsample" / "bspline" (opt-in, lossy) keep them on a FIELD_FACTOR-times
+    # coarser grid and fall back to "full" for a field whose reconstruction
+    # error exceeds FIELD_TOLERANCE pixels
+    FIELD_MODE = "full"
+    FIELD_FACTOR = 4
+    FIELD_TOLERANCE = 0.5
+
+    # SyN schedule: None → fixed SYN_PARAMS reg_iterations; ADAPTIVE_SYN →
+    # stop each level once a chunk of iterations gains < tol NCC.
+    # WARM_START (adaptive schedule only) starts each slice from the previous
+    # slice's deformation.
+    SYN_ADAPTIVE = None
+    WARM_START = SYN_ADAPTIVE is not None
+
+    # On-disk LRU cache of rigid / SyN results keyed by both images and all
+    # parameters: reruns only register pairs that changed. None → off.
+    REGISTRATION_CACHE = Path("results_stablee/.registration_cache")
+
+    # transforms.bundle of a preview run (pipeline.preview) to start every
+    # slice from; None → RIGID_INIT
+    PREVIEW_BUNDLE = None
+
+    register_stack(
+        INPUT_DIR,
+        bundle_path=TRANSFORM_BUNDLE,
+        out_store=OUTPUT_STORE,
+        png_dir=OUTPUT_DIR if EXPORT_PNG else None,
+        bad_slices=BAD_SLICE_NAMES,
+        rigid_init=RIGID_INIT,
+        init_accept_ncc=INIT_ACCEPT_NCC,
+        crop_to_tissue=CROP_TO_TISSUE,
+        crop_margin_frac=CROP_MARGIN_FRAC,
+        crop_min_margin=CROP_MIN_MARGIN,
+        pad=PAD,
+        field_mode=FIELD_MODE,
+        field_factor=FIELD_FACTOR,
+        field_tolerance=FIELD_TOLERANCE,
+        loose_dir=TRANSFORM_DIR if KEEP_LOOSE_TRANSFORMS else None,
+        syn_adaptive=SYN_ADAPTIVE,
+        warm_start=WARM_START,
+        cache=REGISTRATION_CACHE,
+        preview_init=None if PREVIEW_BUNDLE is None else PreviewInit(PREVIEW_BUNDLE),
+    )
 
+    print("\n✅ Rigid → SyN sequential anchoring complete")
+    print(f"Results saved to: {OUTPUT_STORE}")
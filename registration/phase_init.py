@@ -0,0 +1,178 @@
+import tempfile
+import numpy as np
+from scipy import ndimage as ndi
+
+# =========================
+# FFT RIGID INITIALIZER
+# =========================
+# Estimates rotation + translation between a moving slice and the fixed
+# (previous warped) slice:
+#   1. rotation from phase correlation of log-polar magnitude spectra
+#      (translation invariant); the strongest few angle peaks (the pixel
+#      grid adds a stationary one at 0° / 90°) and their 180° / sign
+#      ambiguity are resolved by trying every candidate,
+#   2. translation from phase correlation of the de-rotated moving slice.
+# The result is an ITK AffineTransform (fixed → moving, physical space) that
+# can be passed as ants.registration(initial_transform=...) or applied as is.
+N_ANGLES = 360
+N_RADII = 256
+N_ANGLE_PEAKS = 2
+
+
+def _window(shape):
+    return np.outer(np.hanning(shape[0]), np.hanning(shape[1])).astype(np.float32)
+
+
+def _correlation(a, b):
+    cross = np.fft.fft2(a) * np.conj(np.fft.fft2(b))
+    cross /= np.abs(cross) + 1e-12
+    return np.real(np.fft.ifft2(cross))
+
+
+def _subpixel(c0, cm, cp):
+    # parabolic peak offset from three samples
+    denom = cm - 2 * c0 + cp
+    return 0.5 * (cm - cp) / denom if abs(denom) > 1e-12 else 0.0
+
+
+def phase_correlate(a, b):
+    # Returns (shift, peak) such that a(p) ≈ b(p - shift); peak ∈ [0, 1]
+    corr = _correlation(a, b)
+
+    peak_idx = np.unravel_index(np.argmax(corr), corr.shape)
+    shift = np.zeros(2)
+    for ax, (i, n) in enumerate(zip(peak_idx, corr.shape)):
+        # parabolic sub-pixel refinement along each axis
+        lo = list(peak_idx)
+        hi = list(peak_idx)
+        lo[ax] = (i - 1) % n
+        hi[ax] = (i + 1) % n
+        s = i + _subpixel(corr[peak_idx], corr[tuple(lo)], corr[tuple(hi)])
+        shift[ax] = s - n if s > n / 2 else s
+
+    return shift, float(corr[peak_idx])
+
+
+def angle_peaks(fixed_lp, moving_lp, n_peaks=N_ANGLE_PEAKS):
+    # rotations (rad, mod π) of the strongest local maxima of the log-polar
+    # phase correlation, best first
+    rows = _correlation(fixed_lp, moving_lp).max(axis=1)
+    n = len(rows)
+    local = [i for i in range(n) if rows[i] >= rows[i - 1] and rows[i] >= rows[(i + 1) % n]]
+    out = []
+    for i in sorted(local, key=lambda i: -rows[i])[:n_peaks]:
+        d = i + _subpixel(rows[i], rows[i - 1], rows[(i + 1) % n])
+        out.append((d - n if d > n / 2 else d) * np.pi / n)
+    return out
+
+
+def _log_polar_spectrum(img):
+    mag = np.abs(np.fft.fftshift(np.fft.fft2(img * _window(img.shape))))
+
+    # high-pass emphasis (Reddy & Chatterji) to suppress the DC blob
+    fy = np.fft.fftshift(np.fft.fftfreq(img.shape[0]))[:, None]
+    fx = np.fft.fftshift(np.fft.fftfreq(img.shape[1]))[None, :]
+    c = np.cos(np.pi * fy) * np.cos(np.pi * fx)
+    mag *= (1.0 - c) * (2.0 - c)
+
+    cy, cx = img.shape[0] / 2.0, img.shape[1] / 2.0
+    max_r = min(cy, cx)
+    theta = np.linspace(0, np.pi, N_ANGLES, endpoint=False)
+    radii = np.exp(np.linspace(0, np.log(max_r), N_RADII))
+
+    rows = cy + radii[None, :] * np.sin(theta)[:, None]
+    cols = cx + radii[None, :] * np.cos(theta)[:, None]
+    return ndi.map_coordinates(mag, [rows, cols], order=1, mode="constant")
+
+
+def rotate_about(img, angle, center):
+    # out(p) = img(R (p - c) + c), i.e. sampled through the ITK-style map
+    cos, sin = np.cos(angle), np.sin(angle)
+    rot = np.array([[cos, -sin], [sin, cos]])
+    offset = center - rot @ center
+    return ndi.affine_transform(img, rot, offset=offset, order=1, mode="constant")
+
+
+def ncc(a, b, mask=None):
+    if mask is not None:
+        a, b = a[mask], b[mask]
+    a = a - a.mean()
+    b = b - b.mean()
+    denom = np.sqrt((a * a).sum() * (b * b).sum())
+    return float((a * b).sum() / denom) if denom > 0 else 0.0
+
+
+def estimate_rigid(fixed_np, moving_np):
+    # Both arrays must already share one grid (same shape, same origin).
+    # Returns angle (rad), translation t and center c in index space such that
+    # fixed(p) ≈ moving(R (p - c) + c + t), plus the NCC after alignment.
+
+    # zero-pad so FFT wrap-around does not alias large offsets, and to a
+    # square: the log-polar circle is sampled in frequency-index space, which
+    # is only isotropic when both axes have the same length
+    size = 2 * max(fixed_np.shape)
+    pad = [((size - n) // 2, size - n - (size - n) // 2) for n in fixed_np.shape]
+    fixed_np = np.pad(np.asarray(fixed_np, dtype=np.float32), pad)
+    moving_np = np.pad(np.asarray(moving_np, dtype=np.float32), pad)
+    center = (np.array(fixed_np.shape) - 1) / 2.0
+
+    alphas = angle_peaks(_log_polar_spectrum(fixed_np), _log_polar_spectrum(moving_np))
+    candidates = [a for alpha in alphas for a in (alpha, -alpha, alpha + np.pi, -alpha + np.pi)]
+
+    best = None
+    for angle in candidates:
+        rotated = rotate_about(moving_np, angle, center)
+        s, peak = phase_correlate(fixed_np, rotated)
+        d = -s
+        cos, sin = np.cos(angle), np.sin(angle)
+        t = np.array([[cos, -sin], [sin, cos]]) @ d
+        if best is None or peak > best["peak"]:
+            best = {"angle": angle, "translation": t, "center": center, "peak": peak}
+
+    aligned = apply_rigid(moving_np, best["angle"], best["translation"], center)
+    best["ncc"] = ncc(fixed_np, aligned, mask=(fixed_np > 0) | (aligned > 0))
+    best["center"] = center - np.array([p[0] for p in pad])
+    return best
+
+
+def apply_rigid(img, angle, translation, center):
+    cos, sin = np.cos(angle), np.sin(angle)
+    rot = np.array([[cos, -sin], [sin, cos]])
+    offset = center - rot @ center + translation
+    return ndi.affine_transform(img, rot, offset=offset, order=1, mode="constant")
+
+
+# =========================
+# ANTs GLUE
+# =========================
+def phase_correlation_init(fixed, moving):
+    # fixed / moving are ANTs images (fixed may be padded, i.e. non-zero
+    # origin). Moving is resampled onto the fixed grid before estimation, so
+    # the returned transform is in physical coordinates.
+    import ants
+
+    moving_on_fixed = ants.resample_image_to_target(moving, fixed, interp_type="linear")
+    est = estimate_rigid(fixed.numpy(), moving_on_fixed.numpy())
+
+    cos, sin = np.cos(est["angle"]), np.sin(est["angle"])
+    origin = np.array(fixed.origin)
+    tx = ants.create_ants_transform(
+        transform_type="AffineTransform",
+        dimension=2,
+        matrix=np.array([[cos, -sin], [sin, cos]]),
+        center=origin + est["center"],
+        translation=est["translation"],
+    )
+
+    fd, path = tempfile.mkstemp(prefix="phasecorr", suffix="0GenericAffine.mat")
+    with open(fd, "w"):
+        pass
+    ants.write_transform(tx, path)
+
+    return {
+        "transform": path,
+        "angle_deg": float(np.degrees(est["angle"])),
+        "translation": est["translation"],
+        "peak": est["peak"],
+        "confidence": est["ncc"],
+    }
@@ -0,0 +1,89 @@
+import os
+import tempfile
+import numpy as np
+from pathlib import Path
+
+from preprocessing.slice_store import slice_index
+from registration.coordinate_map import FieldSampler, affine_matrix
+from registration.transform_bundle import TransformBundle
+
+# =========================
+# WARM START FROM A PREVIEW RUN
+# =========================
+# A preview run (pipeline.preview) registers every `slice_step`-th slice
+# after `downsample`× block averaging, so preview pixel p covers full pixels
+# f·p … f·p + f - 1 and
+#
+#   x_full = f · x_preview + (f - 1) / 2
+#
+# in the physical coordinates of both runs (raw pixel indices; the ROI only
+# moves the origin). Every bundle chain maps the anchor space to one slice,
+# so a preview chain is already a full-run initial guess for that slice:
+#
+#   rigid(name)        the linear part of the chain (SyN affine ∘ rigid),
+#                      rescaled, as an ITK transform file for the rigid stage
+#   field(name, ref)   the SyN warp resampled onto the full-run grid of ref,
+#                      for the adaptive SyN warm start
+#
+# Slices the preview skipped use their nearest previewed neighbour.
+
+
+def scale_matrix(h, factor):
+    # 3×3 preview-space affine → the same map in full-resolution coordinates
+    o = (factor - 1) / 2
+    s = np.array([[factor, 0, o], [0, factor, o], [0, 0, 1]], dtype=np.float64)
+    return s @ h @ np.linalg.inv(s)
+
+
+class PreviewInit:
+
+    def __init__(self, bundle_path, downsample=None):
+        self.bundle = TransformBundle(bundle_path)
+        preview = self.bundle.meta.get("preview", {})
+        self.factor = downsample or preview.get("downsample", 1)
+        self._names = self.bundle.names
+
+    def nearest(self, name):
+        idx = slice_index(name)
+        return min(self._names, key=lambda n: (abs(slice_index(n) - idx), -slice_index(n)))
+
+    def linear(self, name):
+        # composed forward affines of the nearest chain, full-resolution 3×3
+        h = np.eye(3)
+        for e in self.bundle.chain(self.nearest(name)):
+            if e["kind"] == "affine":
+                h = affine_matrix(e) @ h
+        return scale_matrix(h, self.factor)
+
+    def rigid(self, name):
+        # temporary ITK AffineTransform file (caller deletes it)
+        import ants
+
+        h = self.linear(name)
+        tx = ants.create_ants_transform(
+            transform_type="AffineTransform",
+            dimension=2,
+            parameters=list(h[:2, :2].ravel()) + list(h[:2, 2]),
+            fixed_parameters=[0.0, 0.0],
+        )
+        fd, path = tempfile.mkstemp(prefix="preview_init_", suffix=".mat")
+        os.close(fd)
+        ants.write_transform(tx, path)
+        return path
+
+    def field(self, name, ref):
+        # (H, W, 2) displacement on ref's grid, or None without a forward warp
+        warps = [e for e in self.bundle.chain(self.nearest(name)) if e["kind"] == "field"]
+        if not warps:
+            return None
+
+        e = warps[0]
+        sampler = FieldSampler(self.bundle.field(e), e["origin"], e["spacing"], e["direction"])
+        f, o = self.factor, (self.factor - 1) / 2
+        grid = np.indices(ref.shape, dtype=np.float64).reshape(2, -1).T
+        points = np.asarray(ref.origin) + grid * np.asarray(ref.spacing)
+        disp = sampler((points - o) / f) - (points - o) / f
+        return (f * disp).reshape(ref.shape + (2,)).astype(np.float32)
+
+    def close(self):
+        self.bundle.close()
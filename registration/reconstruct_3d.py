@@ -1,64 +1,63 @@
 import numpy as np
-import imageio.v2 as imageio
-import os
-from glob import glob
-import SimpleITK as sitk
 
-# =========================
-# CONFIG
-# =========================
-SLICE_DIR = "results_stable/best"
-OUT_NII = "results_stable/volume_registered.nii.gz"
+from preprocessing.prefetch import prefetch, prefetch_slices
+from preprocessing.slice_store import open_slices
 
 
 # =========================
-# LOAD SLICES 
+# STACK WITH CENTER PADDING
 # =========================
-slice_paths = sorted(
-    glob(os.path.join(SLICE_DIR, "slice_*.png")),
-    key=lambda x: int(os.path.basename(x).split("_")[1].split(".")[0])
-)
+def stack_centered(source):
+    # (Z, Y, X) float32 volume; slices centered on the largest canvas
+    source = open_slices(source)
+    slice_names = source.names
 
-if len(slice_paths) == 0:
-    raise RuntimeError("No slices found")
+    if len(slice_names) == 0:
+        raise RuntimeError("No slices found")
 
-print(f"Found {len(slice_paths)} slices")
+    print(f"Found {len(slice_names)} slices")
 
-# =========================
-# FIND MAX CANVAS SIZE
-# =========================
-max_h, max_w = 0, 0
-for p in slice_paths:
-    img = imageio.imread(p)
-    max_h = max(max_h, img.shape[0])
-    max_w = max(max_w, img.shape[1])
+    # =========================
+    # FIND MAX CANVAS SIZE
+    # =========================
+    max_h, max_w = 0, 0
+    for _, (h, w) in prefetch(lambda n: source.read(n).shape, slice_names):
+        max_h = max(max_h, h)
+        max_w = max(max_w, w)
 
-print(f"Canvas size: {max_h} x {max_w}")
+    print(f"Canvas size: {max_h} x {max_w}")
 
-# =========================
-# STACK WITH CENTER PADDING
-# =========================
-volume = []
+    volume = np.zeros((len(slice_names), max_h, max_w), dtype=np.float32)
 
-for p in slice_paths:
-    img = imageio.imread(p)
-    h, w = img.shape
+    for z, (name, img) in enumerate(prefetch_slices(source, slice_names)):
+        h, w = img.shape
 
-    padded = np.zeros((max_h, max_w), dtype=np.float32)
-    y0 = (max_h - h) // 2
-    x0 = (max_w - w) // 2
-    padded[y0:y0+h, x0:x0+w] = img
+        y0 = (max_h - h) // 2
+        x0 = (max_w - w) // 2
+        volume[z, y0:y0+h, x0:x0+w] = img
 
-    volume.append(padded)
+    print("Final volume shape:", volume.shape)
+    return volume
 
-volume = np.stack(volume, axis=0)  # (Z, Y, X)
-print("Final volume shape:", volume.shape)
 
-# =========================
-# SAVE AS NIFTI (.nii.gz)
-# =========================
-img_3d = sitk.GetImageFromArray(volume)
-img_3d.SetSpacing((1.0, 1.0, 1.0)) 
+def reconstruct_3d(slice_dir, out_nii):
+    from registration.transform_all import write_volume
+
+    volume = stack_centered(slice_dir)
+
+    # =========================
+    # SAVE AS NIFTI (.nii.gz)
+    # =========================
+    write_volume(volume, out_nii)
+    print(f"Saved 3D volume: {out_nii}")
+    return volume
+
+
+if __name__ == "__main__":
+    # =========================
+    # CONFIG
+    # =========================
+    SLICE_DIR = "results_stable/best.slices"   # float store or PNG folder
+    OUT_NII = "results_stable/volume_registered.nii.gz"
 
-sitk.WriteImage(img_3d, OUT_NII)
-print(f"Saved 3D volume: {OUT_NII}")
+    reconstruct_3d(SLICE_DIR, OUT_NII)
@@ -1,115 +1,107 @@
-import ants
 import numpy as np
-import cv2
 from pathlib import Path
 from tqdm import tqdm
-import napari
 
-# =========================
-# CONFIG
-# =========================
-TRANSFORM_DIR = Path("results/transforms")
-
-
-INPUT_DIR = Path("data/slices/130.889_gray")
-OUTPUT_DIR = Path("data/warped/130.889.new")
+from preprocessing.prefetch import AsyncWriter, prefetch_slices
+from preprocessing.slice_store import export_png, open_slices
 
-REFERENCE_SLICE = "slice_074.png"   # anchor slice 
-
-OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
 # =========================
-# LOAD REFERENCE (FIXED IMAGE)
+# APPLY TRANSFORMS
 # =========================
-ref_path = INPUT_DIR / REFERENCE_SLICE
-ref_img = cv2.imread(str(ref_path), cv2.IMREAD_GRAYSCALE)
+def reconstruct_mz(input_dir, transform_dir, reference_slice, output_dir=None, pad=80):
+    # Warps one channel with legacy per-slice transform folders
+    # ([warp, affine]) onto the padded reference grid.
+    # Returns (volume, slice names).
+    import ants
+
+    source = open_slices(input_dir)
+    transform_dir = Path(transform_dir)
+
+    # =========================
+    # LOAD REFERENCE (FIXED IMAGE)
+    # =========================
+    if reference_slice not in source:
+        raise RuntimeError(f"Failed to load reference slice: {reference_slice}")
+
+    ref_img = np.array(source.read(reference_slice), dtype=np.float32)
+    fixed = ants.from_numpy(ref_img)
+
+    # 🔧 ADD PADDING (CRITICAL)
+    fixed = ants.pad_image(
+        fixed,
+        pad_width=[pad, pad]   # start with 60–100, tune if needed
+    )
 
-if ref_img is None:
-    raise RuntimeError(f"Failed to load reference slice: {REFERENCE_SLICE}")
+    H, W = ref_img.shape
+    print(f"✔ Reference grid: {H} x {W}")
 
-ref_img = ref_img.astype(np.float32) / 255.0
-fixed = ants.from_numpy(ref_img)
+    if output_dir is not None:
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
 
-# 🔧 ADD PADDING (CRITICAL)
-PAD = 80   # start with 60–100, tune if needed
-fixed = ants.pad_image(
-    fixed,
-    pad_width=[PAD, PAD]
-)
+    warped_stack = []
+    slice_names = []
 
-# fixed = ants.from_numpy(ref_img)
+    print("\n🔹 Applying transforms to slices")
 
-H, W = ref_img.shape
-print(f"✔ Reference grid: {H} x {W}")
+    writer = AsyncWriter()
+    for sid, moving_np in tqdm(prefetch_slices(source, source.names), total=len(source)):
+        tdir = transform_dir / sid
 
-# =========================
-# APPLY TRANSFORMS
-# =========================
-warped_stack = []
-slice_names = []
+        if not tdir.exists():
+            print(f"⚠️ Missing transform folder for {sid}, skipping")
+            continue
 
-slice_paths = sorted(INPUT_DIR.glob("slice_*.png"))
+        affine = list(tdir.glob("*Affine.mat"))
+        warp = list(tdir.glob("*Warp.nii.gz"))
 
-print("\n🔹 Applying transforms to slices")
+        if not affine or not warp:
+            print(f"⚠️ Missing transforms for {sid}, skipping")
+            continue
 
-for sp in tqdm(slice_paths):
-    sid = sp.stem          # e.g. slice_026
-    tdir = TRANSFORM_DIR / sid
+        moving = ants.from_numpy(moving_np)
 
-    if not tdir.exists():
-        print(f"⚠️ Missing transform folder for {sid}, skipping")
-        continue
+        # apply transforms
+        warped = ants.apply_transforms(
+            fixed=fixed,
+            moving=moving,
+            transformlist=[str(warp[0]), str(affine[0])],
+            interpolator="linear"
+        )
 
-    affine = list(tdir.glob("*Affine.mat"))
-    warp = list(tdir.glob("*Warp.nii.gz"))
+        warped_np = warped.numpy()
 
-    if not affine or not warp:
-        print(f"⚠️ Missing transforms for {sid}, skipping")
-        continue
+        # save warped slice
+        if output_dir is not None:
+            writer.submit(export_png, warped_np, Path(output_dir) / f"{sid}.png")
 
-    # load slice
-    img = cv2.imread(str(sp), cv2.IMREAD_GRAYSCALE)
-    if img is None:
-        print(f"⚠️ Failed to read {sid}, skipping")
-        continue
+        warped_stack.append(warped_np)
+        slice_names.append(sid)
 
-    img = img.astype(np.float32) / 255.0
-    moving = ants.from_numpy(img)
+    writer.close()
+    print(f"\n✅ Warped {len(warped_stack)} slices")
 
-    # apply transforms
-    warped = ants.apply_transforms(
-        fixed=fixed,
-        moving=moving,
-        transformlist=[str(warp[0]), str(affine[0])],
-        interpolator="linear"
-    )
+    return np.stack(warped_stack, axis=0), slice_names
 
-    warped_np = warped.numpy()
 
-    # save warped slice
-    out_path = OUTPUT_DIR / f"{sid}.png"
-    cv2.imwrite(
-        str(out_path),
-        (np.clip(warped_np, 0, 1) * 255).astype(np.uint8)
-    )
+if __name__ == "__main__":
+    from visualisation.view_ants_napari import view_stack
 
-    warped_stack.append(warped_np)
-    slice_names.append(sid)
+    # =========================
+    # CONFIG
+    # =========================
+    TRANSFORM_DIR = Path("results/transforms")
 
-print(f"\n✅ Saved {len(warped_stack)} warped slices to {OUTPUT_DIR}")
-
-# =========================
-# NAPARI VISUALIZATION
-# =========================
-print("Launching napari...")
+    INPUT_DIR = Path("data/slices/130.889_gray")
+    OUTPUT_DIR = Path("data/warped/130.889.new")
 
-volume = np.stack(warped_stack, axis=0)
+    REFERENCE_SLICE = "slice_074.png"   # anchor slice
+    PAD = 80
 
-viewer = napari.Viewer()
-viewer.add_image(
-    volume,
-    name="Warped slices",
-    colormap="gray"
-)
+    volume, _ = reconstruct_mz(INPUT_DIR, TRANSFORM_DIR, REFERENCE_SLICE, OUTPUT_DIR, PAD)
 
-napari.run()
+    # =========================
+    # NAPARI VISUALIZATION
+    # =========================
+    print("Launching napari...")
+    view_stack(volume, name="Warped slices", percentiles=None)
@@ -0,0 +1,222 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import uuid
+import numpy as np
+from pathlib import Path
+
+# =========================
+# REGISTRATION CACHE
+# =========================
+# Memoizes registration calls on disk. The key hashes the stage name, the
+# fixed and moving images (pixels + origin / spacing / direction), any extra
+# arrays (e.g. a warm-start field), the full parameter set and the ANTs
+# version. One directory per entry:
+#
+#   <root>/<key>/entry.json   result keys: transform file names, scalars
+#   <root>/<key>/*.mat|*.nii.gz   transform files
+#   <root>/<key>/arrays.npz   images (warpedmovout, ...) and other arrays
+#
+# Hits hand out fresh temporary copies of the transform files, under their
+# original names in one regcache_* directory per hit, so callers can move or
+# delete them as they do with ants.registration output; release() removes
+# whatever is left, including the hit directory. The cache is
+# an LRU bounded by max_bytes: hits touch entry.json, and the oldest entries
+# are dropped after each insert. Entries are written under a temporary name
+# and renamed, so several workers can share one cache directory.
+CACHE_DIR_NAME = ".registration_cache"
+MAX_BYTES = 2 << 30
+ENTRY_NAME = "entry.json"
+ARRAYS_NAME = "arrays.npz"
+TRANSFORM_KEYS = ("fwdtransforms", "invtransforms")
+HIT_PREFIX = "regcache_"
+
+
+def _is_ants_image(value):
+    return hasattr(value, "numpy") and hasattr(value, "origin") and hasattr(value, "spacing")
+
+
+class RegistrationCache:
+
+    def __init__(self, root=CACHE_DIR_NAME, max_bytes=MAX_BYTES):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    # ---------------------------
+    # key
+    # ---------------------------
+    def key(self, stage, params, *images):
+        import ants
+
+        h = hashlib.blake2b(digest_size=16)
+        h.update(json.dumps([stage, ants.__version__, params], sort_keys=True, default=str).encode())
+        for img in images:
+            if img is None:
+                h.update(b"none")
+                continue
+            if _is_ants_image(img):
+                arr = img.numpy()
+                h.update(json.dumps([list(img.origin), list(img.spacing),
+                                     np.asarray(img.direction).ravel().tolist()]).encode())
+            else:
+                arr = np.asarray(img)
+            h.update(str((arr.dtype.str, arr.shape)).encode())
+            h.update(np.ascontiguousarray(arr).tobytes())
+        return h.hexdigest()
+
+    # ---------------------------
+    # read / write
+    # ---------------------------
+    def get(self, key):
+        import ants
+
+        entry_dir = self.root / key
+        hit_dir = None
+        try:
+            with open(entry_dir / ENTRY_NAME) as f:
+                entry = json.load(f)
+            os.utime(entry_dir / ENTRY_NAME)
+
+            # copies keep their ANTs basenames (<prefix>0GenericAffine.mat,
+            # <prefix>1Warp.nii.gz, ...) in one directory per hit
+            result = dict(entry["values"])
+            hit_dir = Path(tempfile.mkdtemp(prefix=HIT_PREFIX))
+            copies = {}
+            for name in entry["files"]:
+                tmp = hit_dir / name.split("_", 1)[1]
+                if tmp.exists():
+                    tmp = hit_dir / name
+                shutil.copyfile(entry_dir / name, tmp)
+                copies[name] = str(tmp)
+            for k in TRANSFORM_KEYS:
+                if k in entry["transforms"]:
+                    result[k] = [copies[name] for name in entry["transforms"][k]]
+
+            with np.load(entry_dir / ARRAYS_NAME) as arrays:
+                for k in entry["arrays"]:
+                    result[k] = arrays[k]
+                for k, geom in entry["images"].items():
+                    result[k] = ants.from_numpy(arrays[k], origin=tuple(geom["origin"]),
+                                                spacing=tuple(geom["spacing"]),
+                                                direction=np.reshape(geom["direction"], (2, 2)))
+        except (OSError, KeyError):
+            # missing or evicted (possibly by another worker) mid-read → miss
+            if hit_dir is not None:
+                shutil.rmtree(hit_dir, ignore_errors=True)
+            return None
+        return result
+
+    def put(self, key, result):
+        final = self.root / key
+        if final.exists():
+            return final
+
+        tmp = self.root / f".tmp-{uuid.uuid4().hex}"
+        tmp.mkdir()
+        entry = {"files": [], "transforms": {}, "arrays": [], "images": {}, "values": {}}
+        arrays = {}
+        stored = {}
+
+        for k, value in result.items():
+            if k in TRANSFORM_KEYS:
+                names = []
+                for path in value:
+                    if path not in stored:
+                        stored[path] = f"{len(stored):02d}_{Path(path).name}"
+                        shutil.copyfile(path, tmp / stored[path])
+                        entry["files"].append(stored[path])
+                    names.append(stored[path])
+                entry["transforms"][k] = names
+            elif _is_ants_image(value):
+                arrays[k] = value.numpy()
+                entry["images"][k] = {
+                    "origin": list(value.origin),
+                    "spacing": list(value.spacing),
+                    "direction": np.asarray(value.direction).ravel().tolist(),
+                }
+            elif isinstance(value, np.ndarray):
+                arrays[k] = value
+                entry["arrays"].append(k)
+            else:
+                entry["values"][k] = value
+
+        np.savez(tmp / ARRAYS_NAME, **arrays)
+        with open(tmp / ENTRY_NAME, "w") as f:
+            json.dump(entry, f, default=float)
+
+        try:
+            os.rename(tmp, final)
+        except OSError:
+            # another worker stored the same key first
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+        return final
+
+    def call(self, stage, params, images, compute):
+        # result of compute(), from the cache when the same call ran before
+        key = self.key(stage, params, *images)
+        result = self.get(key)
+        if result is not None:
+            self.hits += 1
+            return result
+
+        self.misses += 1
+        result = compute()
+        self.put(key, result)
+        return result
+
+    # ---------------------------
+    # LRU eviction
+    # ---------------------------
+    def entries(self):
+        # (last use, bytes, path), oldest first
+        out = []
+        for d in self.root.iterdir():
+            if d.name.startswith(".") or not (d / ENTRY_NAME).exists():
+                continue
+            size = sum(f.stat().st_size for f in d.iterdir())
+            out.append(((d / ENTRY_NAME).stat().st_mtime, size, d))
+        return sorted(out)
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, d in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(d, ignore_errors=True)
+            total -= size
+        return total
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+
+def release(*results):
+    # delete the transform files of registration results (cache hits or
+    # ants.registration output) and the emptied per-hit directories
+    dirs = set()
+    for result in results:
+        for k in TRANSFORM_KEYS:
+            for tf in result.get(k, []):
+                Path(tf).unlink(missing_ok=True)
+                dirs.add(Path(tf).parent)
+    for d in dirs:
+        if d.name.startswith(HIT_PREFIX):
+            shutil.rmtree(d, ignore_errors=True)
+
+
+def open_cache(cache, max_bytes=MAX_BYTES):
+    # None → no caching; a path → RegistrationCache there; caches pass through
+    if cache is None or isinstance(cache, RegistrationCache):
+        return cache
+    return RegistrationCache(cache, max_bytes)
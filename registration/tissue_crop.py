@@ -0,0 +1,81 @@
+import numpy as np
+from scipy import ndimage as ndi
+
+# =========================
+# TISSUE MASK / BOUNDING BOX
+# =========================
+# Registration runs on a common tissue ROI instead of the full raster plus a
+# fixed 80 px pad. Cropped images keep their ROI offset as ANTs origin, so
+# every transform stays in full-frame physical coordinates and can be applied
+# to uncropped slices unchanged.
+def otsu_threshold(values, n_bins=256):
+    hist, edges = np.histogram(values, bins=n_bins)
+    centers = (edges[:-1] + edges[1:]) / 2
+    w0 = np.cumsum(hist)
+    w1 = w0[-1] - w0
+    m0 = np.cumsum(hist * centers)
+    mu0 = m0 / np.maximum(w0, 1)
+    mu1 = (m0[-1] - m0) / np.maximum(w1, 1)
+    between = w0 * w1 * (mu0 - mu1) ** 2
+    return centers[np.argmax(between)]
+
+
+def tissue_mask(img, min_size=20):
+    nz = img[img > 0]
+    if nz.size == 0:
+        return np.zeros(img.shape, dtype=bool)
+
+    # Otsu on the non-zero pixels, but never above the median, so dim tissue
+    # next to bright structures is kept
+    thresh = min(otsu_threshold(nz), np.median(nz))
+    mask = img > thresh * 0.5
+    mask = ndi.binary_closing(mask, iterations=2)
+    mask = ndi.binary_fill_holes(mask)
+
+    labels, n = ndi.label(mask)
+    if n > 1:
+        sizes = ndi.sum(mask, labels, index=np.arange(1, n + 1))
+        mask = np.isin(labels, np.flatnonzero(sizes >= min_size) + 1)
+    return mask
+
+
+def tissue_bbox(img):
+    # (r0, c0, r1, c1), half-open, or None for an empty slice
+    mask = tissue_mask(img)
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if rows.size == 0:
+        return None
+    return int(rows[0]), int(cols[0]), int(rows[-1]) + 1, int(cols[-1]) + 1
+
+
+def common_roi(boxes, margin_frac=0.1, min_margin=8):
+    boxes = np.array([b for b in boxes if b is not None])
+    if boxes.size == 0:
+        raise RuntimeError("No tissue found in any slice")
+
+    r0, c0 = boxes[:, 0].min(), boxes[:, 1].min()
+    r1, c1 = boxes[:, 2].max(), boxes[:, 3].max()
+    mr = max(min_margin, int(np.ceil(margin_frac * (r1 - r0))))
+    mc = max(min_margin, int(np.ceil(margin_frac * (c1 - c0))))
+    return int(r0 - mr), int(c0 - mc), int(r1 + mr), int(c1 + mc)
+
+
+# =========================
+# CROP
+# =========================
+def crop(img, roi):
+    # zero-filled where the ROI extends past the raster
+    r0, c0, r1, c1 = roi
+    out = np.zeros((r1 - r0, c1 - c0), dtype=np.float32)
+    sr0, sc0 = max(r0, 0), max(c0, 0)
+    sr1, sc1 = min(r1, img.shape[0]), min(c1, img.shape[1])
+    if sr1 > sr0 and sc1 > sc0:
+        out[sr0 - r0:sr1 - r0, sc0 - c0:sc1 - c0] = img[sr0:sr1, sc0:sc1]
+    return out
+
+
+def crop_to_ants(img, roi):
+    import ants
+
+    return ants.from_numpy(crop(img, roi), origin=(float(roi[0]), float(roi[1])))
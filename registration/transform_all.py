@@ -1,111 +1,67 @@
-import ants
 import numpy as np
-import cv2
 from pathlib import Path
-import SimpleITK as sitk
+from scipy import ndimage as ndi
 from tqdm import tqdm
 
-# =========================
-# CONFIG
-# =========================
-SLICES_ROOT = Path("data/slices_from_trimmed")
-TRANSFORM_ROOT = Path("results_stable_clean/transforms")
-OUTPUT_ROOT = Path("data/volumes_new")
-
-REFERENCE_SLICE_NAME = "slice_078.png"
+from preprocessing.prefetch import AsyncWriter, prefetch_slices
+from preprocessing.slice_store import STORE_SUFFIX, open_slices
+from preprocessing.sparse_slices import SPARSE_SUFFIX
+from registration.main_registration import SYN_PARAMS
+from registration.transform_bundle import TransformBundle
 
 BAD_SLICE_INDICES = [8, 26, 44, 62]
 
+# Imputation of bad / untransformed slices:
+#   "copy"      previous warped slice (legacy)
+#   "blend"     linear intensity blend of the slices bracketing the gap
+#   "midpoint"  both neighbours deformed part-way along the SyN field between
+#               them, then blended; the field comes from the registered
+#               reference slices, once per gap, and is reused by every channel
+IMPUTE_MODES = ("copy", "blend", "midpoint")
+MIDPOINT_PARAMS = {**SYN_PARAMS, "type_of_transform": "SyNOnly"}
 
-OUTPUT_ROOT.mkdir(parents=True, exist_ok=True)
 
 # =========================
 # UTIL
 # =========================
-def numeric_slice_sort(p):
-    return int(p.stem.split("_")[1])
-
-def load_gray_np(path):
-    img = cv2.imread(str(path), cv2.IMREAD_GRAYSCALE)
-    img = img.astype(np.float32) / 255.0
-    return img
-
-# =========================
-# PROCESS EACH m/z FOLDER
-# =========================
-for mz_dir in sorted(SLICES_ROOT.glob("*_gray")):
-    mz = mz_dir.name.replace("_gray", "")
-    print(f"\n🚀 Processing m/z {mz}")
-
-    slice_paths = sorted(
-        mz_dir.glob("slice_*.png"),
-        key=numeric_slice_sort
-    )
+def channel_sources(root):
+    # float stores (dense, then sparse) first; PNG folders only for channels
+    # without a store
+    root = Path(root)
+    sources = {p.name[:-len(STORE_SUFFIX)]: p for p in root.glob(f"*{STORE_SUFFIX}")}
+    for p in root.glob(f"*{SPARSE_SUFFIX}"):
+        sources.setdefault(p.name[:-len(SPARSE_SUFFIX)], p)
+    for p in root.glob("*_gray"):
+        sources.setdefault(p.name.replace("_gray", ""), p)
+    return sorted(sources.items())
 
-    if not slice_paths:
-        print(f"⚠️ No slices found for {mz}, skipping")
-        continue
-
-    # =========================
-    # LOAD REGISTERED REFERENCE
-    # =========================
-    ref_path = Path("results_stable_clean/best") / REFERENCE_SLICE_NAME
 
-    if not ref_path.exists():
-        raise RuntimeError(f"Registered reference slice not found at {ref_path}")
+def write_volume(volume, out_path, spacing=(1.0, 1.0, 1.0)):
+    import SimpleITK as sitk
 
-    ref_img_np = load_gray_np(ref_path)
-    fixed = ants.from_numpy(ref_img_np)
-
-    warped_stack = []
-
-    # Folder to save warped PNG slices
-    # save_slice_dir = WARPED_SLICE_ROOT / mz
-    # save_slice_dir.mkdir(parents=True, exist_ok=True)
-
-    # =========================
-    # WARP EACH SLICE
-    # =========================
-    for sp in tqdm(slice_paths, desc=f"  Warping slices ({mz})"):
-        sid = sp.stem
-        idx = int(sid.split("_")[1])
-
-        # -----------------------------
-        # Handle BAD slices (impute)
-        # -----------------------------
-        if idx in BAD_SLICE_INDICES:
-            print(f"⚠️ Imputing bad slice {sid} by copying previous slice")
+    sitk_img = sitk.GetImageFromArray(volume)
+    sitk_img.SetSpacing(spacing)
+    sitk.WriteImage(sitk_img, str(out_path))
+    return out_path
 
-            if warped_stack:
-                warped_stack.append(warped_stack[-1])
-            else:
-                warped_stack.append(ref_img_np)
 
-            continue
+# =========================
+# TRANSFORM SOURCES
+# =========================
+class LooseTransforms:
+    # legacy per-slice folders written by older main_registration runs
 
-        # -----------------------------
-        # Anchor slice
-        # -----------------------------
-        if sid == REFERENCE_SLICE_NAME.replace(".png", ""):
-            # warped_stack.append(ref_img_np)
-            continue
+    def __init__(self, root):
+        self.root = Path(root)
 
-        # -----------------------------
-        # Normal transform logic
-        # -----------------------------
-        moving_np = load_gray_np(sp)
-        moving = ants.from_numpy(moving_np)
+    def __contains__(self, name):
+        return bool(self.transform_list(name))
 
-        tdir = TRANSFORM_ROOT / sid
+    def transform_list(self, name):
+        # [warp, SyN affine, rigid affine]
+        tdir = self.root / name
         if not tdir.exists():
-            print(f"⚠️ Missing transforms for {sid}, copying previous slice")
-
-            if warped_stack:
-                warped_stack.append(warped_stack[-1])
-            else:
-                warped_stack.append(ref_img_np)
-
-            continue
+            return []
 
         affines = sorted(tdir.glob("*GenericAffine.mat"))
         warps = sorted(tdir.glob("*Warp.nii.gz"))
@@ -134,45 +90,274 @@ for mz_dir in sorted(SLICES_ROOT.glob("*_gray")):
         elif affines:
             transform_list = [str(affines[0])]
 
-        else:
-            print(f"No usable transforms for {sid}, copying previous slice")
+        return transform_list
 
-            if warped_stack:
-                warped_stack.append(warped_stack[-1])
-            else:
-                warped_stack.append(ref_img_np)
-
-            continue
+    def apply(self, name, moving, fixed, interpolation="linear"):
+        import ants
 
-        warped = ants.apply_transforms(
+        return ants.apply_transforms(
             fixed=fixed,
             moving=moving,
-            transformlist=transform_list,
-            interpolator="linear"
+            transformlist=self.transform_list(name),
+            interpolator=interpolation
         )
 
+
+def open_transforms(bundle_path=None, transform_root=None):
+    if hasattr(bundle_path, "apply"):
+        return bundle_path
+    if bundle_path is not None and Path(bundle_path).exists():
+        bundle = TransformBundle(bundle_path)
+        print(f"Transform bundle: {len(bundle.slices)} slices, "
+              f"max field error {bundle.max_error():.3f} px")
+        return bundle
+    if transform_root is not None:
+        return LooseTransforms(transform_root)
+    raise FileNotFoundError("No transform bundle or transform folder found")
+
+
+def reference_image(registered, reference_name):
+    import ants
+
+    registered = open_slices(registered)
+    if reference_name not in registered:
+        raise RuntimeError(f"Registered reference slice {reference_name} not found")
+
+    ref_img_np = np.array(registered.read(reference_name), dtype=np.float32)
+    return ants.from_numpy(ref_img_np, origin=registered.origin(reference_name))
+
+
+# =========================
+# WARP ONE CHANNEL
+# =========================
+def warp_slices(source, transforms, fixed, reference_name, bad_indices=BAD_SLICE_INDICES,
+                names=None, desc=""):
+    # Warped slice per name (all names by default, anchor excluded); None
+    # marks a slice to impute, so ranges warped separately can be joined
+    # before fill_imputed
+    import ants
+
+    source = open_slices(source)
+    ref_sid = Path(reference_name).stem
+    names = source.names if names is None else names
+
+    # slices that will be warped are read ahead in the background
+    to_warp = [sid for sid in names
+               if int(sid.split("_")[1]) not in bad_indices and sid != ref_sid and sid in transforms]
+    loaded = prefetch_slices(source, to_warp)
+
+    warped_stack = []
+
+    for sid in tqdm(names, desc=f"  Warping slices{desc}"):
+        idx = int(sid.split("_")[1])
+
+        # -----------------------------
+        # Handle BAD slices (impute)
+        # -----------------------------
+        if idx in bad_indices:
+            print(f"⚠️ Imputing bad slice {sid}")
+            warped_stack.append(None)
+            continue
+
+        # -----------------------------
+        # Anchor slice
+        # -----------------------------
+        if sid == ref_sid:
+            continue
+
+        # -----------------------------
+        # Normal transform logic
+        # -----------------------------
+        if sid not in transforms:
+            print(f"⚠️ Missing transforms for {sid}, imputing")
+            warped_stack.append(None)
+            continue
+
+        _, moving_np = next(loaded)
+        warped = transforms.apply(sid, ants.from_numpy(moving_np), fixed)
         warped_stack.append(warped.numpy())
 
+    return warped_stack
 
-        # Save warped PNG slice
-        # out_png = save_slice_dir / f"{sid}.png"
-        # cv2.imwrite(str(out_png), (arr * 255).astype(np.uint8))
 
-    if not warped_stack:
-        print(f"⚠️ No slices warped for {mz}")
-        continue
+# =========================
+# IMPUTATION
+# =========================
+class MidpointFields:
+    # SyN displacement (next → prev, numpy axes, pixels) between two
+    # registered reference slices, cached per pair
+
+    def __init__(self, registered, params=MIDPOINT_PARAMS):
+        self.registered = open_slices(registered)
+        self.params = params
+        self._fields = {}
+
+    def __call__(self, prev_name, next_name):
+        import ants
+
+        key = (prev_name, next_name)
+        if key not in self._fields:
+            if not all(name in self.registered for name in key):
+                self._fields[key] = None
+                return None
+
+            prev, nxt = (ants.from_numpy(np.array(self.registered.read(n), dtype=np.float32))
+                         for n in key)
+            print(f"Midpoint field {key[0]} → {key[1]}")
+            reg = ants.registration(fixed=nxt, moving=prev, **self.params)
+            warps = [tf for tf in reg["fwdtransforms"] if tf.endswith("Warp.nii.gz")]
+            self._fields[key] = ants.image_read(warps[0]).numpy() if warps else None
+            for tf in set(reg["fwdtransforms"] + reg["invtransforms"]):
+                Path(tf).unlink(missing_ok=True)
+        return self._fields[key]
+
+
+def midpoint_slice(prev, nxt, field, t):
+    # next-grid point x ↔ prev point x + u(x); the section a fraction t of
+    # the way from prev sits at x + (1 - t) u, so with u taken at the output
+    # pixel: prev at p + t u, next at p - (1 - t) u
+    grid = np.indices(prev.shape, dtype=np.float32)
+    u = np.moveaxis(field, -1, 0)
+    a = ndi.map_coordinates(prev, grid + t * u, order=1, mode="nearest")
+    b = ndi.map_coordinates(nxt, grid - (1 - t) * u, order=1, mode="nearest")
+    return ((1 - t) * a + t * b).astype(np.float32)
+
+
+def _gaps(warped_stack):
+    i, n = 0, len(warped_stack)
+    while i < n:
+        if warped_stack[i] is None:
+            j = i
+            while j < n and warped_stack[j] is None:
+                j += 1
+            yield i, j
+            i = j
+        else:
+            i += 1
+
+
+def fill_imputed(warped_stack, ref_img_np, mode="copy", names=None, fields=None):
+    # copy: previous slice, the reference image before the first one.
+    # blend / midpoint: interpolate across each gap between the slices around
+    # it; gaps at either end of the stack copy their one neighbour. midpoint
+    # needs the stack names and a MidpointFields; gaps without a field fall
+    # back to blend.
+    if mode not in IMPUTE_MODES:
+        raise ValueError(f"impute must be one of {IMPUTE_MODES}")
+
+    if mode == "copy":
+        filled = []
+        for img in warped_stack:
+            if img is None:
+                img = filled[-1] if filled else ref_img_np
+            filled.append(img)
+        return filled
+
+    if mode == "midpoint" and (names is None or fields is None):
+        raise ValueError("midpoint imputation needs the stack names and a MidpointFields")
+
+    filled = list(warped_stack)
+    n = len(filled)
+    for a, b in _gaps(filled):
+        if a == 0 or b == n:
+            # one-sided gap: nearest slice (the reference if there is none)
+            side = filled[b] if b < n else filled[a - 1] if a > 0 else ref_img_np
+            filled[a:b] = [side] * (b - a)
+            continue
 
-    # =========================
-    # STACK → NIFTI
-    # =========================
-    volume = np.stack(warped_stack, axis=0)
+        prev, nxt = filled[a - 1], filled[b]
+        field = fields(names[a - 1], names[b]) if mode == "midpoint" else None
 
-    sitk_img = sitk.GetImageFromArray(volume)
-    sitk_img.SetSpacing((1.0, 1.0, 1.0))
+        for k in range(a, b):
+            t = (k - a + 1) / (b - a + 1)
+            if field is None:
+                filled[k] = ((1 - t) * prev + t * nxt).astype(np.float32)
+            else:
+                filled[k] = midpoint_slice(prev, nxt, field, t)
+    return filled
+
+
+def warp_channel(source, transforms, fixed, reference_name, bad_indices=BAD_SLICE_INDICES, desc="",
+                 impute="copy", fields=None):
+    # Returns the (Z, Y, X) volume on the fixed grid, or None if no slices
+    source = open_slices(source)
+    warped_stack = warp_slices(source, transforms, fixed, reference_name, bad_indices, desc=desc)
+    if not warped_stack:
+        return None
+
+    names = [n for n in source.names if n != Path(reference_name).stem]
+    return np.stack(fill_imputed(warped_stack, fixed.numpy(), impute, names, fields), axis=0)
 
-    out_path = OUTPUT_ROOT / f"{mz}.nii.gz"
-    sitk.WriteImage(sitk_img, str(out_path))
 
-    print(f"Saved {out_path}")
+# =========================
+# PROCESS EACH m/z CHANNEL
+# =========================
+def transform_all(slices_root, registered, output_root, reference_name,
+                  bundle_path=None, transform_root=None, bad_indices=BAD_SLICE_INDICES,
+                  volume_ext=".nii", impute="copy"):
+    # volume_ext: ".nii" (uncompressed) lets append_slices grow the volumes in
+    # place; ".nii.gz" is smaller but every later append rewrites it in full. impute: see IMPUTE_MODES; imputed slices are computed
+    # while each channel is warped, no separate imputation pass.
+    output_root = Path(output_root)
+    output_root.mkdir(parents=True, exist_ok=True)
+
+    transforms = open_transforms(bundle_path, transform_root)
+    fixed = reference_image(registered, reference_name)
+    fields = MidpointFields(registered) if impute == "midpoint" else None
+
+    out_paths = {}
+    # volumes are written while the next channel warps
+    with AsyncWriter(depth=2) as writer:
+        for mz, mz_path in channel_sources(slices_root):
+            print(f"\n🚀 Processing m/z {mz}")
+
+            source = open_slices(mz_path)
+            if not source.names:
+                print(f"⚠️ No slices found for {mz}, skipping")
+                continue
+
+            volume = warp_channel(source, transforms, fixed, reference_name, bad_indices,
+                                  f" ({mz})", impute, fields)
+            if volume is None:
+                print(f"⚠️ No slices warped for {mz}")
+                continue
+
+            # =========================
+            # STACK → NIFTI
+            # =========================
+            out_paths[mz] = output_root / f"{mz}{volume_ext}"
+            writer.submit(write_volume, volume, out_paths[mz])
+
+    print(f"Saved {len(out_paths)} volumes to {output_root}")
+    return out_paths
+
+
+if __name__ == "__main__":
+    # =========================
+    # CONFIG
+    # =========================
+    SLICES_ROOT = Path("data/slices_from_trimmed")
+    TRANSFORM_BUNDLE = Path("results_stable_clean/transforms.bundle")
+    TRANSFORM_ROOT = Path("results_stable_clean/transforms")   # used if no bundle
+    REGISTERED = Path("results_stable_clean/best.slices")   # float store or PNG folder
+    OUTPUT_ROOT = Path("data/volumes_new")
+
+    REFERENCE_SLICE_NAME = "slice_078.png"
+
+    # ".nii" → uncompressed, grows in place when slices are appended later;
+    # ".nii.gz" → compressed, rewritten in full on every append
+    VOLUME_EXT = ".nii"
+
+    # Bad slices: "copy" | "blend" | "midpoint" (see IMPUTE_MODES)
+    IMPUTE = "midpoint"
+
+    transform_all(
+        SLICES_ROOT, REGISTERED, OUTPUT_ROOT, REFERENCE_SLICE_NAME,
+        bundle_path=TRANSFORM_BUNDLE,
+        transform_root=TRANSFORM_ROOT,
+        bad_indices=BAD_SLICE_INDICES,
+        volume_ext=VOLUME_EXT,
+        impute=IMPUTE,
+    )
 
-print("\nALL m/z volumes generated successfully")
+    print("\nALL m/z volumes generated successfully")
@@ -0,0 +1,259 @@
+import json
+import struct
+import numpy as np
+from pathlib import Path
+from scipy import ndimage as ndi
+
+# =========================
+# TRANSFORM BUNDLE
+# =========================
+# One file per registration run holding every slice's transform chain:
+#
+#   b"TFBUNDL1"
+#   float32 field blocks, 64-byte aligned (memory-mapped on read)
+#   JSON index: slice → ordered transform list
+#   footer: uint64 index offset, uint64 index length
+#
+# Each chain is stored in ants.apply_transforms order (fixed → moving):
+# displacement fields first, then the SyN affine, then the rigid affine.
+# Fields can be stored
+#   "full"        as written by ANTs (exact, the default),
+#   "downsample"  on a grid `factor` times coarser, linearly upsampled,
+#   "bspline"     as cubic B-spline coefficients on that coarser grid,
+# and record the max reconstruction error (in pixels) against the original;
+# the two compressed modes are lossy and opt-in.
+# Appending rewrites only the index, so adding slices is cheap.
+MAGIC = b"TFBUNDL1"
+FOOTER = struct.Struct("<QQ")
+ALIGN = 64
+FIELD_MODES = ("full", "downsample", "bspline")
+
+
+# =========================
+# FIELD COMPRESSION
+# =========================
+def _coarse_shape(shape, factor):
+    return tuple(max(2, int(np.ceil((n - 1) / factor)) + 1) for n in shape)
+
+
+def _grid(src_shape, dst_shape):
+    # coordinates of every dst pixel in src index space (corners aligned)
+    axes = [
+        np.linspace(0, s - 1, d) for s, d in zip(src_shape, dst_shape)
+    ]
+    return np.meshgrid(*axes, indexing="ij")
+
+
+def compress_field(field, mode="downsample", factor=4):
+    # field: (H, W, 2) displacement. Returns (stored array, max error).
+    field = np.asarray(field, dtype=np.float32)
+    if mode == "full":
+        return field, 0.0
+
+    shape = field.shape[:2]
+    coarse_shape = _coarse_shape(shape, factor)
+    coords = _grid(shape, coarse_shape)
+
+    coarse = np.empty(coarse_shape + (field.shape[2],), dtype=np.float32)
+    for c in range(field.shape[2]):
+        smooth = ndi.gaussian_filter(field[..., c], sigma=factor / 3.0)
+        coarse[..., c] = ndi.map_coordinates(smooth, coords, order=1, mode="nearest")
+        if mode == "bspline":
+            coarse[..., c] = ndi.spline_filter(coarse[..., c], order=3, mode="nearest")
+
+    recon = expand_field(coarse, shape, mode)
+    return coarse, float(np.abs(recon - field).max())
+
+
+def expand_field(stored, shape, mode):
+    if mode == "full":
+        return np.asarray(stored, dtype=np.float32)
+
+    coords = _grid(stored.shape[:2], shape)
+    order = 3 if mode == "bspline" else 1
+    out = np.empty(tuple(shape) + (stored.shape[2],), dtype=np.float32)
+    for c in range(stored.shape[2]):
+        out[..., c] = ndi.map_coordinates(
+            stored[..., c], coords, order=order, mode="nearest", prefilter=False
+        )
+    return out
+
+
+# =========================
+# BUNDLE FILE
+# =========================
+class TransformBundle:
+
+    def __init__(self, path, mode="r"):
+        if mode not in ("r", "w", "a"):
+            raise ValueError("mode must be 'r', 'w' or 'a'")
+
+        self.path = Path(path)
+        self.mode = mode
+        self._mmap = None
+        self._fh = None
+        self._expanded = {}
+
+        if mode == "w" or (mode == "a" and not self.path.exists()):
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._fh = open(self.path, "wb")
+            self._fh.write(MAGIC)
+            self.meta = {}
+            self.slices = {}
+        else:
+            index_offset, self.meta, self.slices = self._read_index()
+            if mode == "a":
+                self._fh = open(self.path, "r+b")
+                self._fh.truncate(index_offset)
+                self._fh.seek(index_offset)
+
+    def _read_index(self):
+        with open(self.path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{self.path} is not a transform bundle")
+            f.seek(-FOOTER.size, 2)
+            offset, length = FOOTER.unpack(f.read(FOOTER.size))
+            f.seek(offset)
+            index = json.loads(f.read(length))
+        return offset, index.get("meta", {}), index["slices"]
+
+    # ---------------------------
+    # write
+    # ---------------------------
+    def _write_block(self, arr):
+        pos = self._fh.tell()
+        pad = (-pos) % ALIGN
+        self._fh.write(b"\0" * pad)
+        offset = pos + pad
+        self._fh.write(np.ascontiguousarray(arr, dtype=np.float32).tobytes())
+        return offset
+
+    def add(self, name, transform_files, field_mode="full", factor=4, tolerance=None):
+        # transform_files: ants.apply_transforms order, e.g. [1Warp, 0Affine, rigid]
+        import ants
+
+        if self._fh is None:
+            raise IOError(f"Transform bundle {self.path} is read-only")
+
+        chain = []
+        for tf in map(str, transform_files):
+            if tf.endswith(".mat"):
+                tx = ants.read_transform(tf)
+                chain.append({
+                    "kind": "affine",
+                    "type": tx.type,
+                    "parameters": [float(p) for p in tx.parameters],
+                    "fixed_parameters": [float(p) for p in tx.fixed_parameters],
+                })
+                continue
+
+            img = ants.image_read(tf)
+            field = img.numpy()
+            mode = field_mode
+            stored, err = compress_field(field, mode, factor)
+            if tolerance is not None and err > tolerance:
+                mode, stored, err = "full", field, 0.0
+
+            chain.append({
+                "kind": "field",
+                "inverse": "InverseWarp" in Path(tf).name,
+                "mode": mode,
+                "factor": factor if mode != "full" else 1,
+                "shape": list(field.shape[:2]),
+                "stored_shape": list(stored.shape),
+                "offset": self._write_block(stored),
+                "origin": list(img.origin),
+                "spacing": list(img.spacing),
+                "direction": np.asarray(img.direction).ravel().tolist(),
+                "max_error": err,
+            })
+
+        self.slices[Path(name).stem] = chain
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.seek(0, 2)
+            index = json.dumps({"meta": self.meta, "slices": self.slices}).encode()
+            offset = self._fh.tell()
+            self._fh.write(index)
+            self._fh.write(FOOTER.pack(offset, len(index)))
+            self._fh.close()
+            self._fh = None
+        self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # ---------------------------
+    # read
+    # ---------------------------
+    def __contains__(self, name):
+        return Path(name).stem in self.slices
+
+    @property
+    def names(self):
+        return sorted(self.slices, key=lambda n: int(n.split("_")[1]))
+
+    def _block(self, entry):
+        n = int(np.prod(entry["stored_shape"]))
+        start = entry["offset"]
+        if self._mmap is None or self._mmap.size < start + 4 * n:
+            if self._fh is not None:
+                self._fh.flush()
+            self._mmap = np.memmap(self.path, dtype=np.uint8, mode="r")
+        raw = self._mmap[start:start + 4 * n]
+        return raw.view(np.float32).reshape(entry["stored_shape"])
+
+    def field(self, entry):
+        # full-resolution displacement field (H, W, 2), cached per entry
+        key = entry["offset"]
+        if key not in self._expanded:
+            self._expanded[key] = expand_field(self._block(entry), entry["shape"], entry["mode"])
+        return self._expanded[key]
+
+    def chain(self, name):
+        # forward chain (fixed → moving); stored inverse fields are skipped
+        return [
+            e for e in self.slices[Path(name).stem]
+            if e["kind"] == "affine" or not e["inverse"]
+        ]
+
+    def ants_transform(self, name):
+        # Composite forward ANTsTransform (fixed → moving), for
+        # ants.apply_ants_transform_to_image(tx, moving, fixed)
+        import ants
+
+        parts = []
+        for e in self.chain(name):
+            if e["kind"] == "affine":
+                parts.append(ants.create_ants_transform(
+                    transform_type=e["type"],
+                    dimension=2,
+                    parameters=e["parameters"],
+                    fixed_parameters=e["fixed_parameters"],
+                ))
+            else:
+                field = ants.from_numpy(
+                    self.field(e),
+                    origin=tuple(e["origin"]),
+                    spacing=tuple(e["spacing"]),
+                    direction=np.reshape(e["direction"], (2, 2)),
+                    has_components=True,
+                )
+                parts.append(ants.transform_from_displacement_field(field))
+        return ants.compose_ants_transforms(parts)
+
+    def apply(self, name, moving, fixed, interpolation="linear"):
+        import ants
+
+        return ants.apply_ants_transform_to_image(
+            self.ants_transform(name), moving, fixed, interpolation=interpolation
+        )
+
+    def max_error(self, name=None):
+        names = self.slices if name is None else [Path(name).stem]
+        errs = [e["max_error"] for n in names for e in self.slices[n] if e["kind"] == "field"]
+        return max(errs, default=0.0)
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+from scipy import ndimage as ndi
+
+ants = pytest.importorskip("ants")
+
+from registration.coordinate_map import ChainMapper
+from registration.main_registration import rigid_stage, store_transforms, syn_stage
+from registration.transform_bundle import TransformBundle
+
+
+def _pair():
+    yy, xx = np.mgrid[0:64, 0:64]
+    fixed = (((yy - 32) / 20.0) ** 2 + ((xx - 30) / 14.0) ** 2 < 1).astype(np.float32)
+    fixed += 0.7 * (((yy - 24) ** 2 + (xx - 36) ** 2) < 36)
+    fixed = ndi.gaussian_filter(fixed, 1.5)
+    # rotation + shift for the rigid stage, anisotropic scaling for the SyN
+    # affine, a local bump for the warp
+    moving = ndi.shift(ndi.rotate(fixed, 7, reshape=False, order=1), (2.5, -1.5), order=1)
+    moving = ndi.affine_transform(moving, np.diag([0.85, 1.15]), offset=(4.8, -4.5), order=1)
+    disp = 2.0 * np.exp(-((yy - 40) ** 2 + (xx - 26) ** 2) / 60.0)
+    moving = ndi.map_coordinates(moving, [yy + disp, xx - disp], order=1)
+    return ants.from_numpy(fixed), ants.from_numpy(moving.astype(np.float32))
+
+
+@pytest.fixture(scope="module")
+def chain(tmp_path_factory):
+    # Rigid + SyN (with its affine stage), stored like register_stack does;
+    # the ANTs inverse list is kept for comparison before the files go
+    fixed, moving = _pair()
+    rigid = rigid_stage(fixed, moving, rigid_init=None)
+    syn = syn_stage(fixed, rigid["warpedmovout"],
+                    dict(type_of_transform="SyN", reg_iterations=(20, 10, 0), verbose=False))
+
+    inverse_files = rigid["fwdtransforms"] + syn["invtransforms"]
+    inverse_affines = [ants.read_transform(tf) for tf in inverse_files[:-1]]
+    inverse_warp = ants.image_read(inverse_files[-1])
+
+    path = tmp_path_factory.mktemp("chain") / "transforms.bundle"
+    with TransformBundle(path, mode="w") as bundle:
+        store_transforms(bundle, "slice_001", rigid, syn, field_mode="full")
+    return ChainMapper(path), fixed, moving, inverse_affines, inverse_warp
+
+
+def _interior(n=64, margin=12):
+    r, c = np.mgrid[margin:n - margin:3, margin:n - margin:3]
+    return np.stack([r.ravel(), c.ravel()], axis=1).astype(np.float64)
+
+
+def test_round_trip(chain):
+    mapper = chain[0]
+    points = _interior()
+    back = mapper.inverse("slice_001", mapper.forward("slice_001", points))
+    err = np.linalg.norm(back - points, axis=1)
+    assert np.median(err) < 0.05
+
+
+def test_inverse_matches_ants(chain, tmp_path):
+    # coordinate images on the fixed grid, pulled onto the moving grid through
+    # the ANTs inverse chain [rigid⁻¹, SyN affine⁻¹, inverse warp]
+    mapper, fixed, moving, inverse_affines, inverse_warp = chain
+    files = []
+    for i, tx in enumerate(inverse_affines):
+        files.append(str(tmp_path / f"inv{i}.mat"))
+        ants.write_transform(tx, files[-1])
+    files.append(str(tmp_path / "1InverseWarp.nii.gz"))
+    ants.image_write(inverse_warp, files[-1])
+
+    rows, cols = np.indices(fixed.shape, dtype=np.float32)
+    pulled = [
+        ants.apply_transforms(moving, ants.from_numpy(coord), files,
+                              whichtoinvert=[True] * len(inverse_affines) + [False]).numpy()
+        for coord in (rows, cols)
+    ]
+
+    points = _interior()
+    idx = points.astype(int)
+    expected = np.stack([p[idx[:, 0], idx[:, 1]] for p in pulled], axis=1)
+    mapped = mapper.inverse("slice_001", points)
+    err = np.linalg.norm(mapped - expected, axis=1)
+    assert np.median(err) < 0.01 and err.max() < 0.05
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+from scipy import ndimage as ndi
+
+from registration.phase_init import apply_rigid, estimate_rigid, ncc
+
+
+def _section(shape):
+    # asymmetric blobs on a non-square raster
+    yy, xx = np.mgrid[0:shape[0], 0:shape[1]]
+    cy, cx = shape[0] / 2, shape[1] / 2
+    img = (((yy - cy) / (0.3 * shape[0])) ** 2 + ((xx - cx) / (0.35 * shape[1])) ** 2 < 1).astype(np.float32)
+    img += 0.8 * (((yy - cy + 12) ** 2 + (xx - cx - 20) ** 2) < 80)
+    img += 0.5 * (((yy - cy - 15) ** 2 + (xx - cx + 5) ** 2) < 30)
+    return ndi.gaussian_filter(img, 1.5)
+
+
+@pytest.mark.parametrize("shape", [(120, 160), (160, 120), (160, 160)])
+@pytest.mark.parametrize("degrees", [10, -25, 60])
+def test_rotation_non_square(shape, degrees):
+    fixed = _section(shape)
+    center = (np.array(shape) - 1) / 2.0
+    moving = apply_rigid(fixed, -np.radians(degrees), np.array([3.0, -4.0]), center)
+
+    est = estimate_rigid(fixed, moving)
+    err = (np.degrees(est["angle"]) - degrees + 180) % 360 - 180
+    assert abs(err) < 1.5
+
+    aligned = apply_rigid(moving, est["angle"], est["translation"], est["center"])
+    mask = fixed > 0.05
+    assert ncc(fixed, aligned, mask) > max(0.95, ncc(fixed, moving, mask))
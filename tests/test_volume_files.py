@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+sitk = pytest.importorskip("SimpleITK")
+
+from preprocessing.channel_stats import volume_channel_stats, volume_files
+from registration.lowrank_cube import volume_channels
+
+
+@pytest.fixture
+def volume_dir(tmp_path):
+    rng = np.random.default_rng(0)
+    for name in ("100.100.nii", "200.200.nii.gz", "300.300.nii", "300.300.nii.gz"):
+        vol = rng.random((3, 8, 9)).astype(np.float32)
+        sitk.WriteImage(sitk.GetImageFromArray(vol), str(tmp_path / name))
+    return tmp_path
+
+
+def test_both_extensions(volume_dir):
+    files = volume_files(volume_dir)
+    assert list(files) == ["100.100", "200.200", "300.300"]
+    assert files["100.100"].name == "100.100.nii"
+    assert files["300.300"].name == "300.300.nii"
+    assert volume_channels(volume_dir) == files
+
+
+def test_channel_stats_reads_nii(volume_dir):
+    summary, _ = volume_channel_stats(volume_dir, use_cache=False)
+    assert sorted(summary["mz"]) == ["100.100", "200.200", "300.300"]
+    vol = sitk.GetArrayFromImage(sitk.ReadImage(str(volume_dir / "100.100.nii")))
+    row = summary.set_index("mz").loc["100.100"]
+    assert row["total"] == pytest.approx(vol.sum(), rel=1e-5)
@@ -0,0 +1,26 @@
+import os
+import time
+
+from pipeline.workqueue import WorkQueue
+
+
+def _expire(queue, unit_id):
+    old = time.time() - 10 * queue.lease_seconds
+    os.utime(queue._path("leases", unit_id), (old, old))
+
+
+def test_expired_lease_broken_once(tmp_path):
+    queue = WorkQueue(tmp_path, lease_seconds=5)
+    queue.submit({"u": {}})
+    assert queue.claim("dead") is not None
+    _expire(queue, "u")
+
+    # A breaks the expired lease and claims the unit; B, whose age check ran
+    # before that, must not break A's fresh lease
+    assert queue.claim("a") is not None
+    assert not queue._break_expired("u")
+
+    assert queue.holder("u") == "a"
+    assert queue.attempts("u") == 1
+    queue.heartbeat("u", "a")
+    assert queue.claim("b") is None
@@ -1,28 +1,39 @@
-import SimpleITK as sitk
-import napari
 import numpy as np
 
-# load volume
-img = sitk.ReadImage("data/volumes_new/102.057.nii.gz")
-volume = sitk.GetArrayFromImage(img)
 
-print("Volume shape:", volume.shape)
+def load_volume(path):
+    import SimpleITK as sitk
 
-lo = np.percentile(volume, 5)
-hi = np.percentile(volume, 98)
+    img = sitk.ReadImage(str(path))
+    return sitk.GetArrayFromImage(img)
 
-viewer = napari.Viewer(ndisplay=3)
 
-layer = viewer.add_image(
-    volume,
-    name="Registered cochlea",
-    colormap="gray",
-    rendering="attenuated_mip",
-    gamma=0.6,
-    contrast_limits=(lo, hi),
-    blending="translucent_no_depth",
-)
+def view_volume(volume, name="Registered cochlea", percentiles=(5, 98)):
+    import napari
 
-layer.interpolation = "nearest"
+    print("Volume shape:", volume.shape)
 
-napari.run()
+    lo = np.percentile(volume, percentiles[0])
+    hi = np.percentile(volume, percentiles[1])
+
+    viewer = napari.Viewer(ndisplay=3)
+
+    layer = viewer.add_image(
+        volume,
+        name=name,
+        colormap="gray",
+        rendering="attenuated_mip",
+        gamma=0.6,
+        contrast_limits=(lo, hi),
+        blending="translucent_no_depth",
+    )
+
+    layer.interpolation = "nearest"
+
+    napari.run()
+    return viewer
+
+
+if __name__ == "__main__":
+    # load volume
+    view_volume(load_volume("data/volumes_new/102.057.nii.gz"))
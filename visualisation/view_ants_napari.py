@@ -1,61 +1,70 @@
 import numpy as np
-import imageio.v2 as imageio
-import napari
 from glob import glob
 import os
 
-# =========================
-# CONFIG
-# =========================
-SLICE_DIR = "data/warped_slices/137.001"
-
-
 
 # =========================
 # LOAD SLICES
 # =========================
-slice_paths = sorted(glob(os.path.join(SLICE_DIR, "*.png")))
+def load_stack(slice_dir):
+    import imageio.v2 as imageio
 
-if len(slice_paths) == 0:
-    raise RuntimeError("No registered slices found!")
+    slice_paths = sorted(glob(os.path.join(slice_dir, "*.png")))
 
-print(f"Found {len(slice_paths)} registered slices")
+    if len(slice_paths) == 0:
+        raise RuntimeError("No registered slices found!")
 
-stack = []
-max_h, max_w = 0, 0
+    print(f"Found {len(slice_paths)} registered slices")
 
-# First pass: find max shape
-for p in slice_paths:
-    img = imageio.imread(p)
-    max_h = max(max_h, img.shape[0])
-    max_w = max(max_w, img.shape[1])
+    # First pass: find max shape
+    images = [imageio.imread(p) for p in slice_paths]
+    max_h = max(img.shape[0] for img in images)
+    max_w = max(img.shape[1] for img in images)
 
-print(f"Max slice size: {max_h} x {max_w}")
+    print(f"Max slice size: {max_h} x {max_w}")
 
-# Second pass: pad + stack
-for p in slice_paths:
-    img = imageio.imread(p)
+    # Second pass: pad + stack
+    stack = []
+    for img in images:
+        padded = np.zeros((max_h, max_w), dtype=img.dtype)
+        padded[: img.shape[0], : img.shape[1]] = img
 
-    padded = np.zeros((max_h, max_w), dtype=img.dtype)
-    padded[: img.shape[0], : img.shape[1]] = img
+        stack.append(padded)
 
-    stack.append(padded)
+    volume = np.stack(stack, axis=0)
+    print("Final volume shape:", volume.shape)
+    return volume
 
-volume = np.stack(stack, axis=0)
-print("Final volume shape:", volume.shape)
 
 # =========================
 # VIEW IN NAPARI
 # =========================
-viewer = napari.Viewer()
-viewer.add_image(
-    volume,
-    name="Registered MALDI",
-    colormap="gray",
-    contrast_limits=(
-        np.percentile(volume, 1),
-        np.percentile(volume, 99)
+def view_stack(volume, name="Registered MALDI", percentiles=(1, 99)):
+    import napari
+
+    kwargs = {}
+    if percentiles is not None:
+        kwargs["contrast_limits"] = (
+            np.percentile(volume, percentiles[0]),
+            np.percentile(volume, percentiles[1])
+        )
+
+    viewer = napari.Viewer()
+    viewer.add_image(
+        volume,
+        name=name,
+        colormap="gray",
+        **kwargs
     )
-)
 
-napari.run()
+    napari.run()
+    return viewer
+
+
+if __name__ == "__main__":
+    # =========================
+    # CONFIG
+    # =========================
+    SLICE_DIR = "data/warped_slices/137.001"
+
+    view_stack(load_stack(SLICE_DIR))